@@ -5,31 +5,153 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import atexit
+import collections
 import datetime
-import json
-import os
+import hashlib
 import random
+import time
 
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, abort, redirect, render_template, request, send_from_directory, url_for
+from flask import before_render_template, template_rendered
 from flask_pymongo import PyMongo
-from bson import json_util
-
-from annotation_tools import default_config as cfg
+from pymongo import DeleteOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from annotation_tools import connection
+from annotation_tools import consensus
+from annotation_tools import metrics
+from annotation_tools import queries
+from annotation_tools import segmentation
+from annotation_tools import serialization
+from annotation_tools import task_dispatch
+from annotation_tools import tiles
+from annotation_tools.caches import (BBOX_TASK_INSTRUCTIONS_VERSION_ID, CATEGORY_VERSION_ID, VersionedCache,
+                                     invalidate_bbox_task_instructions_cache, invalidate_cache,
+                                     invalidate_category_cache)
+from annotation_tools.ingest import BatchWriter
+
+# Maximum number of images returned by a single batch request.
+MAX_IMAGES_PER_REQUEST = 100
 
 app = Flask(__name__)
-#app.config.from_object('annotation_tools.default_config')
-app.config['MONGO_URI'] = 'mongodb://'+cfg.MONGO_HOST+':'+str(cfg.MONGO_PORT)+'/'+cfg.MONGO_DBNAME
+# The settings of `default_config` and the VAT_CONFIG file, read by the connection module (the command
+# line tools share it, without importing the app).
+app.config.update(connection.get_settings())
+app.config['MONGO_URI'] = connection.mongo_uri()
+
+def get_config(key):
+  """ Return a configuration value, falling back to `default_config`.
+  """
+  return app.config.get(key, connection.get_config(key))
 
-if 'VAT_CONFIG' in os.environ:
-  app.config.from_envvar('VAT_CONFIG')
-mongo = PyMongo(app)
+def _request_stats_enabled():
+  """ The per request timings are needed for the metrics and for the slow request log.
+  """
+  return get_config('METRICS_ENABLED') or get_config('SLOW_REQUEST_THRESHOLD') is not None
+
+mongo = PyMongo(app, **connection.client_options(
+  event_listeners=[metrics.command_timer] if _request_stats_enabled() else []))
 
 def get_db():
   """ Return a handle to the database
   """
-  with app.app_context():
-    db = mongo.db
-    return db
+  return mongo.db
+
+def _is_xhr():
+  return request.headers.get('X-Requested-With', '').lower() == 'xmlhttprequest'
+
+def _json_response(obj, status=200):
+  """ Encode `obj` (which can hold BSON types, e.g. ObjectIds) in one pass.
+  """
+  return Response(serialization.dumpb(obj), status=status, mimetype='application/json')
+
+################### Metrics ######################
+
+def _route_label():
+  """ The route pattern (e.g. `/bbox_task/<task_id>`) of the current request, so that requests
+  for different ids are counted together.
+  """
+  if request.url_rule is not None:
+    return request.url_rule.rule
+  return 'unmatched'
+
+@app.before_request
+def _start_request_metrics():
+  if _request_stats_enabled():
+    metrics.start_request()
+
+@before_render_template.connect_via(app)
+def _start_render_metrics(sender, template, context, **extra):
+  stats = metrics.current_request()
+  if stats is not None:
+    stats.render_start_time = time.time()
+
+@template_rendered.connect_via(app)
+def _end_render_metrics(sender, template, context, **extra):
+  stats = metrics.current_request()
+  if stats is not None and getattr(stats, 'render_start_time', None) is not None:
+    stats.add('render', time.time() - stats.render_start_time)
+    stats.render_start_time = None
+
+@app.after_request
+def _record_request_metrics(response):
+  stats = metrics.end_request()
+  if stats is None:
+    return response
+
+  route = _route_label()
+  duration = time.time() - stats.start_time
+  if get_config('METRICS_ENABLED'):
+    metrics.request_duration.observe((route, request.method, str(response.status_code)), duration)
+    for phase, seconds in stats.phases.items():
+      metrics.request_phase_duration.observe((route, phase), seconds)
+    metrics.request_mongo_commands.observe((route,), stats.num_mongo_commands)
+    if request.content_length is not None:
+      metrics.request_size.observe((route,), request.content_length)
+    # Streamed responses don't have a length.
+    if response.content_length is not None:
+      metrics.response_size.observe((route,), response.content_length)
+
+  threshold = get_config('SLOW_REQUEST_THRESHOLD')
+  if threshold is not None and duration >= threshold:
+    app.logger.warning("Slow request: %s %s (%s) %d %.3fs, %d mongo commands (%.3fs), serialize %.3fs, render %.3fs, %s bytes",
+      request.method, request.path, route, response.status_code, duration,
+      stats.num_mongo_commands, stats.phases['mongo'], stats.phases['serialize'], stats.phases['render'],
+      response.content_length)
+
+  return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+  """ Return the metrics of this process in the Prometheus text format.
+  """
+  if not get_config('METRICS_ENABLED'):
+    abort(404)
+  return Response(metrics.expose(), content_type=metrics.PROMETHEUS_CONTENT_TYPE)
+
+################### Caches ######################
+
+CachedCategories = collections.namedtuple('CachedCategories', ['categories', 'categories_json', 'etag', 'id_to_category'])
+
+def _load_categories(db):
+  """ Load the categories and serialize them once.
+  """
+  categories = list(db.category.find(projection={'_id' : False}))
+  categories_json = serialization.dumps(categories)
+  return CachedCategories(
+    categories=categories,
+    categories_json=categories_json,
+    etag=hashlib.sha1(categories_json.encode('utf-8')).hexdigest(),
+    id_to_category={cat['id'] : cat for cat in categories}
+  )
+
+def _load_bbox_task_instructions(db):
+  return {instructions['id'] : instructions
+          for instructions in db.bbox_task_instructions.find(projection={'_id' : False})}
+
+category_cache = VersionedCache(CATEGORY_VERSION_ID, _load_categories, get_config('CACHE_CHECK_INTERVAL'))
+bbox_task_instructions_cache = VersionedCache(BBOX_TASK_INSTRUCTIONS_VERSION_ID, _load_bbox_task_instructions, get_config('CACHE_CHECK_INTERVAL'))
 
 ############### Dataset Utilities ###############
 
@@ -44,103 +166,450 @@ def edit_image(image_id):
   """
 
   image = mongo.db.image.find_one_or_404({'id' : image_id})
+  _add_tile_info([image])
   annotations = list(mongo.db.annotation.find({'image_id' : image_id}))
-  categories = list(mongo.db.category.find())
 
-  image = json_util.dumps(image)
-  annotations = json_util.dumps(annotations)
-  categories = json_util.dumps(categories)
+  with metrics.timed('serialize'):
+    image = serialization.dumps(image)
+    annotations = serialization.dumps(annotations)
 
-  if request.is_xhr:
+  if _is_xhr():
     # Return just the data
-    return jsonify({
-      'image' : json.loads(image),
-      'annotations' : json.loads(annotations),
-      'categories' : json.loads(categories)
+    categories = category_cache.get(mongo.db)
+    data = '{"image":%s,"annotations":%s,"categories":%s}' % (image, annotations, categories.categories_json)
+    return Response(data, mimetype='application/json')
+  else:
+    # Render a webpage to edit the annotations for this image. The page fetches the categories from `/categories`.
+    return render_template('edit_image.html', image=image, annotations=annotations)
+
+@app.route('/categories')
+def categories():
+  """ Return all of the categories. Browsers revalidate them with the ETag, and only download
+  them again when they change.
+  """
+  cached = category_cache.get(mongo.db)
+  response = Response(cached.categories_json, mimetype='application/json')
+  response.set_etag(cached.etag)
+  response.headers['Cache-Control'] = 'no-cache'
+  return response.make_conditional(request)
+
+@app.route('/edit_images/')
+def edit_images():
+  """ Return the images and annotations for a window of image ids, in the requested order.
+  Used by the edit sequence to prefetch upcoming images.
+  """
+
+  image_ids = [image_id for image_id in request.args.get('image_ids', '').split(',') if image_id != '']
+  image_ids = image_ids[:MAX_IMAGES_PER_REQUEST]
+
+  images = _add_tile_info(list(mongo.db.image.find({'id' : {'$in' : image_ids}})))
+  image_id_to_image = {image['id'] : image for image in images}
+
+  image_id_to_annotations = {image_id : [] for image_id in image_id_to_image}
+  for anno in mongo.db.annotation.find({'image_id' : {'$in' : list(image_id_to_image.keys())}}):
+    image_id_to_annotations[anno['image_id']].append(anno)
+
+  image_data = []
+  missing_image_ids = []
+  for image_id in image_ids:
+    if image_id in image_id_to_image:
+      image_data.append({
+        'image' : image_id_to_image[image_id],
+        'annotations' : image_id_to_annotations[image_id]
+      })
+    else:
+      missing_image_ids.append(image_id)
+
+  with metrics.timed('serialize'):
+    return _json_response({
+      'image_data' : image_data,
+      'missing_image_ids' : missing_image_ids
     })
+
+def _find_image_ids(category_id=None, after=None, skip=0, limit=None):
+  """ Return image ids sorted by id, optionally only the images that have an annotation for `category_id`.
+  Args:
+    category_id: Only return images with annotations for this category.
+    after: Only return image ids greater than this id (i.e. continue from a previous page).
+    skip: The number of image ids to skip.
+    limit: The maximum number of image ids to return.
+  """
+  if category_id is not None:
+    match = {'category_id' : category_id}
+    if after is not None:
+      match['image_id'] = {'$gt' : after}
+    pipeline = [
+      {'$match' : match},
+      # Sorting on the (category_id, image_id) index lets the server jump between distinct image ids.
+      {'$sort' : {'category_id' : 1, 'image_id' : 1}},
+      {'$group' : {'_id' : '$image_id'}},
+      {'$sort' : {'_id' : 1}}
+    ]
+    if skip > 0:
+      pipeline.append({'$skip' : skip})
+    if limit is not None:
+      pipeline.append({'$limit' : limit})
+    return [doc['_id'] for doc in mongo.db.annotation.aggregate(pipeline, allowDiskUse=True)]
+
+  query = {}
+  if after is not None:
+    query['id'] = {'$gt' : after}
+  cursor = mongo.db.image.find(query, projection={'id' : True, '_id' : False}).sort([('id', 1)]).skip(skip)
+  if limit is not None:
+    cursor = cursor.limit(limit)
+  return [image['id'] for image in cursor]
+
+def _image_id_page(args):
+  """ Return a page of image ids for an edit task, and the cursor for the next page (or None).
+
+  `start` and `end` select a fixed range of image ids, which is returned in full. Otherwise pages
+  of EDIT_TASK_PAGE_SIZE image ids are returned, starting at `start` or after the `after` cursor.
+  `randomize` shuffles the image ids of each page: the pages themselves stay in image id order.
+  """
+  category_id = args.get('category_id')
+  after = args.get('after')
+  start = int(args.get('start', 0))
+  end = int(args['end']) if 'end' in args else None
+
+  if end is not None:
+    image_ids = _find_image_ids(category_id, after, skip=start, limit=max(0, end - start))
+    next_cursor = None
   else:
-    # Render a webpage to edit the annotations for this image
-    return render_template('edit_image.html', image=image, annotations=annotations, categories=categories)
+    page_size = get_config('EDIT_TASK_PAGE_SIZE')
+    image_ids = _find_image_ids(category_id, after, skip=start if after is None else 0, limit=page_size)
+    next_cursor = image_ids[-1] if len(image_ids) == page_size else None
+
+  if int(args.get('randomize', 0)) >= 1:
+    random.shuffle(image_ids)
+
+  return image_ids, next_cursor
+
+def _image_summaries(image_ids):
+  """ Return the url and dimensions of the images, in the order of `image_ids`, so that the client can
+  start downloading them before it fetches their annotations.
+  """
+  images = mongo.db.image.find({'id' : {'$in' : image_ids}},
+                               projection={'_id' : False, 'id' : True, 'url' : True, 'width' : True, 'height' : True})
+  image_id_to_image = {image['id'] : image for image in images}
+  return [image_id_to_image[image_id] for image_id in image_ids if image_id in image_id_to_image]
 
 @app.route('/edit_task/')
 def edit_task():
   """ Edit a group of images.
   """
 
+  page_args = None
+  next_cursor = None
+
   if 'image_ids' in request.args:
 
     image_ids = request.args['image_ids'].split(',')
 
   else:
 
-    start=0
-    if 'start' in request.args:
-      start = int(request.args['start'])
-    end=None
-    if 'end' in request.args:
-      end = int(request.args['end'])
-
-    # Find annotations and their accompanying images for this category
-    if 'category_id' in request.args:
-      category_id = request.args['category_id']
-      annos = mongo.db.annotation.find({ "category_id" : category_id}, projection={'image_id' : True, '_id' : False})#.sort([('image_id', 1)])
-      image_ids = list(set([anno['image_id'] for anno in annos]))
-      image_ids.sort()
-
-    # Else just grab all of the images.
-    else:
-      images = mongo.db.image.find(projection={'id' : True, '_id' : False}).sort([('id', 1)])
-      image_ids = [image['id'] for image in images]
+    image_ids, next_cursor = _image_id_page(request.args)
 
-    if end is None:
-      image_ids = image_ids[start:]
-    else:
-      image_ids = image_ids[start:end]
-
-    if 'randomize' in request.args:
-      if request.args['randomize'] >= 1:
-        random.shuffle(image_ids)
+    # The client fetches the next pages with these arguments, as it reaches the end of the current page.
+    page_args = {key : request.args[key] for key in ['category_id', 'randomize'] if key in request.args}
 
-  categories = list(mongo.db.category.find(projection={'_id' : False}))
+  prefetch_count = get_config('IMAGE_PREFETCH_COUNT')
 
+  # The page fetches the categories from `/categories`.
   return render_template('edit_task.html',
     task_id=1,
     image_ids=image_ids,
-    categories=categories,
+    next_cursor=next_cursor,
+    page_args=page_args,
+    images=_add_tile_info(_image_summaries(image_ids[:prefetch_count + 1])),
+    prefetch_count=prefetch_count
   )
 
+@app.route('/edit_task/image_ids')
+def edit_task_image_ids():
+  """ Return the next page of image ids for an edit task.
+  """
+  image_ids, next_cursor = _image_id_page(request.args)
+  return _json_response({
+    'image_ids' : image_ids,
+    'next_cursor' : next_cursor,
+    'images' : _add_tile_info(_image_summaries(image_ids[:get_config('IMAGE_PREFETCH_COUNT')]))
+  })
+
+def _query_args(filter_types):
+  """ Parse the filters and the page size of a query request, aborting with 400 if they are malformed.
+  """
+  try:
+    return queries.parse_filters(request.args, filter_types), queries.parse_limit(request.args.get('limit'))
+  except ValueError as e:
+    abort(400, description=str(e))
+
+@app.route('/query/annotations')
+def query_annotations():
+  """ Return a page of annotations matching the filters in the query string (see `queries.annotation_pipeline`).
+  Pass `next_cursor` as `after` to get the next page.
+  """
+  filters, limit = _query_args(queries.ANNOTATION_FILTERS)
+  annotations, next_cursor = queries.find_annotations(mongo.db, after=request.args.get('after'), limit=limit, **filters)
+  with metrics.timed('serialize'):
+    return _json_response({
+      'annotations' : annotations,
+      'next_cursor' : next_cursor
+    })
+
+@app.route('/query/images')
+def query_images():
+  """ Return a page of {image_id, count} documents for the images whose number of instances
+  matches the filters in the query string (see `queries.image_pipeline`).
+  """
+  filters, limit = _query_args(queries.IMAGE_FILTERS)
+  images, next_cursor = queries.find_images(mongo.db, after=request.args.get('after'), limit=limit, **filters)
+  return _json_response({
+    'images' : images,
+    'next_cursor' : next_cursor
+  })
+
+@app.route('/query/category_histogram')
+def query_category_histogram():
+  """ Return the instance and image counts of each category. `area_boundaries` (comma separated)
+  adds a histogram of the instance areas.
+  """
+  area_boundaries = None
+  if request.args.get('area_boundaries'):
+    try:
+      area_boundaries = [float(b) for b in request.args['area_boundaries'].split(',')]
+    except ValueError:
+      abort(400, description="Invalid `area_boundaries`: %s" % (request.args['area_boundaries'],))
+  return _json_response({
+    'categories' : queries.category_histogram(mongo.db, area_boundaries)
+  })
+
+def _stored_annotations(annotations):
+  """ Return a dict mapping the `_id`s of the annotations that are in the database to their stored
+  bbox, segmentation and area.
+  """
+  existing_ids = [anno['_id'] for anno in annotations if '_id' in anno]
+  if len(existing_ids) == 0:
+    return {}
+  return {anno['_id'] : anno for anno in mongo.db.annotation.find(
+    {'_id' : {'$in' : existing_ids}}, projection={'bbox' : True, 'segmentation' : True, 'area' : True})}
+
+def _prepare_saved_annotations(annotations, id_to_stored):
+  """ Normalize the segmentations of annotations that are about to be saved, and compute their missing
+  bboxes and their areas (see `segmentation.prepare_annotations`).
+
+  Editing a bbox or a segmentation makes its area stale, so those areas are recomputed. The areas of
+  the other annotations are kept: they may have been computed differently (e.g. the COCO areas of an
+  imported dataset).
+  Args:
+    annotations: The annotations to save.
+    id_to_stored: The stored annotations, see `_stored_annotations`.
+  Returns:
+    A dict mapping the `id()` of each annotation that can't be saved to an error message.
+  """
+  changed = []
+  unchanged = []
+  for anno in annotations:
+    stored = id_to_stored.get(anno.get('_id'))
+    if (stored is not None and stored.get('bbox') == anno.get('bbox')
+        and stored.get('segmentation') == anno.get('segmentation')):
+      if 'area' not in anno and 'area' in stored:
+        anno['area'] = stored['area']
+      unchanged.append(anno)
+    else:
+      changed.append(anno)
+
+  image_ids = list(set(anno['image_id'] for anno in annotations if 'image_id' in anno))
+  image_id_to_w_h = {image['id'] : (float(image['width']), float(image['height']))
+                     for image in _image_summaries(image_ids) if 'width' in image and 'height' in image}
+
+  errors = {}
+  for batch, overwrite in [(changed, True), (unchanged, False)]:
+    try:
+      segmentation.prepare_annotations(batch, image_id_to_w_h, normalized=True, overwrite=overwrite)
+    except Exception:
+      # Find the annotations that can't be prepared, the others are still saved.
+      for anno in batch:
+        try:
+          segmentation.prepare_annotations([anno], image_id_to_w_h, normalized=True, overwrite=overwrite)
+        except Exception as e:
+          errors[id(anno)] = "Can't compute the area of the annotation: %s" % (e,)
+  return errors
+
 @app.route('/annotations/save', methods=['POST'])
 def save_annotations():
   """ Save the annotations. This will overwrite annotations.
-  """
-  annotations = json_util.loads(json.dumps(request.json['annotations']))
 
+  Only the annotations in the payload are touched, so the client can send just the annotations
+  that changed. All of the writes are sent in one ordered bulk write. The response has one result
+  per annotation, in payload order:
+    {'id' : str, '_id' : ObjectId, 'status' : 'replaced' | 'upserted' | 'deleted' | 'skipped' | 'not_found' | 'error' | 'not_saved'}
+  The client should send the returned `_id` with later saves of new annotations. The `area` of a
+  new annotation, or of one whose bbox or segmentation changed, is recomputed from its segmentation
+  or from its bbox. Other annotations keep their stored area.
+
+  An edited annotation with an `_id` that is no longer in the database (e.g. another editor deleted
+  it) is not saved, its status is 'not_found' and the response status is 409. Deleting an annotation
+  that is already gone succeeds.
+  """
+  with metrics.timed('serialize'):
+    # Decode the raw body: Flask's json provider would decode it once, and the `$oid`s would need a second pass.
+    annotations = serialization.loads(request.get_data())['annotations']
+
+  id_to_stored = _stored_annotations(annotations)
+  saved_annotations = [anno for anno in annotations
+                       if not anno.get('deleted', False) and ('_id' not in anno or anno['_id'] in id_to_stored)]
+  prepare_errors = _prepare_saved_annotations(saved_annotations, id_to_stored)
+
+  results = []
+  operations = []
+  operation_result_indices = [] # The result index of each operation
+  upsert_operation_indices = [] # The operation index of each upsert
+  replace_operations = [] # The (operation index, _id) of each replace of an existing annotation
   for annotation in annotations:
+    result = {'id' : annotation.get('id')}
+    results.append(result)
+    deleted = 'deleted' in annotation and annotation['deleted']
+
+    if '_id' in annotation and annotation['_id'] not in id_to_stored:
+      result['_id'] = annotation['_id']
+      if deleted:
+        # Deletes are idempotent, the annotation is gone either way.
+        result['status'] = 'deleted'
+        continue
+      result['status'] = 'not_found'
+      result['message'] = 'The annotation is no longer in the database.'
+      continue
+
+    if id(annotation) in prepare_errors:
+      if '_id' in annotation:
+        result['_id'] = annotation['_id']
+      result['status'] = 'error'
+      result['message'] = prepare_errors[id(annotation)]
+      continue
+
     # Is this an existing annotation?
     if '_id' in annotation:
-      if 'deleted' in annotation and annotation['deleted']:
-        mongo.db.annotation.delete_one({'_id' : annotation['_id']})
+      result['_id'] = annotation['_id']
+      if deleted:
+        operations.append(DeleteOne({'_id' : annotation['_id']}))
+        result['status'] = 'deleted'
       else:
-        result = mongo.db.annotation.replace_one({'_id' : annotation['_id']}, annotation)
+        replace_operations.append((len(operations), annotation['_id']))
+        operations.append(ReplaceOne({'_id' : annotation['_id']}, annotation))
+        result['status'] = 'replaced'
     else:
-      if 'deleted' in annotation and annotation['deleted']:
-        pass # this annotation was created and then deleted.
-      else:
-        # This is a new annotation
-        # The client should have created an id for this new annotation
-        # Upsert the new annotation so that we create it if its new, or replace it if (e.g) the
-        # user hit the save button twice, so the _id field was never seen by the client.
-        assert 'id' in annotation
-        mongo.db.annotation.replace_one({'id' : annotation['id']}, annotation, upsert=True)
-
-        # if 'id' not in annotation:
-        #   insert_res = mongo.db.annotation.insert_one(annotation, bypass_document_validation=True)
-        #   anno_id =  insert_res.inserted_id
-        #   mongo.db.annotation.update_one({'_id' : anno_id}, {'$set' : {'id' : str(anno_id)}})
-        # else:
-        #   insert_res = mongo.db.insert_one(annotation)
+      if deleted:
+        result['status'] = 'skipped' # this annotation was created and then deleted.
+        continue
+      if 'id' not in annotation:
+        result['status'] = 'error'
+        result['message'] = 'New annotations must have an `id`.'
+        continue
+      # This is a new annotation
+      # The client should have created an id for this new annotation
+      # Upsert the new annotation so that we create it if its new, or replace it if (e.g) the
+      # user hit the save button twice, so the _id field was never seen by the client.
+      upsert_operation_indices.append(len(operations))
+      operations.append(ReplaceOne({'id' : annotation['id']}, annotation, upsert=True))
+      result['status'] = 'upserted'
+    operation_result_indices.append(len(results) - 1)
+
+  upserted_ids = {}
+  write_failed = False
+  if len(operations) > 0:
+    try:
+      bulk_result = mongo.db.annotation.bulk_write(operations, ordered=True)
+      upserted_ids = bulk_result.upserted_ids
+      # Upserts that replaced an existing annotation are matched too.
+      num_expected_matches = len(replace_operations) + len(upsert_operation_indices) - len(upserted_ids)
+      if bulk_result.matched_count < num_expected_matches:
+        # Annotations were deleted since they were read, find the replaces that matched nothing.
+        replaced_ids = [_id for op_index, _id in replace_operations]
+        found_ids = set(anno['_id'] for anno in mongo.db.annotation.find({'_id' : {'$in' : replaced_ids}}, projection={'_id' : True}))
+        for op_index, _id in replace_operations:
+          if _id not in found_ids:
+            results[operation_result_indices[op_index]].update({'status' : 'not_found', 'message' : 'The annotation is no longer in the database.'})
+    except BulkWriteError as bwe:
+      # The bulk write is ordered, so everything after the first error was not executed.
+      write_failed = True
+      upserted_ids = {upsert['index'] : upsert['_id'] for upsert in bwe.details['upserted']}
+      error = bwe.details['writeErrors'][0]
+      results[operation_result_indices[error['index']]].update({'status' : 'error', 'message' : error['errmsg']})
+      for op_index in range(error['index'] + 1, len(operations)):
+        results[operation_result_indices[op_index]]['status'] = 'not_saved'
+
+  # Report the `_id` of each new annotation. Upserts that replaced an existing annotation don't
+  # return their `_id`, so look those up in one query.
+  missing = {}
+  for op_index in upsert_operation_indices:
+    result = results[operation_result_indices[op_index]]
+    if result['status'] != 'upserted':
+      continue
+    if op_index in upserted_ids:
+      result['_id'] = upserted_ids[op_index]
+    else:
+      missing[result['id']] = result
+  if len(missing) > 0:
+    for anno in mongo.db.annotation.find({'id' : {'$in' : list(missing.keys())}}, projection={'id' : True}):
+      missing[anno['id']]['_id'] = anno['_id']
+
+  status_code = 200
+  if write_failed:
+    status_code = 500
+  elif any(result['status'] == 'error' for result in results):
+    status_code = 400
+  elif any(result['status'] == 'not_found' for result in results):
+    status_code = 409
+
+  with metrics.timed('serialize'):
+    return _json_response({'results' : results}, status_code)
 
-  return ""
+#################################################
+
+################## Image Tiles ##################
+
+@app.context_processor
+def _image_tile_context():
+  return {'image_tiles_enabled' : get_config('IMAGE_TILE_DIR') is not None}
+
+def _send_tile_file(image_id, path):
+  """ Send a file from the tile directory of an image (see `tiles.py`). The files of an image don't
+  change once they are written, so browsers can cache them for IMAGE_TILE_MAX_AGE seconds.
+  """
+  cache_dir = get_config('IMAGE_TILE_DIR')
+  if cache_dir is None:
+    abort(404)
+  response = send_from_directory(tiles.image_tile_dir(cache_dir, image_id), path)
+  response.cache_control.no_cache = None
+  response.cache_control.public = True
+  response.cache_control.max_age = get_config('IMAGE_TILE_MAX_AGE')
+  return response
+
+def _add_tile_info(images):
+  """ Add the info of each image's tiles (None for an image without tiles) to the image dicts, so that
+  the client doesn't request `info.json` for every image. Nothing is added when tiles are not served.
+  """
+  cache_dir = get_config('IMAGE_TILE_DIR')
+  if cache_dir is None:
+    return images
+  for image in images:
+    image['tiles'] = tiles.read_tile_info(cache_dir, image['id'])
+  return images
+
+@app.route('/tiles/<image_id>/info.json')
+def image_tile_info(image_id):
+  """ The size and levels of the tiles of an image. Returns 404 if the image has no tiles, in which
+  case the client loads the image from its url.
+  """
+  return _send_tile_file(image_id, tiles.INFO_FILE)
+
+@app.route('/tiles/<image_id>/thumbnail.jpg')
+def image_tile_thumbnail(image_id):
+  return _send_tile_file(image_id, tiles.THUMBNAIL_FILE)
+
+@app.route('/tiles/<image_id>/<int:level>/<int:x>_<int:y>.jpg')
+def image_tile(image_id, level, x, y):
+  return _send_tile_file(image_id, tiles.tile_path(level, x, y))
 
 #################################################
 
@@ -154,39 +623,185 @@ def bbox_task(task_id):
 
   bbox_task = mongo.db.bbox_task.find_one_or_404({'id' : task_id})
   task_id = str(bbox_task['id'])
+
+  # Fetch all of the images at once, and then restore the order of the task.
+  image_ids = bbox_task['image_ids']
+  images = _add_tile_info(list(mongo.db.image.find({'id' : {'$in' : image_ids}}, projection={'_id' : False})))
+  image_id_to_image = {image['id'] : image for image in images}
+
   tasks = []
-  for image_id in bbox_task['image_ids']:
-    image = mongo.db.image.find_one_or_404({'id' : image_id}, projection={'_id' : False})
-    tasks.append({
-      'image' : image,
-      'annotations' : []
-    })
+  missing_image_ids = []
+  for image_id in image_ids:
+    if image_id in image_id_to_image:
+      tasks.append({
+        'image' : image_id_to_image[image_id],
+        'annotations' : []
+      })
+    else:
+      missing_image_ids.append(image_id)
 
+  if len(missing_image_ids) > 0:
+    app.logger.warning("bbox task %s references %d missing images: %s", task_id, len(missing_image_ids), ", ".join(missing_image_ids))
+    if len(tasks) == 0:
+      abort(404, description="None of the images for bbox task %s exist." % (task_id,))
+
+  # The category and instructions come from the caches. A miss falls back to the database, in case
+  # the document was inserted after the cache was last refreshed.
   category_id = bbox_task['category_id']
-  categories = [mongo.db.category.find_one_or_404({'id' : category_id}, projection={'_id' : False})]
-  #categories = json.loads(json_util.dumps(categories))
+  category = category_cache.get(mongo.db).id_to_category.get(category_id)
+  if category is None:
+    category = mongo.db.category.find_one_or_404({'id' : category_id}, projection={'_id' : False})
+  categories = [category]
 
   task_instructions_id = bbox_task['instructions_id']
-  task_instructions = mongo.db.bbox_task_instructions.find_one_or_404({'id' : task_instructions_id}, projection={'_id' : False})
+  task_instructions = bbox_task_instructions_cache.get(mongo.db).get(task_instructions_id)
+  if task_instructions is None:
+    task_instructions = mongo.db.bbox_task_instructions.find_one_or_404({'id' : task_instructions_id}, projection={'_id' : False})
+
+  # Tasks handed out by `/bbox_task/next` carry their lease, which the client sends back with the result.
+  lease = None
+  if request.args.get('lease_id'):
+    lease = {'lease_id' : request.args['lease_id'], 'worker_id' : request.args.get('worker_id')}
 
   return render_template('bbox_task.html',
     task_id=task_id,
     task_data=tasks,
     categories=categories,
     mturk=True,
-    task_instructions=task_instructions
+    task_instructions=task_instructions,
+    prefetch_count=get_config('IMAGE_PREFETCH_COUNT'),
+    lease=lease
   )
 
+def _lease_bbox_task(worker_id):
+  """ Lease the next open bbox task to `worker_id`, optionally restricted to the `category_id` argument.
+  """
+  query = None
+  if request.args.get('category_id'):
+    query = {'category_id' : request.args['category_id']}
+  return task_dispatch.lease_task(mongo.db, worker_id, get_config('BBOX_TASK_LEASE_DURATION'), query)
+
+@app.route('/bbox_task/next')
+def bbox_task_next():
+  """ Lease the next open bbox task to the worker (`worker_id`, or MTurk's `workerId`) and redirect to it.
+  Hand this url to every worker instead of the urls of specific tasks. The other arguments (e.g. the
+  MTurk assignment) are passed on to the task.
+  """
+  worker_id = request.args.get('worker_id') or request.args.get('workerId')
+  if not worker_id:
+    abort(400, description="A `worker_id` is required to lease a task.")
+  lease = _lease_bbox_task(worker_id)
+  if lease is None:
+    abort(404, description="There are no open bbox tasks.")
+
+  args = request.args.to_dict()
+  args.update({'lease_id' : lease['lease_id'], 'worker_id' : worker_id})
+  return redirect(url_for('bbox_task', task_id=lease['task_id'], **args))
+
+@app.route('/bbox_task/lease', methods=['POST'])
+def bbox_task_lease():
+  """ Lease the next open bbox task to the worker in the json body ({'worker_id' : str}). Returns
+  {'task_id' : str, 'lease_id' : str, 'worker_id' : str, 'expires' : float, 'url' : str}, or 404 if
+  there are no open tasks.
+  """
+  body = serialization.loads(request.get_data() or b'{}')
+  worker_id = body.get('worker_id') if isinstance(body, dict) else None
+  if not worker_id:
+    return _json_response({'error' : "A `worker_id` is required to lease a task."}, 400)
+  lease = _lease_bbox_task(worker_id)
+  if lease is None:
+    return _json_response({'error' : "There are no open bbox tasks."}, 404)
+  lease['url'] = url_for('bbox_task', task_id=lease['task_id'], lease_id=lease['lease_id'], worker_id=worker_id)
+  return _json_response(lease)
+
+bbox_consensus_updater = consensus.ConsensusUpdater(
+  get_db=lambda: mongo.db,
+  iou_threshold=get_config('BBOX_CONSENSUS_IOU_THRESHOLD'),
+  min_support=get_config('BBOX_CONSENSUS_MIN_SUPPORT')
+)
+atexit.register(bbox_consensus_updater.close)
+
+def update_bbox_consensus(task_results):
+  """ Queue newly written task results to merge the boxes of their images (see `consensus.update_consensus`)
+  on a background thread.
+  """
+  if not get_config('BBOX_CONSENSUS_ENABLED'):
+    return
+  bbox_consensus_updater.submit(task_results)
+
+def on_bbox_task_results_written(task_results):
+  """ Complete the leases of newly written task results and update the consensus of their images.
+  The results are already saved, so failures are logged rather than raised.
+  """
+  try:
+    task_dispatch.complete_tasks(mongo.db, task_results)
+  except Exception:
+    app.logger.exception("Failed to complete the leases of %d task results", len(task_results))
+  update_bbox_consensus(task_results)
+
+bbox_task_result_writer = BatchWriter(
+  get_collection=lambda: mongo.db.bbox_task_result,
+  spill_dir=get_config('BBOX_TASK_RESULT_SPILL_DIR'),
+  max_queue_size=get_config('BBOX_TASK_RESULT_QUEUE_SIZE'),
+  batch_size=get_config('BBOX_TASK_RESULT_BATCH_SIZE'),
+  flush_interval=get_config('BBOX_TASK_RESULT_FLUSH_INTERVAL'),
+  on_written=on_bbox_task_results_written
+)
+atexit.register(bbox_task_result_writer.close)
+
+def warm_up():
+  """ Connect to the database and load the caches, so that the first requests served by a new
+  worker process don't pay for them.
+  """
+  mongo.cx.admin.command('ping')
+  category_cache.get(mongo.db)
+  bbox_task_instructions_cache.get(mongo.db)
+
+def shut_down():
+  """ Write the queued task results, merge their consensus and close the database connections of this process.
+  """
+  bbox_task_result_writer.close()
+  bbox_consensus_updater.close()
+  mongo.cx.close()
+
+def _validate_task_result(task_result):
+  """ Return an error message if the task result is malformed, otherwise None.
+  """
+  if not isinstance(task_result, dict):
+    return "The task result must be an object."
+  if 'task_id' not in task_result:
+    return "The task result is missing `task_id`."
+  if not isinstance(task_result.get('lease_id', ''), str):
+    return "The `lease_id` must be a string."
+  if not isinstance(task_result.get('results'), list):
+    return "The task result is missing the `results` list."
+  for image_result in task_result['results']:
+    if not isinstance(image_result, dict) or 'image' not in image_result or not isinstance(image_result.get('annotations'), list):
+      return "Each result must have an `image` and a list of `annotations`."
+  return None
+
 @app.route('/bbox_task/save', methods=['POST'])
 def bbox_task_save():
-  """ Save the results of a bounding box task.
+  """ Save the results of a bounding box task. Once the result is written, the lease named by its
+  `lease_id` (if any) is completed.
   """
 
-  task_result = json_util.loads(json.dumps(request.json))
+  with metrics.timed('serialize'):
+    task_result = serialization.loads(request.get_data())
+
+  error = _validate_task_result(task_result)
+  if error is not None:
+    return _json_response({'error' : error}, 400)
 
   task_result['date'] = str(datetime.datetime.now())
 
+  if get_config('BBOX_TASK_RESULT_ASYNC'):
+    # The result is queued (or spilled to disk) and will be written in a batch.
+    bbox_task_result_writer.submit(task_result)
+    return "", 202
+
   insert_res = mongo.db.bbox_task_result.insert_one(task_result, bypass_document_validation=True)
+  on_bbox_task_results_written([task_result])
 
   return ""
 
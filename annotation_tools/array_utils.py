@@ -0,0 +1,18 @@
+"""
+Numpy helpers shared by the vectorized kernels (e.g. the columnar format and the segmentations).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+def concat_ranges(starts, lengths):
+  """ Concatenate the ranges [start, start + length) into one index array.
+  """
+  if len(lengths) == 0:
+    return np.zeros(0, dtype=np.int64)
+  ends = np.cumsum(lengths)
+  # For each position, the start of its range minus the number of positions before that range.
+  return np.repeat(starts - (ends - lengths), lengths) + np.arange(ends[-1], dtype=np.int64)
@@ -0,0 +1,129 @@
+"""
+Utilities for inserting large numbers of documents.
+
+Documents are inserted in chunks on a pool of threads. Each thread checks out its own connection
+from the MongoClient pool, so several chunks are in flight at once, while the calling thread is
+free to parse and prepare the next chunk.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY_ERROR_CODE = 11000
+DEFAULT_NUM_WORKERS = 4
+
+ChunkResult = collections.namedtuple('ChunkResult', ['chunk_index', 'num_documents', 'num_inserted', 'num_duplicates'])
+
+def insert_documents(collection, documents):
+  """ Insert documents, ignoring documents that already exist.
+  Returns:
+    (number of inserted documents, number of duplicate documents)
+  """
+  try:
+    response = collection.insert_many(documents, ordered=False)
+    return len(response.inserted_ids), 0
+  except BulkWriteError as bwe:
+    panic = [x for x in bwe.details['writeErrors'] if x['code'] != DUPLICATE_KEY_ERROR_CODE]
+    if len(panic) > 0:
+      raise
+    num_inserted = bwe.details['nInserted']
+    return num_inserted, len(documents) - num_inserted
+
+class BulkInserter(object):
+  """ Insert chunks of documents into a collection concurrently.
+
+  At most `max_pending` chunks are queued or in flight at once; `submit` blocks on the oldest
+  chunk when this limit is reached, which bounds the memory held by the pipeline.
+
+  Usage:
+    with BulkInserter(db.image, num_workers=4) as inserter:
+      for chunk in chunks:
+        inserter.submit(chunk)
+    print(inserter.num_inserted)
+  """
+
+  def __init__(self, collection, num_workers=DEFAULT_NUM_WORKERS, max_pending=None, on_result=None, write_chunk=insert_documents):
+    """
+    Args:
+      collection: The pymongo collection to insert into.
+      num_workers: The number of concurrent inserts.
+      max_pending: The maximum number of chunks queued or in flight. Defaults to 2 * num_workers.
+      on_result: An optional function called with the ChunkResult of each chunk, in submission order.
+      write_chunk: The function that writes a chunk, called with (collection, documents) and returning
+        (number of written documents, number of skipped documents). Defaults to `insert_documents`.
+    """
+    self.collection = collection
+    self.write_chunk = write_chunk
+    self.num_workers = max(1, num_workers)
+    self.max_pending = max_pending if max_pending is not None else 2 * self.num_workers
+    self.on_result = on_result
+    self.results = []
+    self._executor = ThreadPoolExecutor(max_workers=self.num_workers)
+    self._pending = collections.deque()
+    self._num_chunks = 0
+
+  def _insert_chunk(self, chunk_index, documents):
+    num_inserted, num_duplicates = self.write_chunk(self.collection, documents)
+    return ChunkResult(chunk_index, len(documents), num_inserted, num_duplicates)
+
+  def _collect_oldest(self):
+    result = self._pending.popleft().result()
+    self.results.append(result)
+    if self.on_result is not None:
+      self.on_result(result)
+    return result
+
+  def submit(self, documents):
+    """ Queue a chunk of documents for insertion.
+    """
+    if len(documents) == 0:
+      return
+    while len(self._pending) >= self.max_pending:
+      self._collect_oldest()
+    self._pending.append(self._executor.submit(self._insert_chunk, self._num_chunks, documents))
+    self._num_chunks += 1
+
+  def close(self):
+    """ Wait for all of the chunks to be inserted.
+    """
+    try:
+      while len(self._pending) > 0:
+        self._collect_oldest()
+    except:
+      self.abort()
+      raise
+    self._executor.shutdown(wait=True)
+    return self.results
+
+  def abort(self):
+    """ Cancel the chunks that have not been sent yet and wait for the in flight chunks.
+    """
+    for future in self._pending:
+      future.cancel()
+    self._pending.clear()
+    self._executor.shutdown(wait=True)
+
+  @property
+  def num_inserted(self):
+    return sum(result.num_inserted for result in self.results)
+
+  @property
+  def num_duplicates(self):
+    return sum(result.num_duplicates for result in self.results)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      # Don't mask the original exception with errors from the remaining chunks.
+      self.abort()
+    return False
@@ -0,0 +1,96 @@
+"""
+In-memory caches of rarely changing collections (e.g. the categories), shared by the threads of a web
+server process and invalidated across processes through the `cache_version` collection.
+
+The command line tools that change a cached collection call the matching `invalidate_*` function,
+which doesn't need the web app.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+CATEGORY_VERSION_ID = 'category'
+BBOX_TASK_INSTRUCTIONS_VERSION_ID = 'bbox_task_instructions'
+
+# The caches of this process, by version id.
+_caches = {}
+
+class VersionedCache(object):
+  """ Hold a value derived from a rarely changing collection in memory.
+
+  The value is only reloaded when the version stored for it in the `cache_version` collection
+  changes (see `invalidate_cache`). The version is checked at most once every `check_interval`
+  seconds, which bounds how long other processes serve a stale value after the collection changes.
+  The version is checked and the value loaded without holding the lock: while one thread does that,
+  the other threads keep getting the current value.
+  """
+
+  def __init__(self, version_id, load, check_interval):
+    """
+    Args:
+      version_id: The id of the version document for this cache.
+      load: A function taking a database handle and returning the value to cache.
+      check_interval: The number of seconds between version checks.
+    """
+    self.version_id = version_id
+    self.load = load
+    self.check_interval = check_interval
+    self._lock = threading.Lock()
+    self._version = None
+    self._value = None
+    self._next_check = 0
+    self._checking = False
+    # Incremented by `invalidate`, so that a value loaded before the invalidation is not kept.
+    self._generation = 0
+    _caches.setdefault(version_id, []).append(self)
+
+  def invalidate(self):
+    with self._lock:
+      self._version = None
+      self._value = None
+      self._generation += 1
+
+  def get(self, db):
+    """ Return the cached value, reloading it if it is stale.
+    """
+    with self._lock:
+      now = time.time()
+      if self._version is not None and (now < self._next_check or self._checking):
+        return self._value
+      self._checking = True
+      version, value, generation = self._version, self._value, self._generation
+
+    try:
+      version_doc = db.cache_version.find_one({'_id' : self.version_id})
+      latest_version = version_doc['version'] if version_doc is not None else 0
+      if latest_version != version:
+        value = self.load(db)
+    except Exception:
+      with self._lock:
+        self._checking = False
+      raise
+
+    with self._lock:
+      self._checking = False
+      if self._generation == generation:
+        self._version = latest_version
+        self._value = value
+        self._next_check = now + self.check_interval
+      return value
+
+def invalidate_cache(db, version_id):
+  """ Signal to all web server processes that the cached collection has changed.
+  """
+  db.cache_version.update_one({'_id' : version_id}, {'$inc' : {'version' : 1}}, upsert=True)
+  for cache in _caches.get(version_id, []):
+    cache.invalidate()
+
+def invalidate_category_cache(db):
+  invalidate_cache(db, CATEGORY_VERSION_ID)
+
+def invalidate_bbox_task_instructions_cache(db):
+  invalidate_cache(db, BBOX_TASK_INSTRUCTIONS_VERSION_ID)
@@ -0,0 +1,410 @@
+"""
+A columnar, memory mappable dataset format for training jobs.
+
+A dataset is stored as a directory of `.npy` arrays and a `meta.json` file. Opening a dataset
+memory maps the arrays, so nothing is parsed and only the pages that are used are read.
+
+Layout (N images, M annotations, P keypoints in total):
+
+meta.json                     version, counts, whether the coordinates are normalized, the categories and licenses
+image_id.data / .offsets      string column: the id of image i is data[offsets[i]:offsets[i+1]] (utf-8)
+image_file_name.*, image_url.*, image_license.*   string columns
+image_width, image_height     (N,) int32
+image_annotation_offsets      (N+1,) int64, the annotations of image i are [offsets[i], offsets[i+1])
+annotation_id.*               string column
+annotation_image_index        (M,) int32, index into the images
+annotation_category_index     (M,) int32, index into meta['categories']
+annotation_bbox               (M, 4) float64, [x, y, width, height]
+annotation_area               (M,) float64 (nan when missing)
+annotation_iscrowd            (M,) uint8
+annotation_keypoint_offsets   (M+1,) int64, the keypoints of annotation j are rows [offsets[j], offsets[j+1])
+keypoints                     (P, 3) float64, [x, y, v]
+annotation_segmentation.*     string column holding the json encoded segmentation ('' when missing)
+category_annotation_order     (M,) int64, annotation indices sorted by category
+category_annotation_offsets   (C+1,) int64, the annotations of category c are order[offsets[c]:offsets[c+1]]
+
+Annotations are stored grouped by image, so the arrays of an image are contiguous slices.
+
+Convert a COCO style json file:
+$ python -m annotation_tools.columnar \
+--dataset ~/Downloads/annotations/person_keypoints_val2017.json \
+--output ~/Downloads/annotations/person_keypoints_val2017_columnar
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import array
+import json
+import os
+
+import numpy as np
+
+from annotation_tools import serialization
+from annotation_tools.array_utils import concat_ranges
+from annotation_tools.stream_utils import iter_json_arrays
+
+FORMAT_VERSION = 1
+META_FILE = 'meta.json'
+
+class _StringColumnBuilder(object):
+
+  def __init__(self):
+    self.data = bytearray()
+    self.offsets = array.array('q', [0])
+
+  def append(self, value):
+    self.data.extend(value.encode('utf-8'))
+    self.offsets.append(len(self.data))
+
+  def arrays(self):
+    return np.frombuffer(bytes(self.data), dtype=np.uint8), np.frombuffer(self.offsets, dtype=np.int64)
+
+def _take_strings(data, offsets, order):
+  """ Reorder a string column.
+  """
+  lengths = np.diff(offsets)[order]
+  new_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+  np.cumsum(lengths, out=new_offsets[1:])
+  return data[concat_ranges(offsets[:-1][order], lengths)], new_offsets
+
+class ColumnarWriter(object):
+  """ Collect images and annotations (in any order) and write them in the columnar format.
+
+  The numeric fields are kept in compact arrays while they are collected, which takes a small
+  fraction of the memory of the equivalent python dicts.
+  """
+
+  def __init__(self, categories, licenses=None, normalized=False):
+    """
+    Args:
+      categories: The category dicts.
+      licenses: The license dicts.
+      normalized: Are the coordinates of the annotations that will be added normalized?
+    """
+    self.categories = [{key : value for key, value in cat.items() if key != '_id'} for cat in categories]
+    self.licenses = [{key : value for key, value in lic.items() if key != '_id'} for lic in (licenses or [])]
+    self.normalized = normalized
+    self._category_id_to_index = {str(cat['id']) : i for i, cat in enumerate(self.categories)}
+
+    self._image_ids = _StringColumnBuilder()
+    self._image_file_names = _StringColumnBuilder()
+    self._image_urls = _StringColumnBuilder()
+    self._image_licenses = _StringColumnBuilder()
+    self._image_widths = array.array('i')
+    self._image_heights = array.array('i')
+    self._image_id_to_index = {}
+
+    self._anno_ids = _StringColumnBuilder()
+    self._anno_image_ids = []
+    self._anno_category_index = array.array('i')
+    self._anno_bbox = array.array('d')
+    self._anno_area = array.array('d')
+    self._anno_iscrowd = array.array('B')
+    self._anno_num_keypoints = array.array('q')
+    self._keypoints = array.array('d')
+    self._anno_segmentation = _StringColumnBuilder()
+    self._num_unknown_category = 0
+
+  def add_image(self, image):
+    image_id = str(image['id'])
+    self._image_id_to_index[image_id] = len(self._image_widths)
+    self._image_ids.append(image_id)
+    self._image_file_names.append(image.get('file_name', ''))
+    self._image_urls.append(image.get('url', image.get('coco_url', '')))
+    self._image_licenses.append(str(image.get('license', '')))
+    self._image_widths.append(int(image['width']))
+    self._image_heights.append(int(image['height']))
+
+  def add_annotation(self, anno):
+    category_index = self._category_id_to_index.get(str(anno.get('category_id')))
+    if category_index is None:
+      # Skip the annotations of unknown categories, there is no index to store for them.
+      self._num_unknown_category += 1
+      return
+    self._anno_ids.append(str(anno['id']))
+    self._anno_image_ids.append(str(anno['image_id']))
+    self._anno_category_index.append(category_index)
+    self._anno_bbox.extend(anno['bbox'])
+    self._anno_area.append(anno.get('area', float('nan')))
+    self._anno_iscrowd.append(int(anno.get('iscrowd', 0)))
+    keypoints = anno.get('keypoints', [])
+    self._anno_num_keypoints.append(len(keypoints) // 3)
+    self._keypoints.extend(keypoints[:len(keypoints) - len(keypoints) % 3])
+    self._anno_segmentation.append(serialization.dumps(anno['segmentation']) if 'segmentation' in anno else '')
+
+  def write(self, output_dir, normalize=False, denormalize=False):
+    """ Write the dataset to `output_dir`.
+    Args:
+      normalize: Divide the coordinates by the image dimensions.
+      denormalize: Multiply the coordinates by the image dimensions.
+    Returns:
+      The metadata dict.
+    """
+    if not os.path.exists(output_dir):
+      os.makedirs(output_dir)
+
+    def save(name, values):
+      np.save(os.path.join(output_dir, name + '.npy'), values)
+
+    def save_strings(name, data, offsets):
+      save(name + '.data', data)
+      save(name + '.offsets', offsets)
+
+    num_images = len(self._image_widths)
+    widths = np.frombuffer(self._image_widths, dtype=np.int32)
+    heights = np.frombuffer(self._image_heights, dtype=np.int32)
+    save('image_width', widths)
+    save('image_height', heights)
+    save_strings('image_id', *self._image_ids.arrays())
+    save_strings('image_file_name', *self._image_file_names.arrays())
+    save_strings('image_url', *self._image_urls.arrays())
+    save_strings('image_license', *self._image_licenses.arrays())
+
+    # Drop the annotations of unknown images, and group the rest by image.
+    image_index = np.array([self._image_id_to_index.get(image_id, -1) for image_id in self._anno_image_ids], dtype=np.int64)
+    known = np.flatnonzero(image_index >= 0)
+    num_dropped = len(image_index) - len(known)
+    order = known[np.argsort(image_index[known], kind='stable')]
+    image_index = image_index[order]
+    num_annotations = len(order)
+
+    image_annotation_offsets = np.zeros(num_images + 1, dtype=np.int64)
+    np.cumsum(np.bincount(image_index, minlength=num_images), out=image_annotation_offsets[1:])
+    save('image_annotation_offsets', image_annotation_offsets)
+    save('annotation_image_index', image_index.astype(np.int32))
+
+    category_index = np.frombuffer(self._anno_category_index, dtype=np.int32)[order]
+    save('annotation_category_index', category_index)
+    bbox = np.frombuffer(self._anno_bbox, dtype=np.float64).reshape(-1, 4)[order]
+    save('annotation_area', np.frombuffer(self._anno_area, dtype=np.float64)[order])
+    save('annotation_iscrowd', np.frombuffer(self._anno_iscrowd, dtype=np.uint8)[order])
+    for name, column in [('annotation_id', self._anno_ids), ('annotation_segmentation', self._anno_segmentation)]:
+      data, offsets = column.arrays()
+      save_strings(name, *_take_strings(data, offsets, order))
+
+    num_keypoints = np.frombuffer(self._anno_num_keypoints, dtype=np.int64)
+    keypoint_offsets = np.zeros(len(num_keypoints) + 1, dtype=np.int64)
+    np.cumsum(num_keypoints, out=keypoint_offsets[1:])
+    keypoint_rows = concat_ranges(keypoint_offsets[:-1][order], num_keypoints[order])
+    keypoints = np.frombuffer(self._keypoints, dtype=np.float64).reshape(-1, 3)[keypoint_rows]
+    new_keypoint_offsets = np.zeros(num_annotations + 1, dtype=np.int64)
+    np.cumsum(num_keypoints[order], out=new_keypoint_offsets[1:])
+    save('annotation_keypoint_offsets', new_keypoint_offsets)
+
+    normalized = self.normalized
+    if normalize or denormalize:
+      w = widths[image_index].astype(np.float64)
+      h = heights[image_index].astype(np.float64)
+      scale = np.stack([w, h, w, h], axis=1)
+      point_w = np.repeat(w, num_keypoints[order])
+      point_h = np.repeat(h, num_keypoints[order])
+      if normalize:
+        bbox /= scale
+        keypoints[:, 0] /= point_w
+        keypoints[:, 1] /= point_h
+        normalized = True
+      else:
+        bbox *= scale
+        keypoints[:, 0] *= point_w
+        keypoints[:, 1] *= point_h
+        normalized = False
+    save('annotation_bbox', bbox)
+    save('keypoints', keypoints)
+
+    category_order = np.argsort(category_index, kind='stable').astype(np.int64)
+    category_offsets = np.zeros(len(self.categories) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(category_index, minlength=len(self.categories)), out=category_offsets[1:])
+    save('category_annotation_order', category_order)
+    save('category_annotation_offsets', category_offsets)
+
+    meta = {
+      'version' : FORMAT_VERSION,
+      'num_images' : num_images,
+      'num_annotations' : num_annotations,
+      'num_keypoints' : int(len(keypoints)),
+      'normalized' : normalized,
+      'categories' : self.categories,
+      'licenses' : self.licenses
+    }
+    with open(os.path.join(output_dir, META_FILE), 'w') as f:
+      json.dump(meta, f)
+
+    if num_dropped > 0:
+      print("\tWARNING: Dropped %d annotations of unknown images" % (num_dropped,))
+    if self._num_unknown_category > 0:
+      print("\tWARNING: Dropped %d annotations of unknown categories" % (self._num_unknown_category,))
+
+    return meta
+
+class StringColumn(object):
+  """ A read only sequence of strings backed by a byte array and an offsets array.
+  """
+
+  def __init__(self, data, offsets):
+    self.data = data
+    self.offsets = offsets
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+class ColumnarDataset(object):
+  """ Read a dataset written by `ColumnarWriter`. The arrays are memory mapped, and the per image
+  and per category accessors return views into them.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    with open(os.path.join(path, META_FILE)) as f:
+      self.meta = json.load(f)
+    if self.meta['version'] != FORMAT_VERSION:
+      raise ValueError("Unsupported columnar format version %s" % (self.meta['version'],))
+    self.categories = self.meta['categories']
+    self.licenses = self.meta['licenses']
+    self.normalized = self.meta['normalized']
+
+    self.image_width = self._load('image_width')
+    self.image_height = self._load('image_height')
+    self.image_annotation_offsets = self._load('image_annotation_offsets')
+    self.image_ids = self._load_strings('image_id')
+    self.image_file_names = self._load_strings('image_file_name')
+    self.image_urls = self._load_strings('image_url')
+    self.image_licenses = self._load_strings('image_license')
+
+    self.annotation_ids = self._load_strings('annotation_id')
+    self.annotation_image_index = self._load('annotation_image_index')
+    self.annotation_category_index = self._load('annotation_category_index')
+    self.annotation_bbox = self._load('annotation_bbox')
+    self.annotation_area = self._load('annotation_area')
+    self.annotation_iscrowd = self._load('annotation_iscrowd')
+    self.annotation_keypoint_offsets = self._load('annotation_keypoint_offsets')
+    self.keypoints = self._load('keypoints')
+    self.annotation_segmentations = self._load_strings('annotation_segmentation')
+
+    self.category_annotation_order = self._load('category_annotation_order')
+    self.category_annotation_offsets = self._load('category_annotation_offsets')
+
+    self._image_id_to_index = None
+    self._category_id_to_index = {str(cat['id']) : i for i, cat in enumerate(self.categories)}
+
+  def _load(self, name):
+    return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+  def _load_strings(self, name):
+    return StringColumn(self._load(name + '.data'), self._load(name + '.offsets'))
+
+  @property
+  def num_images(self):
+    return len(self.image_width)
+
+  @property
+  def num_annotations(self):
+    return len(self.annotation_image_index)
+
+  def image_index(self, image_id):
+    """ Return the index of an image id. The lookup table is built on first use.
+    """
+    if self._image_id_to_index is None:
+      self._image_id_to_index = {image_id : i for i, image_id in enumerate(self.image_ids)}
+    return self._image_id_to_index[image_id]
+
+  def category_index(self, category_id):
+    return self._category_id_to_index[str(category_id)]
+
+  def image_annotation_range(self, image_index):
+    """ Return the (start, end) annotation indices of an image.
+    """
+    return int(self.image_annotation_offsets[image_index]), int(self.image_annotation_offsets[image_index + 1])
+
+  def image_annotations(self, image_index):
+    """ Return views of the annotation columns of an image.
+    Returns:
+      {'bbox' : (n, 4), 'area' : (n,), 'iscrowd' : (n,), 'category_index' : (n,), 'keypoints' : (k, 3),
+       'keypoint_offsets' : (n + 1,) offsets into `keypoints`, starting at 0}
+    """
+    start, end = self.image_annotation_range(image_index)
+    kp_start, kp_end = int(self.annotation_keypoint_offsets[start]), int(self.annotation_keypoint_offsets[end])
+    return {
+      'bbox' : self.annotation_bbox[start:end],
+      'area' : self.annotation_area[start:end],
+      'iscrowd' : self.annotation_iscrowd[start:end],
+      'category_index' : self.annotation_category_index[start:end],
+      'keypoints' : self.keypoints[kp_start:kp_end],
+      'keypoint_offsets' : self.annotation_keypoint_offsets[start:end + 1] - kp_start
+    }
+
+  def annotation_keypoints(self, annotation_index):
+    """ Return a (k, 3) view of the keypoints of an annotation.
+    """
+    return self.keypoints[self.annotation_keypoint_offsets[annotation_index]:self.annotation_keypoint_offsets[annotation_index + 1]]
+
+  def category_annotation_indices(self, category_index):
+    """ Return a view of the indices of the annotations of a category, in image order.
+    """
+    return self.category_annotation_order[self.category_annotation_offsets[category_index]:self.category_annotation_offsets[category_index + 1]]
+
+  def category_bboxes(self, category_index):
+    """ Return the (n, 4) bboxes of a category. Unlike the per image columns, this is a copy.
+    """
+    return self.annotation_bbox[self.category_annotation_indices(category_index)]
+
+def convert_coco_json(dataset_path, output_dir, normalize=False):
+  """ Convert a COCO style json file to the columnar format, parsing it incrementally.
+  Args:
+    dataset_path: Path to a COCO style dataset file (in image coordinates).
+    output_dir: The directory to write the columnar dataset to.
+    normalize: Store normalized coordinates.
+  Returns:
+    The metadata dict.
+  """
+  # The categories and licenses are needed before the annotations, which can come first in the file.
+  categories = []
+  licenses = []
+  with open(dataset_path) as f:
+    for key, doc in iter_json_arrays(f, keys=['categories', 'licenses']):
+      (categories if key == 'categories' else licenses).append(doc)
+
+  writer = ColumnarWriter(categories, licenses, normalized=False)
+  with open(dataset_path) as f:
+    for key, doc in iter_json_arrays(f, keys=['images', 'annotations']):
+      if key == 'images':
+        writer.add_image(doc)
+      else:
+        writer.add_annotation(doc)
+  return writer.write(output_dir, normalize=normalize)
+
+def parse_args():
+
+  parser = argparse.ArgumentParser(description='Convert a COCO style json dataset to the columnar format.')
+
+  parser.add_argument('-d', '--dataset', dest='dataset_path',
+                        help='Path to a json dataset file.', type=str,
+                        required=True)
+
+  parser.add_argument('-o', '--output', dest='output_dir',
+                        help='Directory to write the columnar dataset to.', type=str,
+                        required=True)
+
+  parser.add_argument('-n', '--normalize', dest='normalize',
+                        help='Normalize the coordinates by the image dimensions.',
+                        required=False, action='store_true', default=False)
+
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+  meta = convert_coco_json(args.dataset_path, args.output_dir, normalize=args.normalize)
+  print("Wrote %d images, %d annotations and %d keypoints to %s" % (
+    meta['num_images'], meta['num_annotations'], meta['num_keypoints'], args.output_dir))
+
+if __name__ == '__main__':
+  main()
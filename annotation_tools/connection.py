@@ -0,0 +1,112 @@
+"""
+Database connections for the command line tools and worker processes, without importing the web app.
+
+The configuration is `default_config`, overridden by the python file pointed to by the `VAT_CONFIG`
+environment variable (the same settings the web server uses). The web server builds its client
+with the same URI and pool options.
+
+Each process gets its own MongoClient: a client is not safe to use across a fork, so a process that
+finds a client created by its parent opens a new one. Worker pools can call `get_db()` in each task.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import threading
+
+from pymongo import MongoClient
+
+from annotation_tools import default_config
+
+_config = None
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+def load_config():
+  """ Read the configuration: the upper case names of `default_config`, overridden by the upper case
+  names of the `VAT_CONFIG` file (as Flask's `config.from_envvar` reads it).
+  """
+  config = {key : getattr(default_config, key) for key in dir(default_config) if key.isupper()}
+  config_path = os.environ.get('VAT_CONFIG')
+  if config_path:
+    namespace = {'__file__' : config_path}
+    with open(config_path, 'rb') as f:
+      exec(compile(f.read(), config_path, 'exec'), namespace)
+    config.update({key : value for key, value in namespace.items() if key.isupper()})
+  return config
+
+def get_settings():
+  """ Return the configuration dict of this process (see `load_config`).
+  """
+  global _config
+  if _config is None:
+    _config = load_config()
+  return _config
+
+def get_config(key):
+  """ Return a configuration value. The configuration is read once per process.
+  """
+  return get_settings()[key]
+
+def mongo_uri():
+  """ The `MONGO_URI` setting, or the URI of MONGO_HOST, MONGO_PORT and MONGO_DBNAME.
+  """
+  config = get_settings()
+  if config.get('MONGO_URI'):
+    return config['MONGO_URI']
+  return 'mongodb://' + config['MONGO_HOST'] + ':' + str(config['MONGO_PORT']) + '/' + config['MONGO_DBNAME']
+
+def client_options(event_listeners=None):
+  """ The MongoClient connection pool options, from the configuration.
+  """
+  return {
+    'maxPoolSize' : get_config('MONGO_MAX_POOL_SIZE'),
+    'minPoolSize' : get_config('MONGO_MIN_POOL_SIZE'),
+    'connectTimeoutMS' : get_config('MONGO_CONNECT_TIMEOUT_MS'),
+    'socketTimeoutMS' : get_config('MONGO_SOCKET_TIMEOUT_MS'),
+    'serverSelectionTimeoutMS' : get_config('MONGO_SERVER_SELECTION_TIMEOUT_MS'),
+    'waitQueueTimeoutMS' : get_config('MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+    'readPreference' : get_config('MONGO_READ_PREFERENCE'),
+    'event_listeners' : event_listeners or [],
+    # Don't connect until the client is first used, so that a process can create the client and then fork workers.
+    'connect' : False
+  }
+
+def get_client():
+  """ Return the MongoClient of this process, creating it on first use (or after a fork).
+  """
+  global _client, _client_pid
+  with _lock:
+    if _client is None or _client_pid != os.getpid():
+      # A client inherited from the parent process is dropped, not closed: its sockets belong to the parent.
+      _client = MongoClient(mongo_uri(), **client_options())
+      _client_pid = os.getpid()
+    return _client
+
+def get_db():
+  """ Return a handle to the configured database.
+  """
+  return get_client().get_default_database(default=get_config('MONGO_DBNAME'))
+
+def close():
+  """ Close the client of this process.
+  """
+  global _client, _client_pid
+  with _lock:
+    if _client is not None and _client_pid == os.getpid():
+      _client.close()
+    _client = None
+    _client_pid = None
+
+def _reset_after_fork():
+  global _lock, _client, _client_pid
+  # The lock may have been held by another thread of the parent when it forked.
+  _lock = threading.Lock()
+  _client = None
+  _client_pid = None
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,501 @@
+"""
+Merge the boxes that several workers drew for the same image and category into consensus boxes.
+
+The consensus of each (image, category) pair is materialized in the `bbox_consensus` collection:
+{
+  image_id : str
+  category_id : str
+  num_workers : int             # The number of distinct workers with a task result for this image and category.
+  boxes : [{
+    bbox : [x, y, w, h]         # Normalized, the median of the clustered worker boxes.
+    num_workers : int           # The number of workers that drew this box.
+    support : float             # num_workers / the number of workers that saw the image.
+    iou : float                 # The mean IoU of the worker boxes with the consensus box.
+  }]
+  agreement : float             # The fraction of the worker boxes that are part of a consensus box.
+  updated : datetime
+}
+
+The web server updates the consensus of the images in each task result after the result is written,
+so only the changed images are merged. The merges run on a background thread (see `ConsensusUpdater`),
+so saving a result doesn't wait for them. A worker that submits an image again replaces their earlier
+boxes. A consensus document only replaces one computed from as many or fewer workers, so concurrent
+updates of the same image can't store the consensus of fewer workers. The indices that the updates use
+are created with the bbox task indices, when the tasks are loaded (see `db_bbox_utils`).
+
+Rebuild the whole collection (e.g. after loading results into the database directly, or to change the
+clustering parameters) with:
+$ python -m annotation_tools.consensus rebuild --iou_threshold 0.5 --min_support 0.5
+
+Find the images that the workers disagree on:
+$ python -m annotation_tools.consensus query --max_agreement 0.5
+
+Export the consensus boxes as annotations:
+$ python -m annotation_tools.consensus export --denormalize --output consensus.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import datetime
+import io
+import logging
+import math
+import os
+import sys
+import threading
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+import numpy as np
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from annotation_tools import serialization
+from annotation_tools.bulk_insert import DUPLICATE_KEY_ERROR_CODE
+from annotation_tools.connection import get_db
+from annotation_tools.coord_utils import scale_annotations
+from annotation_tools.stream_utils import iter_batches, write_json_array
+
+DEFAULT_IOU_THRESHOLD = 0.5
+DEFAULT_MIN_SUPPORT = 0.5
+DEFAULT_BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+def ensure_consensus_indices(db):
+  db.bbox_consensus.create_index([("image_id", 1), ("category_id", 1)], unique=True)
+  db.bbox_consensus.create_index([("category_id", 1), ("agreement", 1)])
+  db.bbox_consensus.create_index("updated")
+  # Find the results that contain an image.
+  db.bbox_task_result.create_index("results.image.id")
+
+def drop_consensus(db):
+  db.drop_collection('bbox_consensus')
+
+def box_iou_matrix(boxes1, boxes2):
+  """ The IoU of each pair of boxes.
+  Args:
+    boxes1: An (N, 4) array of [x, y, w, h] boxes.
+    boxes2: An (M, 4) array of [x, y, w, h] boxes.
+  Returns:
+    An (N, M) array.
+  """
+  boxes1 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 4)
+  boxes2 = np.asarray(boxes2, dtype=np.float64).reshape(-1, 4)
+  x1 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+  y1 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+  x2 = np.minimum(boxes1[:, None, 0] + boxes1[:, None, 2], boxes2[None, :, 0] + boxes2[None, :, 2])
+  y2 = np.minimum(boxes1[:, None, 1] + boxes1[:, None, 3], boxes2[None, :, 1] + boxes2[None, :, 3])
+  intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+  area1 = boxes1[:, 2] * boxes1[:, 3]
+  area2 = boxes2[:, 2] * boxes2[:, 3]
+  union = area1[:, None] + area2[None, :] - intersection
+  return np.where(union > 0, intersection / np.where(union > 0, union, 1), 0.)
+
+def cluster_boxes(boxes, workers, iou_threshold=DEFAULT_IOU_THRESHOLD):
+  """ Greedily group the boxes of different workers that cover the same instance.
+
+  The box that overlaps (IoU >= `iou_threshold`) the most boxes of other workers seeds a cluster,
+  and the best overlapping box of each other worker joins it. This repeats until every box is in
+  a cluster. A cluster has at most one box per worker.
+  Args:
+    boxes: An (N, 4) array of [x, y, w, h] boxes.
+    workers: An (N,) array with the index of the worker that drew each box.
+    iou_threshold: The minimum IoU of two boxes of the same instance.
+  Returns:
+    A list of arrays of box indices.
+  """
+  workers = np.asarray(workers)
+  num_boxes = len(workers)
+  iou = box_iou_matrix(boxes, boxes)
+  iou[workers[:, None] == workers[None, :]] = 0.
+  linked = iou >= iou_threshold
+  linked_iou = np.where(linked, iou, 0.)
+
+  unassigned = np.ones(num_boxes, dtype=bool)
+  clusters = []
+  while unassigned.any():
+    # Rank the boxes by their number of links, then by the sum of their IoUs (which is < num_boxes).
+    live = linked & unassigned[None, :]
+    score = live.sum(axis=1) + (linked_iou * unassigned[None, :]).sum(axis=1) / num_boxes
+    score[~unassigned] = -1
+    seed = int(np.argmax(score))
+
+    candidates = np.flatnonzero(live[seed])
+    # The best candidate of each worker.
+    candidates = candidates[np.argsort(-iou[seed, candidates], kind='stable')]
+    _, first = np.unique(workers[candidates], return_index=True)
+    members = np.concatenate([[seed], candidates[first]]).astype(np.int64)
+
+    unassigned[members] = False
+    clusters.append(members)
+  return clusters
+
+def merge_boxes(submissions, iou_threshold=DEFAULT_IOU_THRESHOLD, min_support=DEFAULT_MIN_SUPPORT):
+  """ Merge the boxes that several workers drew on an image.
+  Args:
+    submissions: A list with the list of [x, y, w, h] boxes of each worker. A worker that found no
+      instances has an empty list.
+    iou_threshold: The minimum IoU of two boxes of the same instance.
+    min_support: The minimum fraction of the workers that must have drawn a box for it to be kept.
+  Returns:
+    A dict with the `num_workers`, `boxes` and `agreement` fields of a consensus document.
+  """
+  num_workers = len(submissions)
+  boxes = [box for submission in submissions for box in submission]
+  if len(boxes) == 0:
+    return {'num_workers' : num_workers, 'boxes' : [], 'agreement' : 1.}
+
+  boxes = np.asarray(boxes, dtype=np.float64)
+  workers = np.repeat(np.arange(num_workers), [len(submission) for submission in submissions])
+  required = max(1, int(math.ceil(min_support * num_workers - 1e-9)))
+
+  consensus_boxes = []
+  num_matched = 0
+  for members in cluster_boxes(boxes, workers, iou_threshold):
+    if len(members) < required:
+      continue
+    # The median of the corners is robust to a single sloppy worker.
+    corners = np.concatenate([boxes[members, :2], boxes[members, :2] + boxes[members, 2:]], axis=1)
+    x1, y1, x2, y2 = np.median(corners, axis=0)
+    bbox = [x1, y1, x2 - x1, y2 - y1]
+    consensus_boxes.append({
+      'bbox' : [float(v) for v in bbox],
+      'num_workers' : int(len(members)),
+      'support' : len(members) / num_workers,
+      'iou' : float(box_iou_matrix([bbox], boxes[members]).mean())
+    })
+    num_matched += len(members)
+
+  consensus_boxes.sort(key=lambda box: (-box['num_workers'], box['bbox']))
+  return {
+    'num_workers' : num_workers,
+    'boxes' : consensus_boxes,
+    'agreement' : num_matched / len(boxes)
+  }
+
+def _task_categories(db, task_ids):
+  """ Map task ids to their category ids.
+  """
+  return {task['id'] : task['category_id']
+          for task in db.bbox_task.find({'id' : {'$in' : list(task_ids)}},
+                                        projection={'_id' : False, 'id' : True, 'category_id' : True})}
+
+def _image_results(task_result):
+  for image_result in task_result.get('results') or []:
+    if isinstance(image_result, dict) and isinstance(image_result.get('image'), dict):
+      yield image_result
+
+def update_image_consensus(db, keys, iou_threshold=DEFAULT_IOU_THRESHOLD, min_support=DEFAULT_MIN_SUPPORT):
+  """ Recompute the consensus of (image id, category id) pairs from their task results.
+  Args:
+    db: A mongodb database handle.
+    keys: A collection of (image id, category id) tuples.
+  Returns:
+    The number of consensus documents written.
+  """
+  keys = set(keys)
+  if len(keys) == 0:
+    return 0
+  image_ids = list(set(image_id for image_id, _ in keys))
+
+  task_results = list(db.bbox_task_result.find(
+    {'results.image.id' : {'$in' : image_ids}},
+    projection={'_id' : True, 'task_id' : True, 'worker_id' : True, 'results.image.id' : True,
+                'results.annotations.bbox' : True}
+  ).sort([('_id', 1)]))
+  task_categories = _task_categories(db, set(task_result['task_id'] for task_result in task_results))
+
+  # The boxes of each worker, from their latest task result (the results are sorted by `_id`). Results
+  # without a worker id can't be matched, so each counts as a different worker.
+  key_to_submissions = {}
+  for task_result in task_results:
+    category_id = task_categories.get(task_result['task_id'])
+    worker_id = task_result.get('worker_id')
+    if worker_id is None:
+      worker_id = task_result['_id']
+    for image_result in _image_results(task_result):
+      key = (image_result['image']['id'], category_id)
+      if key not in keys:
+        continue
+      boxes = [anno['bbox'] for anno in image_result.get('annotations') or [] if 'bbox' in anno]
+      key_to_submissions.setdefault(key, collections.OrderedDict())[worker_id] = boxes
+
+  now = datetime.datetime.utcnow()
+  requests = []
+  for (image_id, category_id), worker_submissions in key_to_submissions.items():
+    doc = merge_boxes(list(worker_submissions.values()), iou_threshold, min_support)
+    doc.update({'image_id' : image_id, 'category_id' : category_id, 'updated' : now})
+    # Task results are only added, so a consensus of more workers is newer.
+    requests.append(ReplaceOne({'image_id' : image_id, 'category_id' : category_id,
+                                'num_workers' : {'$lte' : doc['num_workers']}}, doc, upsert=True))
+  _write_consensus(db, requests)
+  return len(requests)
+
+def _write_consensus(db, requests):
+  """ Run the consensus `ReplaceOne` upserts. The upsert of a stale consensus (one whose filter doesn't
+  match because a newer document was written) fails with a duplicate key error on the unique
+  (image_id, category_id) index, and is dropped. A duplicate key error can also mean that another process
+  inserted the first document of the image at the same time, so those upserts are tried once more.
+  """
+  for attempt in range(2):
+    if len(requests) == 0:
+      return
+    try:
+      db.bbox_consensus.bulk_write(requests, ordered=False)
+      return
+    except BulkWriteError as bwe:
+      errors = bwe.details['writeErrors']
+      if any(error['code'] != DUPLICATE_KEY_ERROR_CODE for error in errors):
+        raise
+      requests = [requests[error['index']] for error in errors]
+
+def update_consensus(db, task_results, iou_threshold=DEFAULT_IOU_THRESHOLD, min_support=DEFAULT_MIN_SUPPORT):
+  """ Update the consensus of the images in newly written task results.
+  Args:
+    db: A mongodb database handle.
+    task_results: A list of bbox task result dicts.
+  Returns:
+    The number of consensus documents written.
+  """
+  task_categories = _task_categories(db, set(task_result['task_id'] for task_result in task_results))
+  keys = set()
+  for task_result in task_results:
+    category_id = task_categories.get(task_result['task_id'])
+    if category_id is None:
+      continue
+    for image_result in _image_results(task_result):
+      keys.add((image_result['image']['id'], category_id))
+  return update_image_consensus(db, keys, iou_threshold, min_support)
+
+class ConsensusUpdater(object):
+  """ Update the consensus of newly written task results from a background thread.
+
+  The task results of a process are queued and merged a batch at a time. The consensus is derived
+  data: results that are still queued when the process dies (or that don't fit in the queue) are only
+  merged by the next update of their images, or by `rebuild_consensus`.
+  """
+
+  def __init__(self, get_db, iou_threshold=DEFAULT_IOU_THRESHOLD, min_support=DEFAULT_MIN_SUPPORT,
+               max_queue_size=10000, batch_size=100, flush_interval=0.5):
+    """
+    Args:
+      get_db: A function returning the database handle.
+      iou_threshold, min_support: The clustering parameters (see `merge_boxes`).
+      max_queue_size: The maximum number of queued task results.
+      batch_size: The maximum number of task results merged together.
+      flush_interval: How long (in seconds) the thread waits for task results.
+    """
+    self.get_db = get_db
+    self.iou_threshold = iou_threshold
+    self.min_support = min_support
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+
+    self._queue = queue.Queue(maxsize=max_queue_size)
+    self._start_lock = threading.Lock()
+    self._stop = threading.Event()
+    self._thread = None
+    self._pid = None
+
+  def start(self):
+    """ Start the background thread (again, if this process was forked after it started or the thread died).
+    """
+    with self._start_lock:
+      if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+        return
+      self._pid = os.getpid()
+      self._stop.clear()
+      self._thread = threading.Thread(target=self._run, name='ConsensusUpdater')
+      self._thread.daemon = True
+      self._thread.start()
+
+  def submit(self, task_results):
+    """ Queue newly written task results. This never blocks.
+    """
+    self.start()
+    for task_result in task_results:
+      try:
+        self._queue.put_nowait(task_result)
+      except queue.Full:
+        logger.warning("The consensus queue is full, skipping the consensus update of task %s", task_result.get('task_id'))
+
+  def close(self, timeout=30):
+    """ Stop the background thread after it has merged the queued task results.
+    """
+    if self._thread is None or self._pid != os.getpid():
+      return
+    self._stop.set()
+    self._thread.join(timeout)
+    self._thread = None
+
+  def _drain(self):
+    batch = []
+    try:
+      batch.append(self._queue.get(timeout=self.flush_interval))
+    except queue.Empty:
+      return batch
+    while len(batch) < self.batch_size:
+      try:
+        batch.append(self._queue.get_nowait())
+      except queue.Empty:
+        break
+    return batch
+
+  def _run(self):
+    while not self._stop.is_set() or not self._queue.empty():
+      batch = self._drain()
+      if len(batch) == 0:
+        continue
+      try:
+        update_consensus(self.get_db(), batch, self.iou_threshold, self.min_support)
+      except Exception:
+        logger.exception("Failed to update the consensus of %d task results", len(batch))
+
+def rebuild_consensus(db, iou_threshold=DEFAULT_IOU_THRESHOLD, min_support=DEFAULT_MIN_SUPPORT,
+                      batch_size=DEFAULT_BATCH_SIZE):
+  """ Recompute the consensus of every image in a bbox task, a batch of tasks at a time.
+  Returns:
+    The number of consensus documents written.
+  """
+  drop_consensus(db)
+  ensure_consensus_indices(db)
+  tasks = db.bbox_task.find({}, projection={'_id' : False, 'image_ids' : True, 'category_id' : True},
+                            batch_size=batch_size)
+  num_written = 0
+  for batch in iter_batches(tasks, batch_size):
+    keys = set((image_id, task['category_id']) for task in batch for image_id in task['image_ids'])
+    for key_batch in iter_batches(keys, batch_size):
+      num_written += update_image_consensus(db, key_batch, iou_threshold, min_support)
+  return num_written
+
+def consensus_query(category_id=None, min_agreement=None, max_agreement=None, min_num_workers=None,
+                    updated_after=None):
+  """ Build the query for the consensus documents matching the filters.
+  """
+  query = {}
+  if category_id is not None:
+    query['category_id'] = category_id
+  agreement = {}
+  if min_agreement is not None:
+    agreement['$gte'] = min_agreement
+  if max_agreement is not None:
+    agreement['$lte'] = max_agreement
+  if len(agreement) > 0:
+    query['agreement'] = agreement
+  if min_num_workers is not None:
+    query['num_workers'] = {'$gte' : min_num_workers}
+  if updated_after is not None:
+    query['updated'] = {'$gt' : updated_after}
+  return query
+
+def find_consensus(db, batch_size=DEFAULT_BATCH_SIZE, **filters):
+  """ Return a cursor over the consensus documents matching the filters (see `consensus_query`).
+  """
+  return db.bbox_consensus.find(consensus_query(**filters), projection={'_id' : False}, batch_size=batch_size)
+
+def iter_consensus_annotations(db, denormalize=False, batch_size=DEFAULT_BATCH_SIZE, **filters):
+  """ Yield an annotation for each consensus box of the consensus documents matching the filters.
+  Args:
+    denormalize: Should the bboxes be converted to image coordinates?
+  """
+  for batch in iter_batches(find_consensus(db, batch_size=batch_size, **filters), batch_size):
+    annotations = []
+    for doc in batch:
+      for i, box in enumerate(doc['boxes']):
+        annotation = dict(box)
+        annotation['id'] = '%s_%s_%d' % (doc['image_id'], doc['category_id'], i)
+        annotation['image_id'] = doc['image_id']
+        annotation['category_id'] = doc['category_id']
+        annotations.append(annotation)
+
+    if denormalize:
+      image_ids = list(set(anno['image_id'] for anno in annotations))
+      image_id_to_w_h = {image['id'] : (float(image['width']), float(image['height']))
+                         for image in db.image.find({'id' : {'$in' : image_ids}},
+                                                    projection={'_id' : False, 'id' : True, 'width' : True, 'height' : True})}
+      scale_annotations(annotations, [image_id_to_w_h[anno['image_id']] for anno in annotations],
+                        normalize=False, keypoints=False)
+
+    for annotation in annotations:
+      yield annotation
+
+def export_consensus_stream(db, fileobj, denormalize=False, batch_size=DEFAULT_BATCH_SIZE, **filters):
+  """ Write the consensus boxes to `fileobj` as a json list of annotations.
+  Returns:
+    The number of annotations written.
+  """
+  return write_json_array(fileobj, iter_consensus_annotations(db, denormalize, batch_size, **filters))
+
+def parse_args():
+
+  parser = argparse.ArgumentParser(description='Merge the bbox task results of several workers.')
+  subparsers = parser.add_subparsers(dest='action')
+  subparsers.required = True
+
+  rebuild = subparsers.add_parser('rebuild', help='Recompute the consensus of every image in a bbox task.')
+  rebuild.add_argument('--iou_threshold', dest='iou_threshold', type=float, default=DEFAULT_IOU_THRESHOLD,
+                       help='The minimum IoU of two boxes of the same instance.')
+  rebuild.add_argument('--min_support', dest='min_support', type=float, default=DEFAULT_MIN_SUPPORT,
+                       help='The minimum fraction of the workers that must have drawn a box for it to be kept.')
+
+  query = subparsers.add_parser('query', help='Find consensus documents (one json document per line).')
+  export = subparsers.add_parser('export', help='Export the consensus boxes as a json list of annotations.')
+  export.add_argument('-u', '--denormalize', dest='denormalize', action='store_true', default=False,
+                      help='Store the bboxes in image coordinates.')
+
+  for subparser in [query, export]:
+    subparser.add_argument('--category_id', dest='category_id', type=str, default=None)
+    subparser.add_argument('--min_agreement', dest='min_agreement', type=float, default=None)
+    subparser.add_argument('--max_agreement', dest='max_agreement', type=float, default=None)
+    subparser.add_argument('--min_num_workers', dest='min_num_workers', type=int, default=None)
+    subparser.add_argument('--updated_after', dest='updated_after', type=str, default=None,
+                           help='Only the images whose consensus changed after this UTC time (YYYY-MM-DDTHH:MM:SS).')
+    subparser.add_argument('-o', '--output', dest='output_path', type=str, default=None,
+                           help='Write the results to this file instead of stdout.')
+
+  return parser.parse_args()
+
+def main():
+
+  args = parse_args()
+  db = get_db()
+
+  if args.action == 'rebuild':
+    num_written = rebuild_consensus(db, args.iou_threshold, args.min_support)
+    print("Merged the results of %d images." % (num_written,))
+    return
+
+  filters = {
+    'category_id' : args.category_id,
+    'min_agreement' : args.min_agreement,
+    'max_agreement' : args.max_agreement,
+    'min_num_workers' : args.min_num_workers,
+    'updated_after' : None
+  }
+  if args.updated_after is not None:
+    filters['updated_after'] = datetime.datetime.strptime(args.updated_after, '%Y-%m-%dT%H:%M:%S')
+
+  output = io.open(args.output_path, 'w', encoding='utf-8') if args.output_path is not None else sys.stdout
+  try:
+    if args.action == 'query':
+      count = 0
+      for doc in find_consensus(db, **filters):
+        output.write(serialization.dumps(doc) + '\n')
+        count += 1
+    else:
+      count = export_consensus_stream(db, output, denormalize=args.denormalize, **filters)
+  finally:
+    if output is not sys.stdout:
+      output.close()
+  print("Found %d results" % (count,), file=sys.stderr)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,59 @@
+"""
+Batched conversion of annotations between image coordinates and normalized coordinates.
+
+The annotations are python dicts, so copying their coordinates into numpy arrays and back costs
+more than the arithmetic saves. Instead, the x and y coordinates of the keypoints are scaled with one
+list comprehension per axis and written back with slice assignments, which keeps the type of the
+visibility flags. The results are identical to scaling each coordinate in a loop.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+def image_dimensions(annotations, image_id_to_w_h):
+  """ Join a batch of annotations to the dimensions of their images.
+  Args:
+    annotations: A list of annotation dicts.
+    image_id_to_w_h: A dict mapping image ids to (width, height) float tuples.
+  Returns:
+    A list with the (width, height) tuple of each annotation.
+  """
+  return [image_id_to_w_h[anno['image_id']] for anno in annotations]
+
+def scale_annotations(annotations, dims, normalize, keypoints=True):
+  """ Normalize or denormalize the bboxes (and keypoints) of a batch of annotations in place.
+  Args:
+    annotations: A list of annotation dicts.
+    dims: The (width, height) float tuple of the image of each annotation.
+    normalize: If True then divide by the image dimensions, otherwise multiply.
+    keypoints: Should the keypoints be converted as well?
+  Returns:
+    The annotations.
+  """
+  for anno, (w, h) in zip(annotations, dims):
+    x1, y1, bw, bh = anno['bbox']
+    if normalize:
+      anno['bbox'] = [x1 / w, y1 / h, bw / w, bh / h]
+    else:
+      anno['bbox'] = [x1 * w, y1 * h, bw * w, bh * h]
+    if keypoints and 'keypoints' in anno:
+      kps = anno['keypoints']
+      if normalize:
+        kps[0::3] = [x / w for x in kps[0::3]]
+        kps[1::3] = [y / h for y in kps[1::3]]
+      else:
+        kps[0::3] = [x * w for x in kps[0::3]]
+        kps[1::3] = [y * h for y in kps[1::3]]
+
+  return annotations
+
+def normalize_annotations(annotations, image_id_to_w_h):
+  """ Convert a batch of annotations from image coordinates to normalized coordinates, in place.
+  """
+  return scale_annotations(annotations, image_dimensions(annotations, image_id_to_w_h), normalize=True)
+
+def denormalize_annotations(annotations, image_id_to_w_h):
+  """ Convert a batch of annotations from normalized coordinates to image coordinates, in place.
+  """
+  return scale_annotations(annotations, image_dimensions(annotations, image_id_to_w_h), normalize=False)
@@ -22,7 +22,8 @@ A bounding box task dict consists of:
   instructions_id : str,
   category_id : str
 }
-Where image ids point to normal image objects.
+Where image ids point to normal image objects. Tasks that are handed out by `/bbox_task/next` also
+hold their dispatch state (see `task_dispatch.py`).
 
 The result of a worker completing the task is:
 {
@@ -30,6 +31,7 @@ The result of a worker completing the task is:
   task_id : str
   date : str
   worker_id : str
+  lease_id : str (optional)
   results : [bbox_result]
 }
 Where bbox_result looks like:
@@ -46,23 +48,45 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import io
 import json
 import random
 import uuid
 
-from annotation_tools.annotation_tools import get_db
+from annotation_tools.caches import invalidate_bbox_task_instructions_cache
+from annotation_tools.connection import get_config, get_db
+from annotation_tools.consensus import drop_consensus, ensure_consensus_indices
+from annotation_tools.task_dispatch import dispatch_fields, ensure_dispatch_indices
+from annotation_tools.bulk_insert import BulkInserter, insert_documents, DEFAULT_NUM_WORKERS
+from annotation_tools.coord_utils import scale_annotations
+from annotation_tools.stream_utils import iter_batches, write_json_array
+
+DEFAULT_BATCH_SIZE = 1000
 
 def drop_bbox_collections(db):
   db.drop_collection('bbox_task')
   db.drop_collection('bbox_task_instructions')
   db.drop_collection('bbox_task_result')
+  drop_consensus(db)
+  invalidate_bbox_task_instructions_cache(db)
 
 def ensure_bbox_indices(db):
   db.bbox_task.create_index("id", unique=True)
+  db.bbox_task.create_index([("category_id", 1), ("image_ids", 1)])
   db.bbox_task_instructions.create_index("id", unique=True)
+  ensure_consensus_indices(db)
+  ensure_dispatch_indices(db)
+
 
+def _with_dispatch_fields(tasks, redundancy):
+  """ Add the dispatch state (see `task_dispatch`) to the tasks that don't have one.
+  """
+  for task in tasks:
+    if 'redundancy' not in task:
+      task.update(dispatch_fields(redundancy))
+    yield task
 
-def insert_bbox_tasks(db, tasks):
+def insert_bbox_tasks(db, tasks, batch_size=DEFAULT_BATCH_SIZE, num_workers=DEFAULT_NUM_WORKERS, redundancy=None):
   """
   Args:
     db: a pymongo database connection
@@ -71,13 +95,20 @@ def insert_bbox_tasks(db, tasks):
       image_ids : [image_ids],
       instructions_id : instructions_id,
       category_id : str
-    }] A list of bbox task dicts.
+    }] A list (or iterable) of bbox task dicts.
+    batch_size: The maximum number of tasks to send to the database in a single insert.
+    num_workers: The number of concurrent inserts.
+    redundancy: Lease each task to this many workers (see `task_dispatch`). None leaves the tasks
+      out of the dispatch until `task_dispatch.enable_dispatch` is called.
+  Returns:
+    (number of inserted tasks, number of duplicate tasks)
   """
-  try:
-    response = db.bbox_task.insert_many(tasks, ordered=False)
-  except:
-    pass
-  return response
+  if redundancy is not None:
+    tasks = _with_dispatch_fields(tasks, redundancy)
+  with BulkInserter(db.bbox_task, num_workers=num_workers) as inserter:
+    for chunk in iter_batches(tasks, batch_size):
+      inserter.submit(chunk)
+  return inserter.num_inserted, inserter.num_duplicates
 
 def insert_bbox_task_instructions(db, task_instructions):
   """ Store the instructions for the bbox task.
@@ -89,15 +120,138 @@ def insert_bbox_task_instructions(db, task_instructions):
       'instructions':
       'examples'
     }] A list of bbox task instructions
+  Returns:
+    (number of inserted instructions, number of duplicate instructions)
+  """
+  if len(task_instructions) == 0:
+    return 0, 0
+  return insert_documents(db.bbox_task_instructions, task_instructions)
+
+DEFAULT_SHUFFLE_BUFFER_SIZE = 10000
+DEFAULT_NUM_OPEN_TASKS = 16
+
+def _shuffled(iterable, buffer_size, rng):
+  """ Shuffle a stream with a bounded buffer: each item is swapped with a random item of the buffer.
+  """
+  buffer = []
+  for item in iterable:
+    if len(buffer) < buffer_size:
+      buffer.append(item)
+      continue
+    idx = rng.randrange(buffer_size)
+    yield buffer[idx]
+    buffer[idx] = item
+  rng.shuffle(buffer)
+  for item in buffer:
+    yield item
+
+def _iter_uncovered_images(db, category_id, batch_size=DEFAULT_BATCH_SIZE):
+  """ Stream (image id, number of annotations of `category_id`) for the images that are not in a bbox task for
+  `category_id` yet. Task results always belong to a task, so this also skips the images that have results.
   """
-  try:
-    response = db.bbox_task_instructions.insert_many(task_instructions, ordered=False)
-  except:
-    pass
-  return response
-
-def create_bbox_tasks_for_all_images(db, category_id, instructions_id, num_images_per_task=20):
-  """Insert all images into a bounding box task. This is a convenience function.
+  images = db.image.find({}, projection={'_id' : False, 'id' : True}, batch_size=batch_size).sort([('id', 1)])
+  for batch in iter_batches((image['id'] for image in images), batch_size):
+    # Uses the (category_id, image_ids) index on the tasks.
+    covered = set()
+    for task in db.bbox_task.find({'category_id' : category_id, 'image_ids' : {'$in' : batch}},
+                                  projection={'_id' : False, 'image_ids' : True}):
+      covered.update(task['image_ids'])
+
+    # Uses the (category_id, image_id) index on the annotations.
+    annotation_counts = {doc['_id'] : doc['count'] for doc in db.annotation.aggregate([
+      {'$match' : {'category_id' : category_id, 'image_id' : {'$in' : batch}}},
+      {'$group' : {'_id' : '$image_id', 'count' : {'$sum' : 1}}}
+    ])}
+
+    for image_id in batch:
+      if image_id not in covered:
+        yield image_id, annotation_counts.get(image_id, 0)
+
+def generate_bbox_tasks(db, category_id, instructions_id, num_images_per_task=20, max_workload=None,
+                        shuffle_buffer_size=DEFAULT_SHUFFLE_BUFFER_SIZE, num_open_tasks=DEFAULT_NUM_OPEN_TASKS,
+                        batch_size=DEFAULT_BATCH_SIZE, seed=None):
+  """ Generate bbox tasks for `category_id` covering the images that are not in a task for this category yet.
+
+  The images are streamed from the database, so memory usage is bounded by `batch_size`,
+  `shuffle_buffer_size` and `num_open_tasks` regardless of the number of images.
+
+  Each image is given an estimated workload of 1 + the number of its existing annotations for the
+  category (more instances take longer to box). Images are packed into a pool of open tasks: an
+  image goes to the fullest open task that it fits in, and a task is emitted when it is full, or to
+  make room in the pool.
+  Args:
+    db: A mongodb database handle.
+    category_id: The category to collect boxes for.
+    instructions_id: The id of the task instructions.
+    num_images_per_task: The maximum number of images per task.
+    max_workload: The maximum total workload per task. Defaults to `num_images_per_task`.
+    shuffle_buffer_size: The images are shuffled within a window of this size (0 keeps them in id order).
+    num_open_tasks: The number of tasks that are filled at the same time.
+    batch_size: The number of images fetched (and checked against the existing tasks) per round trip.
+    seed: Seed for the shuffle.
+  Returns:
+    A generator of bbox task dicts.
+  """
+  if max_workload is None:
+    max_workload = num_images_per_task
+  rng = random.Random(seed)
+
+  images = _iter_uncovered_images(db, category_id, batch_size)
+  if shuffle_buffer_size > 0:
+    images = _shuffled(images, shuffle_buffer_size, rng)
+
+  def make_task(image_ids):
+    return {
+      'id' : str(uuid.uuid1()),
+      'image_ids' : image_ids,
+      'instructions_id' : instructions_id,
+      'category_id' : category_id
+    }
+
+  # Each open task is [workload, image ids].
+  open_tasks = []
+  for image_id, num_annotations in images:
+    workload = 1 + num_annotations
+
+    best = None
+    for task in open_tasks:
+      if task[0] + workload <= max_workload and len(task[1]) < num_images_per_task:
+        if best is None or task[0] > best[0]:
+          best = task
+    if best is None:
+      if len(open_tasks) >= num_open_tasks:
+        fullest = max(open_tasks, key=lambda task: task[0])
+        open_tasks.remove(fullest)
+        yield make_task(fullest[1])
+      best = [0, []]
+      open_tasks.append(best)
+
+    best[0] += workload
+    best[1].append(image_id)
+    if best[0] >= max_workload or len(best[1]) >= num_images_per_task:
+      open_tasks.remove(best)
+      yield make_task(best[1])
+
+  for task in open_tasks:
+    yield make_task(task[1])
+
+def create_bbox_tasks(db, category_id, instructions_id, num_images_per_task=20, max_workload=None,
+                      batch_size=DEFAULT_BATCH_SIZE, num_workers=DEFAULT_NUM_WORKERS, redundancy=None, **kwargs):
+  """ Create and insert bbox tasks for the images that are not in a task for `category_id` yet
+  (see `generate_bbox_tasks` for the arguments, and `insert_bbox_tasks` for `redundancy`). The tasks
+  are inserted in batches as they are generated.
+  Returns:
+    (number of inserted tasks, number of duplicate tasks)
+  """
+  ensure_bbox_indices(db)
+  tasks = generate_bbox_tasks(db, category_id, instructions_id, num_images_per_task, max_workload,
+                              batch_size=batch_size, **kwargs)
+  return insert_bbox_tasks(db, tasks, batch_size=batch_size, num_workers=num_workers, redundancy=redundancy)
+
+def create_bbox_tasks_for_all_images(db, category_id, instructions_id, num_images_per_task=20, redundancy=None):
+  """Insert all images into a bounding box task. This is a convenience function, it holds all of the
+  image ids in memory and puts every image in a new task, even if it is already in a task for
+  `category_id`; use `create_bbox_tasks` to only cover the remaining images of large image pools.
   Returns:
     [<bbox task dict>] a list of the tasks created.
   """
@@ -121,29 +275,55 @@ def create_bbox_tasks_for_all_images(db, category_id, instructions_id, num_image
       'category_id' : category_id
     })
 
-  insert_bbox_tasks(db, bbox_tasks)
+  insert_bbox_tasks(db, bbox_tasks, redundancy=redundancy)
 
   return bbox_tasks
 
-def load_tasks(db, task_data):
+def load_tasks(db, task_data, redundancy=None):
   """
   task_data{
     'tasks' : [bbox_task],
     'instructions' : [bbox_task_instructions]
   }
+  See `insert_bbox_tasks` for `redundancy`.
   """
   assert 'tasks' in task_data,  "Failed to find `tasks` in task_data object."
 
   if 'instructions' in task_data:
     instructions = task_data['instructions']
     print("Inserting %d instructions." % (len(instructions),))
-    response = insert_bbox_task_instructions(db, instructions)
-    print("Successfully inserted %d instuctions." % (len(response.inserted_ids),))
+    num_inserted, num_duplicates = insert_bbox_task_instructions(db, instructions)
+    print("Successfully inserted %d instuctions (%d duplicates skipped)." % (num_inserted, num_duplicates))
+    invalidate_bbox_task_instructions_cache(db)
 
   tasks = task_data['tasks']
   print("Inserting %d tasks." % (len(tasks),))
-  response = insert_bbox_tasks(db, tasks)
-  print("Successfully inserted %d tasks." % (len(response.inserted_ids),))
+  num_inserted, num_duplicates = insert_bbox_tasks(db, tasks, redundancy=redundancy)
+  print("Successfully inserted %d tasks (%d duplicates skipped)." % (num_inserted, num_duplicates))
+
+def _denormalize_task_results(task_results):
+  """ Convert the bboxes of a batch of task results to image coordinates, in place.
+  """
+  annotations = []
+  dims = []
+  for task_result in task_results:
+    for image_result in task_result['results']:
+      image = image_result['image']
+      image_w_h = (image['width'], image['height'])
+      for anno in image_result['annotations']:
+        annotations.append(anno)
+        dims.append(image_w_h)
+  scale_annotations(annotations, dims, normalize=False, keypoints=False)
+  return task_results
+
+def _find_task_results(db, task_data=None, batch_size=DEFAULT_BATCH_SIZE):
+  if task_data != None:
+    assert 'tasks' in task_data,  "Failed to find `tasks` in task_data object."
+    task_ids = list(set([task['id'] for task in task_data['tasks']]))
+    query = {'task_id' : {"$in" : task_ids}}
+  else:
+    query = {}
+  return db.bbox_task_result.find(query, projection={'_id' : False}, batch_size=batch_size)
 
 def export_task_results(db, task_data=None, denormalize=False):
   """ Export the bbox task results. Saves a list of task results to `output_path`.
@@ -151,30 +331,36 @@ def export_task_results(db, task_data=None, denormalize=False):
     task_data: Use this to specify which task results to export.
     denormalize: Should the annotations be stored in image coordinates?
   """
-  if task_data != None:
-    assert 'tasks' in task_data,  "Failed to find `tasks` in task_data object."
-    task_ids = list(set([task['id'] for task in task_data['tasks']]))
-    task_results = list(db.bbox_task_result.find({'task_id' : {"$in" : task_ids}}, projection={'_id' : False}))
-  else:
-    task_results = list(db.bbox_task_result.find(projection={'_id' : False}))
+  task_results = list(_find_task_results(db, task_data))
 
   if denormalize:
-    for task_result in task_results:
-      for image_result in task_result['results']:
-        image = image_result['image']
-        width = image['width']
-        height = image['height']
-        for anno in image_result['annotations']:
-          x, y, w, h = anno['bbox']
-          anno['bbox'] = [x * width, y * height, w * width, h * height]
+    _denormalize_task_results(task_results)
 
   return task_results
 
+def export_task_results_stream(db, fileobj, task_data=None, denormalize=False, batch_size=DEFAULT_BATCH_SIZE):
+  """ Write the bbox task results to `fileobj` as they are read from the database. Produces the same data as
+  `json.dump(export_task_results(db, task_data, denormalize), fileobj)` without holding the results in memory.
+  Args:
+    fileobj: A file object opened for writing.
+    task_data: Use this to specify which task results to export.
+    denormalize: Should the annotations be stored in image coordinates?
+    batch_size: The number of results to fetch from the database per round trip.
+  Returns:
+    The number of task results written.
+  """
+  task_results = _find_task_results(db, task_data, batch_size)
+  if denormalize:
+    task_results = (task_result
+                    for chunk in iter_batches(task_results, batch_size)
+                    for task_result in _denormalize_task_results(chunk))
+  return write_json_array(fileobj, task_results)
+
 def parse_args():
 
   parser = argparse.ArgumentParser(description='Dataset loading and exporting utilities.')
 
-  parser.add_argument('-a', '--action', choices=['drop', 'load', 'export'], dest='action',
+  parser.add_argument('-a', '--action', choices=['drop', 'load', 'export', 'create'], dest='action',
                       help='The action you would like to perform.', required=True)
 
   parser.add_argument('-t', '--tasks', dest='task_path',
@@ -189,8 +375,30 @@ def parse_args():
                         help='Save path for the json dataset. Used with the `export` action.', type=str,
                         required=False)
 
+  parser.add_argument('-c', '--category_id', dest='category_id',
+                        help='Create tasks for this category. Used with the `create` action.', type=str,
+                        required=False)
+
+  parser.add_argument('-i', '--instructions_id', dest='instructions_id',
+                        help='The instructions of the created tasks. Used with the `create` action.', type=str,
+                        required=False)
+
+  parser.add_argument('-n', '--num_images_per_task', dest='num_images_per_task',
+                        help='The maximum number of images per task. Used with the `create` action.', type=int,
+                        required=False, default=20)
+
+  parser.add_argument('-m', '--max_workload', dest='max_workload',
+                        help='The maximum workload per task, where an image costs 1 + its number of existing annotations for the category. Defaults to the number of images per task. Used with the `create` action.', type=int,
+                        required=False, default=None)
+
+  parser.add_argument('-r', '--redundancy', dest='redundancy',
+                        help='The number of different workers that each task is leased to by `/bbox_task/next`. Defaults to BBOX_TASK_REDUNDANCY. Used with the `load` and `create` actions.', type=int,
+                        required=False, default=None)
+
 
   args = parser.parse_args()
+  if args.action == 'create' and (args.category_id is None or args.instructions_id is None):
+    parser.error("The `create` action requires --category_id and --instructions_id.")
   return args
 
 def main():
@@ -198,22 +406,34 @@ def main():
   db = get_db()
 
   action = args.action
+  redundancy = args.redundancy
+  if redundancy is None:
+    redundancy = get_config('BBOX_TASK_REDUNDANCY')
   if action == 'drop':
     drop_bbox_collections(db)
   elif action == 'load':
     with open(args.task_path) as f:
       task_data = json.load(f)
     ensure_bbox_indices(db)
-    load_tasks(db, task_data)
+    load_tasks(db, task_data, redundancy=redundancy)
   elif action == 'export':
     if args.task_path != None:
       with open(args.task_path) as f:
         task_data = json.load(f)
     else:
       task_data = None
-    results = export_task_results(db, task_data, denormalize=args.denormalize)
-    with open(args.output_path, 'w') as f:
-      json.dump(results, f)
+    with io.open(args.output_path, 'w', encoding='utf-8') as f:
+      num_results = export_task_results_stream(db, f, task_data, denormalize=args.denormalize)
+    print("Exported %d task results." % (num_results,))
+  elif action == 'create':
+    if db.category.find_one({'id' : args.category_id}, projection={'_id' : True}) is None:
+      raise ValueError("There is no category with id %s." % (args.category_id,))
+    if db.bbox_task_instructions.find_one({'id' : args.instructions_id}, projection={'_id' : True}) is None:
+      raise ValueError("There are no bbox task instructions with id %s, load them first." % (args.instructions_id,))
+    num_inserted, num_duplicates = create_bbox_tasks(db, args.category_id, args.instructions_id,
+                                                     num_images_per_task=args.num_images_per_task,
+                                                     max_workload=args.max_workload, redundancy=redundancy)
+    print("Created %d tasks." % (num_inserted,))
 
 if __name__ == '__main__':
 
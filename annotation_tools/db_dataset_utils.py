@@ -49,14 +49,38 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import collections
+import datetime
+import functools
+import hashlib
+import io
 import json
-
-from pymongo.errors import BulkWriteError
-
-from annotation_tools.annotation_tools import get_db
+import multiprocessing
+import os
+import time
+
+from bson import json_util
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from pymongo import MongoClient, ReplaceOne
+
+from annotation_tools import connection
+from annotation_tools import serialization
+from annotation_tools.caches import invalidate_category_cache
+from annotation_tools.connection import get_db
+from annotation_tools.columnar import ColumnarWriter
+from annotation_tools.bulk_insert import BulkInserter, DEFAULT_NUM_WORKERS, insert_documents
+from annotation_tools.coord_utils import normalize_annotations, denormalize_annotations
+from annotation_tools.segmentation import prepare_annotations
+from annotation_tools.stream_utils import iter_json_arrays, iter_batches, write_json_array, write_json_arrays, ProgressReporter
 from annotation_tools.utils import COLOR_LIST
 
-DUPLICATE_KEY_ERROR_CODE = 11000
+DEFAULT_BATCH_SIZE = 1000
+
+# Content hashes of the loaded records, used by delta loads to find new and changed records.
+SOURCE_HASH_COLLECTION = 'dataset_source_hash'
+# Progress of resumable loads.
+CHECKPOINT_COLLECTION = 'dataset_load_checkpoint'
 
 def drop_dataset(db):
   """ Drop the collections.
@@ -67,6 +91,10 @@ def drop_dataset(db):
   db.drop_collection('image')
   db.drop_collection('annotation')
   db.drop_collection('license')
+  db.drop_collection(SOURCE_HASH_COLLECTION)
+  db.drop_collection(CHECKPOINT_COLLECTION)
+
+  invalidate_category_cache(db)
 
 def ensure_dataset_indices(db):
   """ Ensure the collections exist and create the indices
@@ -75,14 +103,189 @@ def ensure_dataset_indices(db):
   db.image.create_index("id", unique=True)
   db.annotation.create_index("id", unique=True)
   db.annotation.create_index("image_id")
+  db.annotation.create_index([("category_id", 1), ("image_id", 1)])
+  db.annotation.create_index("area")
+  # Serves the annotation queries (see `queries.annotation_pipeline`): the category, then the `id`
+  # sort of the pages, then the `area` range, so that a page doesn't need an in memory sort.
+  db.annotation.create_index([("category_id", 1), ("id", 1), ("area", 1)])
   db.license.create_index("id", unique=True)
 
-def load_dataset(db, dataset, normalize=False):
+def _prepare_category(cat):
+  """ Ensure that the category id is a string and that keypoint styles exist.
+  """
+  cat['id'] = str(cat['id'])
+
+  # Add specific colors to the keypoints
+  if 'keypoints' in cat and 'keypoints_style' not in cat:
+    print("\tWARNING: Adding keypoint styles to category: %s" % (cat['name'],))
+    keypoints_style = []
+    for k in range(len(cat['keypoints'])):
+      keypoints_style.append(COLOR_LIST[k % len(COLOR_LIST)])
+    cat['keypoints_style'] = keypoints_style
+
+  return cat
+
+def _prepare_image(image):
+  """ Ensure that the image id and license id are strings and fill in missing fields.
+  """
+  image['id'] = str(image['id'])
+  image['license'] = str(image['license']) if 'license' in image else ''
+
+  # If loading the actual COCO dataset, then remap `coco_url` to `url`
+  if 'url' not in image and 'coco_url' in image:
+    image['url'] = image['coco_url']
+
+  # Add a blank rights holder if it is not present
+  if 'rights_holder' not in image:
+    image['rights_holder'] = ''
+
+  return image
+
+def _prepare_annotation(anno):
+  """ Ensure that the ids are strings.
+  """
+  anno['id'] = str(anno['id'])
+  anno['image_id'] = str(anno['image_id'])
+  anno['category_id'] = str(anno['category_id'])
+  return anno
+
+def _prepare_license(lic):
+  """ Ensure the license id is a string.
+  """
+  lic['id'] = str(lic['id'])
+  return lic
+
+# Maps the top level keys of a dataset file to their collection and preparation function.
+DATASET_COLLECTIONS = {
+  'categories' : ('category', _prepare_category),
+  'images' : ('image', _prepare_image),
+  'annotations' : ('annotation', _prepare_annotation),
+  'licenses' : ('license', _prepare_license)
+}
+
+def _prepare_chunk(key, chunk, image_id_to_w_h=None):
+  """ Prepare a chunk of documents from the `key` array of a dataset. The segmentations of the
+  annotations are normalized and their missing areas are computed (in pixels), then the annotations
+  are normalized if `image_id_to_w_h` is provided.
+  """
+  prepare = DATASET_COLLECTIONS[key][1]
+  chunk = [prepare(doc) for doc in chunk]
+  if key == 'annotations':
+    prepare_annotations(chunk, image_id_to_w_h)
+    if image_id_to_w_h is not None:
+      normalize_annotations(chunk, image_id_to_w_h)
+  return chunk
+
+def _insert_prepared(db, key, documents, image_id_to_w_h=None, batch_size=DEFAULT_BATCH_SIZE, num_workers=DEFAULT_NUM_WORKERS):
+  """ Prepare and insert documents in chunks. Preparing a chunk overlaps with the insertion of the previous chunks.
+  Returns:
+    (number of inserted documents, number of duplicate documents)
+  """
+  collection = db[DATASET_COLLECTIONS[key][0]]
+  with BulkInserter(collection, num_workers=num_workers) as inserter:
+    for chunk in iter_batches(documents, batch_size):
+      inserter.submit(_prepare_chunk(key, chunk, image_id_to_w_h))
+  return inserter.num_inserted, inserter.num_duplicates
+
+def _print_insert_summary(name, num_inserted, num_duplicates):
+  if num_duplicates == 0:
+    print("Successfully inserted %d %s" % (num_inserted, name))
+  else:
+    print("Attempted to insert duplicate %s, %d new %s inserted" % (name, num_inserted, name))
+
+################### Resumable and Delta Loads ######################
+
+def _content_hash(doc):
+  """ Hash a prepared record. Equal records have equal hashes regardless of key order. BSON values
+  of stored documents (e.g. ObjectIds and datetimes) are hashed as extended json, plain json values
+  hash the same as with `json.dumps`.
+  """
+  return hashlib.sha1(json_util.dumps(doc, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def upsert_changed_documents(db, collection, documents):
+  """ Write the documents that are new or that changed since they were last loaded, and skip the rest.
+
+  A record is compared with the hash of the source record it was last loaded from, not with the
+  current document, so edits made in the web app survive a refresh that doesn't change the record.
+  The hashes are updated after the documents are written, so an interrupted write is redone.
+
+  A document that exists but has no hash (e.g. it was loaded without `delta`) is not overwritten:
+  if it still matches the record its hash is recorded, otherwise it is skipped and reported, since
+  it may have been edited in the web app.
+  Args:
+    db: A mongodb database handle.
+    collection: The pymongo collection of the documents.
+    documents: Prepared documents with an `id` field.
+  Returns:
+    (number of written documents, number of unchanged documents)
+  """
+  hash_ids = ['%s/%s' % (collection.name, doc['id']) for doc in documents]
+  hashes = [_content_hash(doc) for doc in documents]
+  existing = {entry['_id'] : entry['hash'] for entry in db[SOURCE_HASH_COLLECTION].find({'_id' : {'$in' : hash_ids}})}
+
+  unhashed_ids = [doc['id'] for doc, hash_id in zip(documents, hash_ids) if hash_id not in existing]
+  unhashed = {}
+  if len(unhashed_ids) > 0:
+    unhashed = {doc['id'] : doc for doc in collection.find({'id' : {'$in' : unhashed_ids}}, projection={'_id' : False})}
+
+  operations = []
+  hash_operations = []
+  conflicts = []
+  for doc, hash_id, content_hash in zip(documents, hash_ids, hashes):
+    if existing.get(hash_id) == content_hash:
+      continue
+    if doc['id'] in unhashed and _content_hash(unhashed[doc['id']]) != content_hash:
+      conflicts.append(doc['id'])
+      continue
+    if doc['id'] not in unhashed:
+      operations.append(ReplaceOne({'id' : doc['id']}, doc, upsert=True))
+    hash_operations.append(ReplaceOne({'_id' : hash_id}, {'_id' : hash_id, 'hash' : content_hash}, upsert=True))
+
+  if len(operations) > 0:
+    collection.bulk_write(operations, ordered=False)
+  if len(hash_operations) > 0:
+    db[SOURCE_HASH_COLLECTION].bulk_write(hash_operations, ordered=False)
+  if len(conflicts) > 0:
+    print("Skipped %d %s documents that differ from the file but were not loaded with delta (e.g. id %s)" % (
+      len(conflicts), collection.name, conflicts[0]))
+
+  return len(operations), len(documents) - len(operations)
+
+def _dataset_fingerprint(dataset_path):
+  """ Identify a version of a dataset file by its path, size and modification time.
+  """
+  stat = os.stat(dataset_path)
+  return '%s:%d:%d' % (os.path.abspath(dataset_path), stat.st_size, int(stat.st_mtime))
+
+def _load_checkpoint(db, dataset_path, normalize, delta):
+  """ Return the checkpoint of a previous load of this version of the file (or a new one).
+  """
+  fingerprint = _dataset_fingerprint(dataset_path)
+  checkpoint = db[CHECKPOINT_COLLECTION].find_one({'_id' : fingerprint})
+  if checkpoint is None:
+    checkpoint = {
+      '_id' : fingerprint,
+      'normalize' : normalize,
+      'delta' : delta,
+      'committed' : {key : 0 for key in DATASET_COLLECTIONS},
+      'finished' : False,
+      'started' : str(datetime.datetime.now())
+    }
+    db[CHECKPOINT_COLLECTION].insert_one(checkpoint)
+  elif checkpoint['normalize'] != normalize:
+    raise ValueError("The interrupted load of %s used normalize=%s, resume it with the same setting." % (dataset_path, checkpoint['normalize']))
+  elif checkpoint.get('delta', False) != delta:
+    raise ValueError("The interrupted load of %s used delta=%s, resume it with the same setting." % (dataset_path, checkpoint.get('delta', False)))
+  return checkpoint
+
+def load_dataset(db, dataset, normalize=False, batch_size=DEFAULT_BATCH_SIZE, num_workers=DEFAULT_NUM_WORKERS):
   """ Load a COCO style dataset.
   Args:
     db: A mongodb database handle.
     dataset: A COCO style dataset.
     normalize: Should the annotations be normalized by the width and height stored with the images?
+    batch_size: The maximum number of documents to send to the database in a single insert.
+    num_workers: The number of concurrent inserts.
   """
 
   print("Loading Dataset")
@@ -92,59 +295,17 @@ def load_dataset(db, dataset, normalize=False):
   categories = dataset['categories']
   print("Inserting %d categories" % (len(categories),))
   if len(categories) > 0:
-
-    # Ensure that the category ids are strings
-    for cat in categories:
-      cat['id'] = str(cat['id'])
-
-      # Add specific colors to the keypoints
-      if 'keypoints' in cat and 'keypoints_style' not in cat:
-        print("\tWARNING: Adding keypoint styles to category: %s" % (cat['name'],))
-        keypoints_style = []
-        for k in range(len(cat['keypoints'])):
-          keypoints_style.append(COLOR_LIST[k % len(COLOR_LIST)])
-        cat['keypoints_style'] = keypoints_style
-
-    try:
-      response = db.category.insert_many(categories, ordered=False)
-      print("Successfully inserted %d categories" % (len(response.inserted_ids),))
-    except BulkWriteError as bwe:
-      panic = filter(lambda x: x['code'] != DUPLICATE_KEY_ERROR_CODE, bwe.details['writeErrors'])
-      if len(panic) > 0:
-        raise
-      print("Attempted to insert duplicate categories, %d new categories inserted" % (bwe.details['nInserted'],))
-
-
+    num_inserted, num_duplicates = _insert_prepared(db, 'categories', categories, batch_size=batch_size, num_workers=num_workers)
+    _print_insert_summary('categories', num_inserted, num_duplicates)
+    invalidate_category_cache(db)
 
   # Insert the images
   assert 'images' in dataset, "Failed to find `images` in dataset object."
   images = dataset['images']
   print("Inserting %d images" % (len(images),))
   if len(images) > 0:
-
-    # Ensure that the image ids and license ids are strings
-    for image in images:
-      image['id'] = str(image['id'])
-      image['license'] = str(image['license']) if 'license' in image else ''
-
-      # If loading the actual COCO dataset, then remap `coco_url` to `url`
-      if 'url' not in image and 'coco_url' in image:
-        image['url'] = image['coco_url']
-
-      # Add a blank rights holder if it is not present
-      if 'rights_holder' not in image:
-        image['rights_holder'] = ''
-
-    try:
-      response = db.image.insert_many(images, ordered=False)
-      print("Successfully inserted %d images" % (len(response.inserted_ids),))
-
-    except BulkWriteError as bwe:
-      panic = filter(lambda x: x['code'] != DUPLICATE_KEY_ERROR_CODE, bwe.details['writeErrors'])
-      if len(panic) > 0:
-        raise
-      print("Attempted to insert duplicate images, %d new images inserted" % (bwe.details['nInserted'],))
-
+    num_inserted, num_duplicates = _insert_prepared(db, 'images', images, batch_size=batch_size, num_workers=num_workers)
+    _print_insert_summary('images', num_inserted, num_duplicates)
 
   # Insert the annotations
   assert 'annotations' in dataset, "Failed to find `annotations` in dataset object."
@@ -152,55 +313,147 @@ def load_dataset(db, dataset, normalize=False):
   print("Inserting %d annotations" % (len(annotations),))
   if len(annotations) > 0:
 
-    # Ensure that the ids are strings
-    for anno in annotations:
-      anno['id'] = str(anno['id'])
-      anno['image_id'] = str(anno['image_id'])
-      anno['category_id'] = str(anno['category_id'])
-
+    image_id_to_w_h = None
     if normalize:
       image_id_to_w_h = {image['id'] : (float(image['width']), float(image['height']))
                          for image in images}
 
-      for anno in annotations:
-        image_width, image_height = image_id_to_w_h[anno['image_id']]
-        x, y, w, h = anno['bbox']
-        anno['bbox'] = [x / image_width, y / image_height, w / image_width, h / image_height]
-        if 'keypoints' in anno:
-          for pidx in range(0, len(anno['keypoints']), 3):
-            x, y = anno['keypoints'][pidx:pidx+2]
-            anno['keypoints'][pidx:pidx+2] = [x / image_width, y / image_height]
-
-    try:
-      response = db.annotation.insert_many(annotations, ordered=False)
-      print("Successfully inserted %d annotations" % (len(response.inserted_ids),))
-    except BulkWriteError as bwe:
-      panic = filter(lambda x: x['code'] != DUPLICATE_KEY_ERROR_CODE, bwe.details['writeErrors'])
-      if len(panic) > 0:
-        raise
-      print("Attempted to insert duplicate annotations, %d new annotations inserted" % (bwe.details['nInserted'],))
-
-
+    num_inserted, num_duplicates = _insert_prepared(db, 'annotations', annotations, image_id_to_w_h,
+                                                    batch_size=batch_size, num_workers=num_workers)
+    _print_insert_summary('annotations', num_inserted, num_duplicates)
 
   # Insert the licenses
   assert 'licenses' in dataset, "Failed to find `licenses` in dataset object."
   licenses = dataset['licenses']
   print("Inserting %d licenses" % (len(licenses),))
   if len(licenses) > 0:
+    num_inserted, num_duplicates = _insert_prepared(db, 'licenses', licenses, batch_size=batch_size, num_workers=num_workers)
+    _print_insert_summary('licenses', num_inserted, num_duplicates)
 
-    # Ensure the license ids are strings
-    for lic in licenses:
-      lic['id'] = str(lic['id'])
+def load_dataset_stream(db, dataset_path, normalize=False, batch_size=DEFAULT_BATCH_SIZE, num_workers=DEFAULT_NUM_WORKERS,
+                        resume=False, delta=False):
+  """ Load a COCO style dataset file without reading the whole file into memory.
+  The top level arrays are parsed incrementally and inserted in batches of `batch_size` documents.
 
-    try:
-      response = db.license.insert_many(licenses, ordered=False)
-      print("Successfully inserted %d licenses" % (len(response.inserted_ids),))
-    except BulkWriteError as bwe:
-      panic = filter(lambda x: x['code'] != DUPLICATE_KEY_ERROR_CODE, bwe.details['writeErrors'])
-      if len(panic) > 0:
-        raise
-      print("Attempted to insert duplicate licenses, %d new licenses inserted" % (bwe.details['nInserted'],))
+  With `resume`, the number of records of each array that have been committed is checkpointed
+  in the database as the load progresses. Loading the same (unmodified) file again skips the
+  committed records instead of sending them to the database again.
 
+  With `delta`, records are upserted by id, and only the records that are new or whose content
+  changed since they were last loaded are written (see `upsert_changed_documents`). Use this to
+  load a refreshed version of a dataset. Records that were removed from the file are not deleted.
+  Args:
+    db: A mongodb database handle.
+    dataset_path: Path to a COCO style dataset file.
+    normalize: Should the annotations be normalized by the width and height stored with the images?
+    batch_size: The maximum number of documents to send to the database in a single insert.
+    num_workers: The number of concurrent inserts.
+    resume: Checkpoint the load, and skip the records committed by a previous load of this file.
+    delta: Only write new and changed records.
+  """
+
+  print("Loading Dataset (streaming%s%s)" % (", resumable" if resume else "", ", delta" if delta else ""))
+
+  checkpoint = None
+  skip = collections.Counter()
+  if resume:
+    checkpoint = _load_checkpoint(db, dataset_path, normalize, delta)
+    if checkpoint['finished']:
+      print("This version of %s was already loaded" % (dataset_path,))
+      return
+    skip.update(checkpoint['committed'])
+
+  write_chunk = insert_documents
+  if delta:
+    write_chunk = functools.partial(upsert_changed_documents, db)
+
+  # The annotations can appear before the images in the file, so make a first pass to collect
+  # the image dimensions.
+  image_id_to_w_h = None
+  if normalize:
+    image_id_to_w_h = {}
+    with open(dataset_path) as f:
+      for _, image in iter_json_arrays(f, keys=['images']):
+        image_id_to_w_h[str(image['id'])] = (float(image['width']), float(image['height']))
+    print("Found dimensions for %d images" % (len(image_id_to_w_h),))
+
+  def prepared_batches(f):
+    """ Yield (key, batch) pairs where all documents in a batch come from the same top level array.
+    """
+    batch_key = None
+    batch = []
+    seen = collections.Counter()
+    for key, doc in iter_json_arrays(f, keys=DATASET_COLLECTIONS.keys()):
+      # Records are committed in file order, so the committed records are the first ones of each array.
+      seen[key] += 1
+      if seen[key] <= skip[key]:
+        continue
+      if key != batch_key or len(batch) >= batch_size:
+        if len(batch) > 0:
+          yield batch_key, _prepare_chunk(batch_key, batch, image_id_to_w_h)
+        batch_key = key
+        batch = []
+      batch.append(doc)
+    if len(batch) > 0:
+      yield batch_key, _prepare_chunk(batch_key, batch, image_id_to_w_h)
+
+  progress = {}
+  duplicates = collections.Counter()
+  inserter = None
+  inserter_key = None
+
+  def on_result(result):
+    progress[inserter_key].update(result.num_documents)
+    duplicates[inserter_key] += result.num_duplicates
+    if checkpoint is not None:
+      # Results arrive in submission order, so everything up to this chunk has been committed.
+      db[CHECKPOINT_COLLECTION].update_one({'_id' : checkpoint['_id']},
+                                           {'$inc' : {'committed.' + inserter_key : result.num_documents}})
+
+  try:
+    with open(dataset_path) as f:
+      for key, batch in prepared_batches(f):
+        if key != inserter_key:
+          if inserter is not None:
+            inserter.close()
+          # The same key can appear twice in a malformed file, keep accumulating its progress.
+          if key not in progress:
+            progress[key] = ProgressReporter(key)
+          inserter_key = key
+          inserter = BulkInserter(db[DATASET_COLLECTIONS[key][0]], num_workers=num_workers, on_result=on_result,
+                                  write_chunk=write_chunk)
+        inserter.submit(batch)
+    if inserter is not None:
+      inserter.close()
+  except Exception:
+    # e.g. a malformed file (ValueError) or record (KeyError, TypeError), or a failed write.
+    if inserter is not None:
+      inserter.abort()
+    raise
+
+  if checkpoint is not None:
+    db[CHECKPOINT_COLLECTION].update_one({'_id' : checkpoint['_id']},
+                                         {'$set' : {'finished' : True, 'finished_date' : str(datetime.datetime.now())}})
+
+  if 'categories' in progress:
+    invalidate_category_cache(db)
+
+  for key in DATASET_COLLECTIONS:
+    if skip[key] > 0:
+      print("Skipped %d %s committed by the previous load" % (skip[key], key))
+    if key not in progress:
+      if skip[key] == 0:
+        print("Found 0 %s" % (key,))
+      continue
+    progress[key].report(final=True)
+    if duplicates[key] > 0:
+      print("\tSkipped %d %s %s" % (duplicates[key], "unchanged" if delta else "duplicate", key))
+
+def _image_dimensions(db, batch_size=DEFAULT_BATCH_SIZE):
+  """ Build a compact image id to (width, height) lookup.
+  """
+  cursor = db.image.find(projection={'_id' : False, 'id' : True, 'width' : True, 'height' : True}, batch_size=batch_size)
+  return {image['id'] : (float(image['width']), float(image['height'])) for image in cursor}
 
 def export_dataset(db, denormalize=False):
 
@@ -218,15 +471,7 @@ def export_dataset(db, denormalize=False):
   if denormalize:
     image_id_to_w_h = {image['id'] : (float(image['width']), float(image['height']))
                          for image in images}
-
-    for anno in annotations:
-      image_width, image_height = image_id_to_w_h[anno['image_id']]
-      x, y, w, h = anno['bbox']
-      anno['bbox'] = [x * image_width, y * image_height, w * image_width, h * image_height]
-      if 'keypoints' in anno:
-        for pidx in range(0, len(anno['keypoints']), 3):
-          x, y = anno['keypoints'][pidx:pidx+2]
-          anno['keypoints'][pidx:pidx+2] = [x * image_width, y * image_height]
+    denormalize_annotations(annotations, image_id_to_w_h)
 
   licenses = list(db.license.find(projection={'_id' : False}))
   print("Found %d licenses" % (len(licenses),))
@@ -240,11 +485,366 @@ def export_dataset(db, denormalize=False):
 
   return dataset
 
+def export_dataset_stream(db, fileobj, denormalize=False, batch_size=DEFAULT_BATCH_SIZE):
+  """ Write the dataset to `fileobj` as it is read from the database. Produces the same data as
+  `json.dump(export_dataset(db, denormalize), fileobj)` without holding the dataset in memory.
+  Args:
+    db: A mongodb database handle.
+    fileobj: A file object opened for writing.
+    denormalize: Should the annotations be stored in image coordinates?
+    batch_size: The number of documents to fetch from the database per round trip.
+  """
+
+  print("Exporting Dataset (streaming)")
+
+  def find(collection):
+    return collection.find(projection={'_id' : False}, batch_size=batch_size)
+
+  def annotations():
+    if not denormalize:
+      return find(db.annotation)
+    # Only the image dimensions are needed to denormalize the annotations.
+    image_id_to_w_h = _image_dimensions(db, batch_size)
+    return (anno
+            for chunk in iter_batches(find(db.annotation), batch_size)
+            for anno in denormalize_annotations(chunk, image_id_to_w_h))
+
+  counts = write_json_arrays(fileobj, [
+    ('categories', find(db.category)),
+    ('annotations', annotations),
+    ('images', find(db.image)),
+    ('licenses', find(db.license))
+  ])
+
+  for key in ['categories', 'images', 'annotations', 'licenses']:
+    print("Exported %d %s" % (counts[key], key))
+
+def export_dataset_columnar(db, output_dir, denormalize=False, normalized=True, batch_size=DEFAULT_BATCH_SIZE):
+  """ Write the dataset to `output_dir` in the columnar format (see `annotation_tools.columnar`), which
+  training jobs can memory map instead of parsing json.
+  Args:
+    db: A mongodb database handle.
+    output_dir: The directory to write the dataset to.
+    denormalize: Should the annotations be stored in image coordinates?
+    normalized: Are the annotations in the database normalized (i.e. was it loaded with `normalize=True`)?
+      Recorded in the metadata, so that readers know whether to scale the coordinates.
+    batch_size: The number of documents to fetch from the database per round trip.
+  """
+  if denormalize and not normalized:
+    raise ValueError("The annotations are already in image coordinates, they can't be denormalized.")
+
+  print("Exporting Dataset (columnar)")
+
+  def find(collection):
+    return collection.find(projection={'_id' : False}, batch_size=batch_size)
+
+  writer = ColumnarWriter(list(find(db.category)), list(find(db.license)), normalized=normalized)
+  for image in find(db.image):
+    writer.add_image(image)
+  for anno in find(db.annotation):
+    writer.add_annotation(anno)
+  meta = writer.write(output_dir, denormalize=denormalize)
+
+  print("Exported %d categories" % (len(meta['categories']),))
+  print("Exported %d images" % (meta['num_images'],))
+  print("Exported %d annotations" % (meta['num_annotations'],))
+  print("Exported %d licenses" % (len(meta['licenses']),))
+
+################### Sharded Exports ######################
+
+SHARD_MANIFEST_FILE = 'manifest.json'
+# The order of the arrays in an exported dataset file.
+EXPORT_KEYS = ['categories', 'annotations', 'images', 'licenses']
+
+def shard_file_name(shard_index, num_shards):
+  return 'shard-%05d-of-%05d.json' % (shard_index, num_shards)
+
+# The $type aliases of the BSON types that image ids are split on. Range queries only match values
+# of the same type as the bounds (all numbers compare with each other).
+_ID_TYPE_ALIASES = [
+  ((int, float, Decimal128), 'number'),
+  ((str,), 'string'),
+  ((ObjectId,), 'objectId')
+]
+
+def _id_type_alias(value):
+  if isinstance(value, bool):
+    return None
+  for types, alias in _ID_TYPE_ALIASES:
+    if isinstance(value, types):
+      return alias
+  return None
+
+def image_id_boundaries(db, num_shards):
+  """ Split the sorted image ids into `num_shards` ranges of (roughly) equal size. The split ids are
+  found by skipping through the `id` index on the server, the ids are not read by this process.
+  Returns:
+    A list of (min_id, max_id) tuples, covering [min_id, max_id). The first range has no lower
+    bound and the last range has no upper bound (None). A single (None, None) range is returned
+    when the ids are not all of one type (e.g. a mix of numbers and strings), since a range
+    can't cover ids of different types.
+  """
+  num_images = db.image.count_documents({})
+  num_shards = max(1, min(num_shards, num_images))
+  if num_shards == 1:
+    return [(None, None)]
+
+  def id_at(position, sort_order=1, query=None):
+    image = db.image.find_one(query or {}, projection={'_id' : False, 'id' : True},
+                              sort=[('id', sort_order)], skip=position)
+    return image.get('id') if image is not None else None
+
+  # The ids are sorted by type first, so the ids are all of one type if the first and last are.
+  id_type = _id_type_alias(id_at(0))
+  if id_type is None or _id_type_alias(id_at(0, sort_order=-1)) != id_type:
+    print("The image ids are not all numbers or all strings, exporting a single shard")
+    return [(None, None)]
+
+  splits = []
+  previous_position = 0
+  for k in range(1, num_shards):
+    position = (num_images * k) // num_shards
+    # Skip from the previous split, so that the index is only walked once in total.
+    query = {'id' : {'$gte' : splits[-1]}} if splits else None
+    split = id_at(position - previous_position, query=query)
+    if split is None:
+      break
+    if not splits or split != splits[-1]:
+      splits.append(split)
+    previous_position = position
+  bounds = [None] + splits + [None]
+  return list(zip(bounds[:-1], bounds[1:]))
+
+def _id_range_query(field, min_id, max_id):
+  """ Match the `field` values in [min_id, max_id). The first range also matches the values that
+  are not of the type of its upper bound (e.g. annotations with the image id of a missing image).
+  """
+  query = {}
+  if min_id is not None:
+    query['$gte'] = min_id
+  if max_id is not None:
+    query['$lt'] = max_id
+  if not query:
+    return {}
+  if min_id is None:
+    return {'$or' : [{field : query}, {field : {'$not' : {'$type' : _id_type_alias(max_id)}}}]}
+  return {field : query}
+
+def export_shard(db, path, min_id, max_id, categories, licenses, denormalize=False, batch_size=DEFAULT_BATCH_SIZE):
+  """ Write the images with ids in [min_id, max_id) and their annotations to a COCO style dataset file
+  (with all of the categories and licenses). The annotations are found with the `annotation.image_id` index.
+  When denormalizing, the annotations of missing images can't be converted and are skipped.
+  Returns:
+    A dict with the number of elements of each array, the byte range of the elements of each array
+    within the file (so that shards can be concatenated without parsing them), and the number of
+    skipped annotations.
+  """
+  image_query = _id_range_query('id', min_id, max_id)
+  annotation_query = _id_range_query('image_id', min_id, max_id)
+  skipped = [0]
+
+  def find(collection, query):
+    return collection.find(query, projection={'_id' : False}, batch_size=batch_size)
+
+  annotations = find(db.annotation, annotation_query)
+  if denormalize:
+    image_id_to_w_h = {image['id'] : (float(image['width']), float(image['height']))
+                       for image in db.image.find(image_query, projection={'_id' : False, 'id' : True, 'width' : True, 'height' : True},
+                                                  batch_size=batch_size)}
+
+    def with_image(chunk):
+      kept = [anno for anno in chunk if anno.get('image_id') in image_id_to_w_h]
+      skipped[0] += len(chunk) - len(kept)
+      return kept
+
+    annotations = (anno
+                   for chunk in iter_batches(annotations, batch_size)
+                   for anno in denormalize_annotations(with_image(chunk), image_id_to_w_h))
+
+  arrays = {
+    'categories' : categories,
+    'annotations' : annotations,
+    'images' : find(db.image, image_query),
+    'licenses' : licenses
+  }
+  counts = {}
+  ranges = {}
+  # Write to a temporary file so that a shard file is always complete.
+  tmp_path = path + '.tmp'
+  with io.open(tmp_path, 'w', encoding='utf-8') as f:
+
+    def position():
+      f.flush()
+      return f.buffer.tell()
+
+    f.write(u'{')
+    for i, key in enumerate(EXPORT_KEYS):
+      if i > 0:
+        f.write(u',')
+      f.write(u'"%s":' % (key,))
+      start = position()
+      counts[key] = write_json_array(f, arrays[key])
+      # The elements are between the brackets.
+      ranges[key] = [start + 1, position() - 1]
+    f.write(u'}')
+  os.rename(tmp_path, path)
+
+  return {'counts' : counts, 'ranges' : ranges, 'skipped_annotations' : skipped[0]}
+
+# The database of each export worker process.
+_worker_db = None
+
+def _init_export_worker(mongo_uri):
+  """ Open a connection in each worker process, connections can't be shared across a fork.
+  """
+  global _worker_db
+  if mongo_uri is None:
+    _worker_db = connection.get_db()
+  else:
+    _worker_db = MongoClient(mongo_uri, **connection.client_options()).get_default_database()
+
+def _export_shard(job):
+  """ Process pool entry point. Returns (shard index, shard info).
+  """
+  shard_index, path, min_id, max_id, categories, licenses, denormalize, batch_size = job
+  return shard_index, export_shard(_worker_db, path, min_id, max_id, categories, licenses, denormalize, batch_size)
+
+def _export_shard_with_db(db, job):
+  """ Export a shard in this process.
+  """
+  shard_index, path, min_id, max_id, categories, licenses, denormalize, batch_size = job
+  return shard_index, export_shard(db, path, min_id, max_id, categories, licenses, denormalize, batch_size)
+
+def export_dataset_sharded(db, output_dir, denormalize=False, num_shards=None, num_processes=None,
+                           batch_size=DEFAULT_BATCH_SIZE, mongo_uri=None):
+  """ Export the dataset to `output_dir` as shard files, exported in parallel by a pool of processes.
+
+  The images are split into `num_shards` ranges of ids, and each shard file is a COCO style dataset
+  with the images of one range, their annotations, and all of the categories and licenses. A
+  manifest listing the shards is written once every shard is done. Use `merge_shards` to combine the
+  shards into one dataset file.
+  Args:
+    db: A mongodb database handle.
+    output_dir: The directory to write the shards to.
+    denormalize: Should the annotations be stored in image coordinates?
+    num_shards: The number of shards. Defaults to 4 shards per process, so that the processes stay busy
+      when some shards are slower than others.
+    num_processes: The number of processes. Defaults to the number of CPUs. With 1 process the shards
+      are exported one at a time with `db`.
+    batch_size: The number of documents to fetch from the database per round trip.
+    mongo_uri: The database of the worker processes. Defaults to the configured database (see `connection`).
+  Returns:
+    The manifest.
+  """
+  if num_processes is None:
+    num_processes = multiprocessing.cpu_count()
+  if num_shards is None:
+    num_shards = 4 * num_processes
+
+  print("Exporting Dataset (%d shards, %d processes)" % (num_shards, num_processes))
+
+  if not os.path.exists(output_dir):
+    os.makedirs(output_dir)
+  manifest_path = os.path.join(output_dir, SHARD_MANIFEST_FILE)
+  # A stale manifest would describe shard files that are about to be replaced.
+  if os.path.exists(manifest_path):
+    os.remove(manifest_path)
+
+  # Fork the workers before the database connection is opened.
+  pool = None
+  if num_processes > 1:
+    pool = multiprocessing.Pool(num_processes, initializer=_init_export_worker, initargs=(mongo_uri,))
+  try:
+    categories = list(db.category.find(projection={'_id' : False}))
+    licenses = list(db.license.find(projection={'_id' : False}))
+    bounds = image_id_boundaries(db, num_shards)
+    num_shards = len(bounds)
+    jobs = [(shard_index, os.path.join(output_dir, shard_file_name(shard_index, num_shards)), min_id, max_id,
+             categories, licenses, denormalize, batch_size)
+            for shard_index, (min_id, max_id) in enumerate(bounds)]
+
+    if pool is None:
+      results = (_export_shard_with_db(db, job) for job in jobs)
+    else:
+      results = pool.imap_unordered(_export_shard, jobs)
+
+    shards = [None] * num_shards
+    start_time = time.time()
+    for i, (shard_index, shard) in enumerate(results):
+      min_id, max_id = bounds[shard_index]
+      shard.update({'file' : shard_file_name(shard_index, num_shards), 'min_image_id' : min_id, 'max_image_id' : max_id})
+      shards[shard_index] = shard
+      print("Exported %d / %d shards (%.1f sec)" % (i + 1, num_shards, time.time() - start_time))
+    if pool is not None:
+      pool.close()
+  except BaseException:
+    # Stop the workers that are still exporting shards.
+    if pool is not None:
+      pool.terminate()
+    raise
+  finally:
+    if pool is not None:
+      pool.join()
+
+  # The image id bounds can be BSON types (e.g. ObjectIds), which are written as extended json.
+  manifest = {'num_shards' : num_shards, 'denormalize' : denormalize, 'shards' : shards}
+  with io.open(manifest_path, 'w', encoding='utf-8') as f:
+    f.write(serialization.dumps(manifest))
+
+  for key in ['categories', 'images', 'annotations', 'licenses']:
+    total = shards[0]['counts'][key] if key in ('categories', 'licenses') else sum(shard['counts'][key] for shard in shards)
+    print("Exported %d %s" % (total, key))
+  num_skipped = sum(shard['skipped_annotations'] for shard in shards)
+  if num_skipped > 0:
+    print("Skipped %d annotations of missing images" % (num_skipped,))
+  return manifest
+
+def _copy_range(src, dst, start, end, read_size=1 << 20):
+  src.seek(start)
+  remaining = end - start
+  while remaining > 0:
+    data = src.read(min(read_size, remaining))
+    if not data:
+      raise ValueError("Unexpected end of file in %s" % (src.name,))
+    dst.write(data)
+    remaining -= len(data)
+
+def merge_shards(shard_dir, output_path):
+  """ Combine the shards written by `export_dataset_sharded` into one COCO style dataset file. The
+  elements are copied byte for byte, without parsing them.
+  """
+  with io.open(os.path.join(shard_dir, SHARD_MANIFEST_FILE), encoding='utf-8') as f:
+    manifest = serialization.loads(f.read())
+  shards = manifest['shards']
+
+  with open(output_path, 'wb') as output:
+    output.write(b'{')
+    for i, key in enumerate(EXPORT_KEYS):
+      if i > 0:
+        output.write(b',')
+      output.write(('"%s":[' % (key,)).encode('utf-8'))
+      # Every shard has all of the categories and licenses.
+      key_shards = shards[:1] if key in ('categories', 'licenses') else shards
+      first = True
+      for shard in key_shards:
+        if shard['counts'][key] == 0:
+          continue
+        if not first:
+          output.write(b',')
+        first = False
+        start, end = shard['ranges'][key]
+        with open(os.path.join(shard_dir, shard['file']), 'rb') as src:
+          _copy_range(src, output, start, end)
+      output.write(b']')
+    output.write(b'}')
+
+  print("Merged %d shards into %s" % (len(shards), output_path))
+
 def parse_args():
 
   parser = argparse.ArgumentParser(description='Dataset loading and exporting utilities.')
 
-  parser.add_argument('-a', '--action', choices=['drop', 'load', 'export'], dest='action',
+  parser.add_argument('-a', '--action', choices=['drop', 'load', 'export', 'merge'], dest='action',
                       help='The action you would like to perform.', required=True)
 
   parser.add_argument('-d', '--dataset', dest='dataset_path',
@@ -255,12 +855,52 @@ def parse_args():
                         help='Normalize the annotations prior to inserting them into the database. Used with the `load` action.',
                         required=False, action='store_true', default=False)
 
+  parser.add_argument('-s', '--stream', dest='stream',
+                        help='Parse the dataset file incrementally and insert it in batches, keeping memory usage constant. Used with the `load` action.',
+                        required=False, action='store_true', default=False)
+
+  parser.add_argument('-b', '--batch_size', dest='batch_size',
+                        help='The number of documents to insert or fetch at a time. Used with the `load` and `export` actions.', type=int,
+                        required=False, default=DEFAULT_BATCH_SIZE)
+
+  parser.add_argument('-w', '--num_workers', dest='num_workers',
+                        help='The number of concurrent inserts. Used with the `load` action.', type=int,
+                        required=False, default=DEFAULT_NUM_WORKERS)
+
+  parser.add_argument('-r', '--resume', dest='resume',
+                        help='Checkpoint the load so that it can be resumed if it is interrupted, and skip the committed records when resuming. Implies --stream. Used with the `load` action.',
+                        required=False, action='store_true', default=False)
+
+  parser.add_argument('-i', '--delta', dest='delta',
+                        help='Only write the records that are new or that changed since they were last loaded. Implies --stream. Used with the `load` action.',
+                        required=False, action='store_true', default=False)
+
   parser.add_argument('-u', '--denormalize', dest='denormalize',
                         help='Denormalize the annotations when exporting the database. Used with the `export` action.',
                         required=False, action='store_true', default=False)
 
+  parser.add_argument('--image_coordinates', dest='image_coordinates',
+                        help='The annotations in the database are in image coordinates (it was loaded without --normalize). Used with the `export` action and the `columnar` format, which records it.',
+                        required=False, action='store_true', default=False)
+
   parser.add_argument('-o', '--output', dest='output_path',
-                        help='Save path for the json dataset. Used with the `export` action.', type=str,
+                        help='Save path for the json dataset (or directory for the columnar and sharded datasets). Used with the `export` and `merge` actions.', type=str,
+                        required=False)
+
+  parser.add_argument('-f', '--format', dest='format', choices=['json', 'columnar', 'shards'],
+                        help='Export format, `columnar` writes memory mappable arrays (see annotation_tools/columnar.py), `shards` exports ranges of images to separate json files in parallel. Used with the `export` action.',
+                        required=False, default='json')
+
+  parser.add_argument('--num_shards', dest='num_shards',
+                        help='The number of shards. Defaults to 4 per process. Used with the `export` action and the `shards` format.', type=int,
+                        required=False, default=None)
+
+  parser.add_argument('-p', '--num_processes', dest='num_processes',
+                        help='The number of export processes. Defaults to the number of CPUs. Used with the `export` action and the `shards` format.', type=int,
+                        required=False, default=None)
+
+  parser.add_argument('--shard_dir', dest='shard_dir',
+                        help='The directory of a sharded export to merge into one json dataset (--output). Used with the `merge` action.', type=str,
                         required=False)
 
 
@@ -275,14 +915,27 @@ def main():
   if action == 'drop':
     drop_dataset(db)
   elif action == 'load':
-    with open(args.dataset_path) as f:
-      dataset = json.load(f)
     ensure_dataset_indices(db)
-    load_dataset(db, dataset, normalize=args.normalize)
+    if args.stream or args.resume or args.delta:
+      load_dataset_stream(db, args.dataset_path, normalize=args.normalize,
+                          batch_size=args.batch_size, num_workers=args.num_workers,
+                          resume=args.resume, delta=args.delta)
+    else:
+      with open(args.dataset_path) as f:
+        dataset = json.load(f)
+      load_dataset(db, dataset, normalize=args.normalize,
+                   batch_size=args.batch_size, num_workers=args.num_workers)
+  elif action == 'merge':
+    merge_shards(args.shard_dir, args.output_path)
+  elif action == 'export' and args.format == 'shards':
+    export_dataset_sharded(db, args.output_path, denormalize=args.denormalize, num_shards=args.num_shards,
+                           num_processes=args.num_processes, batch_size=args.batch_size)
+  elif action == 'export' and args.format == 'columnar':
+    export_dataset_columnar(db, args.output_path, denormalize=args.denormalize, normalized=not args.image_coordinates,
+                            batch_size=args.batch_size)
   elif action == 'export':
-    dataset = export_dataset(db, denormalize=args.denormalize)
-    with open(args.output_path, 'w') as f:
-      json.dump(dataset, f)
+    with io.open(args.output_path, 'w', encoding='utf-8') as f:
+      export_dataset_stream(db, f, denormalize=args.denormalize, batch_size=args.batch_size)
 
 if __name__ == '__main__':
 
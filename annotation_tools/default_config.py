@@ -2,6 +2,72 @@
 Default configurations.
 """
 
+import os
+
 MONGO_HOST = 'localhost'
 MONGO_PORT = 27017
-MONGO_DBNAME = 'visipedia_annotation_toolkit'
\ No newline at end of file
+MONGO_DBNAME = 'visipedia_annotation_toolkit'
+
+# Connection pool for each web server process. Each request thread holds at most one connection
+# at a time, so MONGO_MAX_POOL_SIZE should be at least SERVER_THREADS (plus a few for the background
+# writer). A request that waits longer than MONGO_WAIT_QUEUE_TIMEOUT_MS for a connection fails
+# instead of piling up behind the others.
+MONGO_MAX_POOL_SIZE = 32
+MONGO_MIN_POOL_SIZE = 4
+MONGO_CONNECT_TIMEOUT_MS = 5000
+MONGO_SOCKET_TIMEOUT_MS = 30000
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 5000
+MONGO_WAIT_QUEUE_TIMEOUT_MS = 5000
+MONGO_READ_PREFERENCE = 'primary'
+
+# Production server (`python run.py --production`). The total number of concurrent requests is
+# SERVER_WORKERS * SERVER_THREADS. Workers get SERVER_GRACEFUL_TIMEOUT seconds to finish their
+# requests when the server is stopped.
+SERVER_WORKERS = 4
+SERVER_THREADS = 16
+SERVER_WORKER_CLASS = 'gthread'
+SERVER_TIMEOUT = 60
+SERVER_GRACEFUL_TIMEOUT = 30
+SERVER_KEEPALIVE = 5
+
+# Record request latencies and Mongo command timings, served from `/metrics` in the Prometheus text format.
+# The endpoint is not authenticated, only enable it where `/metrics` can't be reached publicly.
+METRICS_ENABLED = False
+# Log requests that take longer than this many seconds (None disables the log).
+SLOW_REQUEST_THRESHOLD = None
+
+# How often (in seconds) the web server checks whether the cached categories and task instructions are stale.
+CACHE_CHECK_INTERVAL = 5
+
+# Acknowledge bbox task results immediately and write them to the database from a background
+# thread, in batches. Results that can't be queued or written are spilled to BBOX_TASK_RESULT_SPILL_DIR.
+BBOX_TASK_RESULT_ASYNC = False
+BBOX_TASK_RESULT_QUEUE_SIZE = 10000
+BBOX_TASK_RESULT_BATCH_SIZE = 100
+BBOX_TASK_RESULT_FLUSH_INTERVAL = 0.5
+BBOX_TASK_RESULT_SPILL_DIR = os.path.join(os.path.expanduser('~'), '.visipedia_annotation_toolkit', 'spill')
+
+# Merge the boxes of the workers that saw an image into the `bbox_consensus` collection as task results
+# are written. Boxes of different workers with an IoU >= BBOX_CONSENSUS_IOU_THRESHOLD are clustered, and a
+# cluster is kept if at least BBOX_CONSENSUS_MIN_SUPPORT of the workers drew it.
+BBOX_CONSENSUS_ENABLED = True
+BBOX_CONSENSUS_IOU_THRESHOLD = 0.5
+BBOX_CONSENSUS_MIN_SUPPORT = 0.5
+
+# Workers get bbox tasks from `/bbox_task/next` (or `/bbox_task/lease`), which leases each task to at most
+# BBOX_TASK_REDUNDANCY different workers. A lease that isn't completed within BBOX_TASK_LEASE_DURATION
+# seconds is given to another worker.
+BBOX_TASK_REDUNDANCY = 1
+BBOX_TASK_LEASE_DURATION = 60 * 60
+
+# The number of image ids sent to the edit task page at a time. With `randomize=1`, the images are shuffled
+# within each page.
+EDIT_TASK_PAGE_SIZE = 500
+# The number of upcoming images that the edit and bbox task pages download in the background.
+IMAGE_PREFETCH_COUNT = 5
+
+# Serve the tiles precomputed by `python -m annotation_tools.tiles` from this directory. The editors load
+# only the visible tiles of the images that have them. None disables the tile routes.
+IMAGE_TILE_DIR = None
+# How long (in seconds) browsers may cache a tile.
+IMAGE_TILE_MAX_AGE = 365 * 24 * 60 * 60
@@ -0,0 +1,316 @@
+"""
+Background, batched writes for documents that arrive in bursts (e.g. bbox task results when a
+crowd batch launches).
+
+Request threads hand documents to a `BatchWriter` and return immediately. A background thread
+groups queued documents into `insert_many` batches. The queue is bounded: when it is full, a
+request thread waits up to `put_timeout` seconds and then appends its document to a local spill
+file instead. Batches that fail to insert (e.g. because Mongo is restarting) are also spilled.
+Spilled documents are inserted again once Mongo accepts writes, and when the writer starts.
+
+Documents that the database will never accept (e.g. invalid keys, documents over the size limit or
+failing validation) are appended to a quarantine file with the error instead, so that they are not
+retried forever and don't hold up the rest of their batch.
+
+Every document is given an `_id` when it is submitted, so a document that is written twice
+(e.g. after a partially successful batch) is ignored as a duplicate.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import errno
+import glob
+import logging
+import os
+import threading
+import time
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from annotation_tools import serialization
+from annotation_tools.bulk_insert import DUPLICATE_KEY_ERROR_CODE, insert_documents
+
+logger = logging.getLogger(__name__)
+
+SPILL_SUFFIX = '.jsonl'
+REPLAY_SUFFIX = '.replay'
+QUARANTINE_SUFFIX = '.quarantine'
+
+def _pid_is_running(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.EPERM
+  return True
+
+class BatchWriter(object):
+  """ Insert documents into a collection from a background thread, in batches.
+  """
+
+  def __init__(self, get_collection, spill_dir, max_queue_size=10000, batch_size=100,
+               flush_interval=0.5, put_timeout=1.0, retry_interval=5.0, on_written=None):
+    """
+    Args:
+      get_collection: A function returning the pymongo collection to insert into.
+      spill_dir: Directory for the spill files.
+      max_queue_size: The maximum number of documents waiting in memory.
+      batch_size: The maximum number of documents per insert.
+      flush_interval: The maximum number of seconds a document waits for its batch to fill up.
+      put_timeout: How long `submit` waits for room in the queue before spilling to disk.
+      retry_interval: How often (in seconds) spilled documents are retried.
+      on_written: An optional function called with each batch of documents after it is inserted.
+    """
+    self.get_collection = get_collection
+    self.spill_dir = spill_dir
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.put_timeout = put_timeout
+    self.retry_interval = retry_interval
+    self.on_written = on_written
+
+    self._queue = queue.Queue(maxsize=max_queue_size)
+    self._spill_lock = threading.Lock()
+    self._start_lock = threading.Lock()
+    self._stop = threading.Event()
+    self._thread = None
+    self._pid = None
+    self._next_retry = 0
+
+  @property
+  def spill_path(self):
+    """ Each process spills to its own file.
+    """
+    return os.path.join(self.spill_dir, '%s-%d%s' % (self.get_collection().name, os.getpid(), SPILL_SUFFIX))
+
+  @property
+  def quarantine_path(self):
+    """ The documents the database rejected, one {'error' : str, 'document' : dict} per line.
+    """
+    return os.path.join(self.spill_dir, '%s-%d%s' % (self.get_collection().name, os.getpid(), QUARANTINE_SUFFIX))
+
+  def start(self):
+    """ Start the background thread (again, if this process was forked after it started or the thread died).
+    """
+    with self._start_lock:
+      if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+        return
+      if not os.path.exists(self.spill_dir):
+        try:
+          os.makedirs(self.spill_dir)
+        except OSError as e:
+          if e.errno != errno.EEXIST:
+            raise
+      self._pid = os.getpid()
+      self._stop.clear()
+      self._thread = threading.Thread(target=self._run, name='BatchWriter')
+      self._thread.daemon = True
+      self._thread.start()
+
+  def submit(self, doc):
+    """ Queue a document to be inserted. The document is either queued in memory or durably spilled to disk
+    when this returns.
+    """
+    self.start()
+    if '_id' not in doc:
+      doc['_id'] = ObjectId()
+    try:
+      self._queue.put(doc, timeout=self.put_timeout)
+    except queue.Full:
+      logger.warning("Write queue is full, spilling a document to %s", self.spill_path)
+      self._spill([doc])
+
+  def close(self, timeout=30):
+    """ Stop the background thread after it has written (or spilled) the queued documents.
+    """
+    if self._thread is None or self._pid != os.getpid():
+      return
+    self._stop.set()
+    self._thread.join(timeout)
+    # Anything still queued (e.g. the thread timed out) goes to disk.
+    remaining = self._drain(block=False)
+    if len(remaining) > 0:
+      self._spill(remaining)
+    self._thread = None
+
+  def qsize(self):
+    return self._queue.qsize()
+
+  def _drain(self, block):
+    """ Get up to `batch_size` documents from the queue.
+    """
+    batch = []
+    if block:
+      try:
+        batch.append(self._queue.get(timeout=self.flush_interval))
+      except queue.Empty:
+        return batch
+      deadline = time.time() + self.flush_interval
+      while len(batch) < self.batch_size:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        try:
+          batch.append(self._queue.get(timeout=remaining))
+        except queue.Empty:
+          break
+    else:
+      while True:
+        try:
+          batch.append(self._queue.get_nowait())
+        except queue.Empty:
+          break
+    return batch
+
+  def _write(self, batch):
+    """ Insert a batch. Documents the database rejects are quarantined.
+    Returns:
+      False (after spilling the batch) if the database is unavailable.
+    """
+    try:
+      insert_documents(self.get_collection(), batch)
+      written = batch
+    except BulkWriteError as bwe:
+      # The other documents of the unordered insert were written.
+      rejected = {error['index'] : error for error in bwe.details['writeErrors']
+                  if error['code'] != DUPLICATE_KEY_ERROR_CODE}
+      self._quarantine([(batch[index], error.get('errmsg')) for index, error in sorted(rejected.items())])
+      written = [doc for index, doc in enumerate(batch) if index not in rejected]
+    except PyMongoError as e:
+      logger.warning("Failed to write %d documents (%s), spilling them to %s", len(batch), e, self.spill_path)
+      self._spill(batch)
+      return False
+    except Exception as e:
+      # e.g. bson's InvalidDocument and DocumentTooLarge, raised while encoding the batch (they are not
+      # PyMongoErrors). Write the documents one at a time to find the ones to quarantine.
+      if len(batch) > 1:
+        for i in range(len(batch)):
+          if not self._write(batch[i:i + 1]):
+            if i + 1 < len(batch):
+              self._spill(batch[i + 1:])
+            return False
+        return True
+      self._quarantine([(batch[0], '%s: %s' % (type(e).__name__, e))])
+      written = []
+
+    if self.on_written is not None and len(written) > 0:
+      try:
+        self.on_written(written)
+      except Exception:
+        logger.exception("on_written failed")
+    return True
+
+  def _run(self):
+    self._replay_spills()
+    while not self._stop.is_set() or not self._queue.empty():
+      batch = self._drain(block=not self._stop.is_set())
+      if len(batch) > 0:
+        try:
+          self._write(batch)
+        except Exception:
+          # Only raised when the batch couldn't be spilled either (e.g. the disk is full).
+          logger.exception("Lost %d documents", len(batch))
+      if time.time() >= self._next_retry:
+        self._replay_spills()
+
+  def _spill(self, docs):
+    """ Append documents to this process's spill file.
+    """
+    with self._spill_lock:
+      with open(self.spill_path, 'a') as f:
+        for doc in docs:
+          f.write(serialization.dumps(doc) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    self._next_retry = min(self._next_retry, time.time() + self.retry_interval)
+
+  def _quarantine(self, docs_and_errors):
+    """ Append the documents the database rejected, and why, to this process's quarantine file.
+    """
+    if len(docs_and_errors) == 0:
+      return
+    logger.error("The database rejected %d documents, moving them to %s", len(docs_and_errors), self.quarantine_path)
+    with self._spill_lock:
+      with open(self.quarantine_path, 'a') as f:
+        for doc, error in docs_and_errors:
+          f.write(serialization.dumps({'error' : error, 'document' : doc}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+  def _claim_spills(self):
+    """ Rename the spill files that can be replayed so that no other process replays them: this
+    process's own spill file, and the spill files left behind by processes that are not running.
+    This process's own replay files (left behind by a replay that failed) are retried as they are.
+    """
+    claimed = []
+    prefix = os.path.join(self.spill_dir, '%s-' % (self.get_collection().name,))
+    for path in glob.glob(prefix + '*'):
+      if path.endswith(SPILL_SUFFIX):
+        # <collection>-<pid>.jsonl
+        spill_file = path
+        owner_pid = path[len(prefix):-len(SPILL_SUFFIX)]
+      elif path.endswith(REPLAY_SUFFIX):
+        # <collection>-<pid>.jsonl.<claiming pid>.replay
+        spill_file, owner_pid = path[:-len(REPLAY_SUFFIX)].rsplit('.', 1)
+      else:
+        continue
+      try:
+        owner_pid = int(owner_pid)
+      except ValueError:
+        continue
+      if owner_pid != os.getpid() and _pid_is_running(owner_pid):
+        continue
+      if path.endswith(REPLAY_SUFFIX) and owner_pid == os.getpid():
+        claimed.append(path)
+        continue
+      claim_path = '%s.%d%s' % (spill_file, os.getpid(), REPLAY_SUFFIX)
+      with self._spill_lock:
+        try:
+          os.rename(path, claim_path)
+        except OSError:
+          continue # Another process claimed it first.
+      claimed.append(claim_path)
+    return claimed
+
+  def _replay_spills(self):
+    """ Insert the spilled documents. Documents that still can't be written are spilled again.
+    """
+    self._next_retry = time.time() + self.retry_interval
+    try:
+      claimed = self._claim_spills()
+    except Exception:
+      logger.exception("Failed to claim the spill files")
+      return
+    for path in claimed:
+      try:
+        self._replay_spill(path)
+      except Exception:
+        # The claimed file is kept, and retried by this process.
+        logger.exception("Failed to replay %s", path)
+
+  def _replay_spill(self, path):
+    docs = []
+    with open(path) as f:
+      for line in f:
+        if line.strip() == '':
+          continue
+        try:
+          docs.append(serialization.loads(line))
+        except ValueError:
+          # A process died while writing this line, so it was never acknowledged.
+          logger.warning("Skipping a truncated line in %s", path)
+    logger.info("Replaying %d spilled documents from %s", len(docs), path)
+    for i in range(0, len(docs), self.batch_size):
+      if not self._write(docs[i:i + self.batch_size]):
+        # The failed batch was spilled, spill the rest too and try again later.
+        if i + self.batch_size < len(docs):
+          self._spill(docs[i + self.batch_size:])
+        break
+    os.remove(path)
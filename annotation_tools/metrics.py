@@ -0,0 +1,221 @@
+"""
+Request and database instrumentation, exposed in the Prometheus text format.
+
+Each request records its latency, its request and response sizes, and the time it spent in Mongo,
+in serialization and in template rendering. Mongo commands are timed with pymongo command
+monitoring, so every query is counted, including the ones issued by the caches and the background
+writer.
+
+The metrics are kept in memory and are per process: when the server runs several worker processes,
+each one reports its own metrics (scrape each worker, or sum the series over the `pid` label).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import bisect
+import contextlib
+import os
+import threading
+import time
+
+from pymongo import monitoring
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values):
+  if len(names) == 0:
+    return ''
+  return '{' + ','.join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)) + '}'
+
+def _format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value))
+
+class Counter(object):
+  """ A monotonically increasing count for each combination of label values.
+  """
+
+  def __init__(self, name, documentation, label_names=()):
+    self.name = name
+    self.documentation = documentation
+    self.label_names = tuple(label_names)
+    self._lock = threading.Lock()
+    self._values = {}
+
+  def inc(self, label_values=(), amount=1):
+    with self._lock:
+      self._values[label_values] = self._values.get(label_values, 0) + amount
+
+  def expose(self):
+    lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s counter' % (self.name,)]
+    with self._lock:
+      values = sorted(self._values.items())
+    for label_values, value in values:
+      lines.append('%s%s %s' % (self.name, _format_labels(self.label_names, label_values), _format_value(value)))
+    return lines
+
+class Histogram(object):
+  """ Observations grouped into buckets, for each combination of label values.
+  """
+
+  def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+    self.name = name
+    self.documentation = documentation
+    self.label_names = tuple(label_names)
+    self.buckets = tuple(sorted(buckets))
+    self._lock = threading.Lock()
+    # label values -> [bucket counts (the last one is +Inf), sum]
+    self._values = {}
+
+  def observe(self, label_values, value):
+    i = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      entry = self._values.get(label_values)
+      if entry is None:
+        entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.]
+      entry[0][i] += 1
+      entry[1] += value
+
+  def expose(self):
+    lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % (self.name,)]
+    with self._lock:
+      values = sorted((label_values, (list(counts), total)) for label_values, (counts, total) in self._values.items())
+    label_names = self.label_names + ('le',)
+    for label_values, (counts, total) in values:
+      cumulative = 0
+      for upper_bound, count in zip(self.buckets + (float('inf'),), counts):
+        cumulative += count
+        labels = _format_labels(label_names, label_values + (_format_value(upper_bound),))
+        lines.append('%s_bucket%s %d' % (self.name, labels, cumulative))
+      labels = _format_labels(self.label_names, label_values)
+      lines.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+      lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+    return lines
+
+request_duration = Histogram('vat_request_duration_seconds',
+  'Time spent handling a request.', ('route', 'method', 'status'))
+request_phase_duration = Histogram('vat_request_phase_duration_seconds',
+  'Time a request spent in Mongo, serialization and template rendering.', ('route', 'phase'))
+request_mongo_commands = Histogram('vat_request_mongo_commands',
+  'Number of Mongo commands issued by a request.', ('route',), buckets=COUNT_BUCKETS)
+request_size = Histogram('vat_request_size_bytes',
+  'Size of the request body.', ('route',), buckets=SIZE_BUCKETS)
+response_size = Histogram('vat_response_size_bytes',
+  'Size of the response body.', ('route',), buckets=SIZE_BUCKETS)
+mongo_command_duration = Histogram('vat_mongo_command_duration_seconds',
+  'Time spent on a Mongo command.', ('command', 'collection'))
+mongo_command_failures = Counter('vat_mongo_command_failures_total',
+  'Number of failed Mongo commands.', ('command', 'collection'))
+
+ALL_METRICS = [
+  request_duration,
+  request_phase_duration,
+  request_mongo_commands,
+  request_size,
+  response_size,
+  mongo_command_duration,
+  mongo_command_failures
+]
+
+def expose():
+  """ Return all of the metrics in the Prometheus text format.
+  """
+  lines = []
+  for metric in ALL_METRICS:
+    lines.extend(metric.expose())
+  lines.append('# HELP vat_process_info The process that reported these metrics.')
+  lines.append('# TYPE vat_process_info gauge')
+  lines.append('vat_process_info{pid="%d"} 1' % (os.getpid(),))
+  return '\n'.join(lines) + '\n'
+
+################### Per Request Stats ######################
+
+class RequestStats(object):
+  """ The time spent in each phase of the current request.
+  """
+
+  def __init__(self):
+    self.start_time = time.time()
+    self.num_mongo_commands = 0
+    # phase -> seconds
+    self.phases = {'mongo' : 0., 'serialize' : 0., 'render' : 0.}
+
+  def add(self, phase, seconds):
+    self.phases[phase] = self.phases.get(phase, 0.) + seconds
+
+_local = threading.local()
+
+def start_request():
+  _local.stats = RequestStats()
+  return _local.stats
+
+def end_request():
+  stats = getattr(_local, 'stats', None)
+  _local.stats = None
+  return stats
+
+def current_request():
+  """ Return the stats of the request handled by this thread, or None.
+  """
+  return getattr(_local, 'stats', None)
+
+@contextlib.contextmanager
+def timed(phase):
+  """ Add the time spent in the block to `phase` of the current request.
+  """
+  start = time.time()
+  try:
+    yield
+  finally:
+    stats = current_request()
+    if stats is not None:
+      stats.add(phase, time.time() - start)
+
+################### Mongo Command Monitoring ######################
+
+class CommandTimer(monitoring.CommandListener):
+  """ Time every Mongo command, and charge it to the request that issued it.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # (connection id, request id) -> collection name
+    self._collections = {}
+
+  def started(self, event):
+    collection = event.command.get(event.command_name)
+    if not isinstance(collection, str):
+      collection = ''
+    with self._lock:
+      self._collections[(event.connection_id, event.request_id)] = collection
+
+  def _finished(self, event):
+    with self._lock:
+      collection = self._collections.pop((event.connection_id, event.request_id), '')
+    seconds = event.duration_micros / 1e6
+    mongo_command_duration.observe((event.command_name, collection), seconds)
+    # Synchronous commands are published on the thread that issued them.
+    stats = current_request()
+    if stats is not None:
+      stats.num_mongo_commands += 1
+      stats.add('mongo', seconds)
+    return collection
+
+  def succeeded(self, event):
+    self._finished(event)
+
+  def failed(self, event):
+    collection = self._finished(event)
+    mongo_command_failures.inc((event.command_name, collection))
+
+command_timer = CommandTimer()
@@ -0,0 +1,357 @@
+"""
+Quality assurance queries over the annotations, run as Mongo aggregations.
+
+Annotations are returned in `id` order and images in image id order, a page at a time: each
+page returns a cursor to pass as `after` to get the next page. An image page covers the next
+`limit` images of the `image` collection, so it can hold fewer results (even none) and still
+have a next page.
+
+Find small boxes:
+$ python -m annotation_tools.queries annotations --max_area 100 --output small_boxes.jsonl
+
+Find images with more than 50 instances:
+$ python -m annotation_tools.queries images --min_count 51
+
+Find annotations with visible keypoints outside of their bbox:
+$ python -m annotation_tools.queries annotations --keypoints_outside_bbox
+
+Count the instances and images of each category, with a histogram of the instance areas:
+$ python -m annotation_tools.queries histogram --area_boundaries 0 1024 9216
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import io
+import sys
+
+from annotation_tools import serialization
+from annotation_tools.connection import get_db
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# The annotation filters, and the type of their values.
+ANNOTATION_FILTERS = {
+  'category_id' : str,
+  'image_id' : str,
+  'min_area' : float,
+  'max_area' : float,
+  'min_relative_area' : float,
+  'max_relative_area' : float,
+  'min_aspect_ratio' : float,
+  'max_aspect_ratio' : float,
+  'keypoints_outside_bbox' : bool
+}
+
+# The image filters, and the type of their values.
+IMAGE_FILTERS = {
+  'category_id' : str,
+  'min_count' : int,
+  'max_count' : int
+}
+
+def _range(field, min_value, max_value):
+  condition = {}
+  if min_value is not None:
+    condition['$gte'] = min_value
+  if max_value is not None:
+    condition['$lte'] = max_value
+  return {field : condition} if len(condition) > 0 else {}
+
+def _expr_range(expression, min_value, max_value):
+  conditions = []
+  if min_value is not None:
+    conditions.append({'$gte' : [expression, min_value]})
+  if max_value is not None:
+    conditions.append({'$lte' : [expression, max_value]})
+  return conditions
+
+def _keypoints_outside_bbox_expr():
+  """ True if a visible keypoint (v > 0) of the annotation is outside of its bbox.
+  """
+  def element(offset):
+    return {'$arrayElemAt' : ['$keypoints', {'$add' : ['$$i', offset]}]}
+  x1, y1 = {'$arrayElemAt' : ['$bbox', 0]}, {'$arrayElemAt' : ['$bbox', 1]}
+  x2 = {'$add' : [x1, {'$arrayElemAt' : ['$bbox', 2]}]}
+  y2 = {'$add' : [y1, {'$arrayElemAt' : ['$bbox', 3]}]}
+  outside = {
+    '$filter' : {
+      'input' : {'$range' : [0, {'$size' : {'$ifNull' : ['$keypoints', []]}}, 3]},
+      'as' : 'i',
+      'cond' : {'$and' : [
+        {'$gt' : [element(2), 0]},
+        {'$or' : [
+          {'$lt' : [element(0), x1]}, {'$gt' : [element(0), x2]},
+          {'$lt' : [element(1), y1]}, {'$gt' : [element(1), y2]}
+        ]}
+      ]}
+    }
+  }
+  return {'$gt' : [{'$size' : outside}, 0]}
+
+def annotation_pipeline(category_id=None, image_id=None, min_area=None, max_area=None,
+                        min_relative_area=None, max_relative_area=None,
+                        min_aspect_ratio=None, max_aspect_ratio=None,
+                        keypoints_outside_bbox=False, after=None, limit=DEFAULT_PAGE_SIZE):
+  """ Build the aggregation pipeline for a page of annotations.
+  Args:
+    category_id: Only annotations of this category.
+    image_id: Only annotations of this image.
+    min_area, max_area: Range of the `area` field (in pixels).
+    min_relative_area, max_relative_area: Range of the bbox area as a fraction of the image area.
+    min_aspect_ratio, max_aspect_ratio: Range of the bbox width / height (in pixels). This joins
+      each candidate annotation with its image, so combine it with other filters when possible.
+    keypoints_outside_bbox: Only annotations with a visible keypoint outside of the bbox.
+    after: Only annotations whose id is greater than this (the cursor of the previous page).
+    limit: The page size.
+  """
+  # Equality and range filters on indexed fields come first, so that the server can use an index.
+  match = {}
+  if category_id is not None:
+    match['category_id'] = category_id
+  if image_id is not None:
+    match['image_id'] = image_id
+  match.update(_range('area', min_area, max_area))
+  if after is not None:
+    match['id'] = {'$gt' : after}
+
+  # Bboxes are stored normalized, so their area is a fraction of the image area.
+  relative_area = {'$multiply' : [{'$arrayElemAt' : ['$bbox', 2]}, {'$arrayElemAt' : ['$bbox', 3]}]}
+  expressions = _expr_range(relative_area, min_relative_area, max_relative_area)
+  if keypoints_outside_bbox:
+    expressions.append(_keypoints_outside_bbox_expr())
+  if len(expressions) > 0:
+    match['$expr'] = {'$and' : expressions}
+
+  # The (category_id, id, area) index serves this sort, the `id` index does without a category.
+  pipeline = [
+    {'$match' : match},
+    {'$sort' : {'id' : 1}}
+  ]
+
+  if min_aspect_ratio is not None or max_aspect_ratio is not None:
+    aspect_ratio = {'$divide' : [
+      {'$multiply' : [{'$arrayElemAt' : ['$bbox', 2]}, '$_image.width']},
+      {'$multiply' : [{'$arrayElemAt' : ['$bbox', 3]}, '$_image.height']}
+    ]}
+    pipeline += [
+      # Skip degenerate boxes rather than dividing by 0.
+      {'$match' : {'$expr' : {'$gt' : [{'$arrayElemAt' : ['$bbox', 3]}, 0]}}},
+      {'$lookup' : {'from' : 'image', 'localField' : 'image_id', 'foreignField' : 'id', 'as' : '_image'}},
+      {'$unwind' : '$_image'},
+      {'$match' : {'$expr' : {'$and' : _expr_range(aspect_ratio, min_aspect_ratio, max_aspect_ratio)}}},
+      {'$project' : {'_image' : False}}
+    ]
+
+  pipeline.append({'$limit' : limit})
+  return pipeline
+
+def image_pipeline(category_id=None, min_count=None, max_count=None, after=None, until=None, limit=DEFAULT_PAGE_SIZE):
+  """ Build the aggregation pipeline for a page of images, by their number of instances.
+  Args:
+    category_id: Only count the instances of this category.
+    min_count, max_count: Range of the number of instances. Images without instances are not returned.
+    after: Only images whose id is greater than this (the cursor of the previous page).
+    until: Only images whose id is less than or equal to this (the last image of the page), so
+      that only the instances of the page's images are grouped.
+    limit: The page size.
+  Returns a pipeline that produces {'image_id' : str, 'count' : int} documents.
+  """
+  match = {}
+  if category_id is not None:
+    match['category_id'] = category_id
+  match.update(_range('image_id', None, until))
+  if after is not None:
+    match.setdefault('image_id', {})['$gt'] = after
+  count_range = _range('count', min_count, max_count)
+  return [
+    {'$match' : match},
+    # Sorting on the indexed image id lets the server group the instances of an image together.
+    {'$sort' : {'image_id' : 1}},
+    {'$group' : {'_id' : '$image_id', 'count' : {'$sum' : 1}}},
+    {'$match' : count_range},
+    {'$sort' : {'_id' : 1}},
+    {'$limit' : limit},
+    {'$project' : {'_id' : False, 'image_id' : '$_id', 'count' : True}}
+  ]
+
+def category_count_pipeline():
+  """ Build the aggregation pipeline that counts the instances and images of each category.
+  Returns a pipeline that produces {'category_id', 'num_instances', 'num_images'} documents.
+  """
+  return [
+    {'$group' : {'_id' : {'category_id' : '$category_id', 'image_id' : '$image_id'}, 'count' : {'$sum' : 1}}},
+    {'$group' : {'_id' : '$_id.category_id', 'num_instances' : {'$sum' : '$count'}, 'num_images' : {'$sum' : 1}}},
+    {'$project' : {'_id' : False, 'category_id' : '$_id', 'num_instances' : True, 'num_images' : True}},
+    {'$sort' : {'category_id' : 1}}
+  ]
+
+def category_area_histogram_pipeline(area_boundaries):
+  """ Build the aggregation pipeline that counts the instances of each category in `area` buckets.
+  Bucket i > 0 holds the instances with boundaries[i - 1] <= area < boundaries[i] (the last bucket is
+  open ended). Bucket 0 holds the instances below the first boundary or without an area.
+  Returns a pipeline that produces {'category_id', 'bucket', 'count'} documents.
+  """
+  # The bucket of an instance is the number of boundaries that are <= its area.
+  bucket = {'$size' : {'$filter' : {'input' : list(area_boundaries), 'as' : 'b', 'cond' : {'$lte' : ['$$b', '$area']}}}}
+  return [
+    {'$group' : {'_id' : {'category_id' : '$category_id', 'bucket' : bucket}, 'count' : {'$sum' : 1}}},
+    {'$project' : {'_id' : False, 'category_id' : '$_id.category_id', 'bucket' : '$_id.bucket', 'count' : True}}
+  ]
+
+def find_annotations(db, after=None, limit=DEFAULT_PAGE_SIZE, **filters):
+  """ Return a page of annotations matching the filters (see `annotation_pipeline`), and the cursor
+  for the next page (None if this is the last page).
+  """
+  limit = min(limit, MAX_PAGE_SIZE)
+  annotations = list(db.annotation.aggregate(annotation_pipeline(after=after, limit=limit, **filters), allowDiskUse=True))
+  next_cursor = annotations[-1]['id'] if len(annotations) == limit else None
+  return annotations, next_cursor
+
+def find_images(db, after=None, limit=DEFAULT_PAGE_SIZE, **filters):
+  """ Return a page of {'image_id', 'count'} documents matching the filters (see `image_pipeline`),
+  and the cursor for the next page (None if this is the last page).
+
+  The page covers the next `limit` images (in id order), so it can hold fewer than `limit` results.
+  """
+  limit = min(limit, MAX_PAGE_SIZE)
+  query = {'id' : {'$gt' : after}} if after is not None else {}
+  page_image_ids = [image['id'] for image in
+                    db.image.find(query, projection={'_id' : False, 'id' : True}).sort('id', 1).limit(limit)]
+  if len(page_image_ids) == 0:
+    return [], None
+  pipeline = image_pipeline(after=after, until=page_image_ids[-1], limit=limit, **filters)
+  images = list(db.annotation.aggregate(pipeline, allowDiskUse=True))
+  next_cursor = page_image_ids[-1] if len(page_image_ids) == limit else None
+  return images, next_cursor
+
+def category_histogram(db, area_boundaries=None):
+  """ Return the instance and image counts of each category. With `area_boundaries`, each category
+  also gets `area_histogram`: the number of instances with boundaries[i] <= area < boundaries[i + 1].
+  """
+  histogram = list(db.annotation.aggregate(category_count_pipeline(), allowDiskUse=True))
+  if area_boundaries is not None:
+    category_id_to_doc = {doc['category_id'] : doc for doc in histogram}
+    for doc in histogram:
+      doc['area_histogram'] = [0] * len(area_boundaries)
+    for bucket in db.annotation.aggregate(category_area_histogram_pipeline(area_boundaries), allowDiskUse=True):
+      if bucket['bucket'] > 0:
+        category_id_to_doc[bucket['category_id']]['area_histogram'][bucket['bucket'] - 1] += bucket['count']
+  return histogram
+
+def iter_pages(find_page, db, after=None, page_size=DEFAULT_PAGE_SIZE, **filters):
+  """ Iterate over all of the results of `find_annotations` or `find_images`, a page at a time.
+  """
+  while True:
+    results, after = find_page(db, after=after, limit=page_size, **filters)
+    for result in results:
+      yield result
+    if after is None:
+      return
+
+def parse_filters(args, filter_types):
+  """ Convert the string values of request arguments to filter values.
+  Raises:
+    ValueError if a value can't be converted.
+  """
+  filters = {}
+  for name, value_type in filter_types.items():
+    if name not in args:
+      continue
+    if value_type is bool:
+      filters[name] = args[name].lower() in ('1', 'true', 'yes')
+    else:
+      try:
+        filters[name] = value_type(args[name])
+      except ValueError:
+        raise ValueError("Invalid `%s`: %s" % (name, args[name]))
+  return filters
+
+def parse_limit(value):
+  """ Convert the `limit` request argument to a page size, at most MAX_PAGE_SIZE.
+  Raises:
+    ValueError if it is not a positive integer.
+  """
+  if value is None:
+    return DEFAULT_PAGE_SIZE
+  try:
+    limit = int(value)
+  except ValueError:
+    limit = 0
+  if limit < 1:
+    raise ValueError("Invalid `limit`: %s, it must be a positive integer." % (value,))
+  return min(limit, MAX_PAGE_SIZE)
+
+def parse_args():
+
+  parser = argparse.ArgumentParser(description='Query the annotations.')
+  subparsers = parser.add_subparsers(dest='query')
+  subparsers.required = True
+
+  annotations = subparsers.add_parser('annotations', help='Find annotations by their bbox and keypoints.')
+  annotations.add_argument('--category_id', dest='category_id', type=str, default=None)
+  annotations.add_argument('--image_id', dest='image_id', type=str, default=None)
+  annotations.add_argument('--min_area', dest='min_area', type=float, default=None,
+                           help='Minimum `area` (in pixels).')
+  annotations.add_argument('--max_area', dest='max_area', type=float, default=None,
+                           help='Maximum `area` (in pixels).')
+  annotations.add_argument('--min_relative_area', dest='min_relative_area', type=float, default=None,
+                           help='Minimum bbox area, as a fraction of the image area.')
+  annotations.add_argument('--max_relative_area', dest='max_relative_area', type=float, default=None,
+                           help='Maximum bbox area, as a fraction of the image area.')
+  annotations.add_argument('--min_aspect_ratio', dest='min_aspect_ratio', type=float, default=None,
+                           help='Minimum bbox width / height.')
+  annotations.add_argument('--max_aspect_ratio', dest='max_aspect_ratio', type=float, default=None,
+                           help='Maximum bbox width / height.')
+  annotations.add_argument('--keypoints_outside_bbox', dest='keypoints_outside_bbox', action='store_true', default=False,
+                           help='Only annotations with a visible keypoint outside of their bbox.')
+
+  images = subparsers.add_parser('images', help='Find images by their number of instances.')
+  images.add_argument('--category_id', dest='category_id', type=str, default=None)
+  images.add_argument('--min_count', dest='min_count', type=int, default=None)
+  images.add_argument('--max_count', dest='max_count', type=int, default=None)
+
+  histogram = subparsers.add_parser('histogram', help='Count the instances and images of each category.')
+  histogram.add_argument('--area_boundaries', dest='area_boundaries', type=float, nargs='+', default=None,
+                         help='Also count the instances of each category in these `area` buckets.')
+
+  for subparser in [annotations, images]:
+    subparser.add_argument('--page_size', dest='page_size', type=int, default=MAX_PAGE_SIZE,
+                           help='Number of results (images for the `images` query) fetched per round trip.')
+
+  for subparser in [annotations, images, histogram]:
+    subparser.add_argument('-o', '--output', dest='output_path', type=str, default=None,
+                           help='Write the results to this file (one json document per line) instead of stdout.')
+
+  return parser.parse_args()
+
+def main():
+
+  args = parse_args()
+  db = get_db()
+
+  if args.query == 'annotations':
+    filters = {name : getattr(args, name) for name in ANNOTATION_FILTERS}
+    results = iter_pages(find_annotations, db, page_size=args.page_size, **filters)
+  elif args.query == 'images':
+    filters = {name : getattr(args, name) for name in IMAGE_FILTERS}
+    results = iter_pages(find_images, db, page_size=args.page_size, **filters)
+  else:
+    results = category_histogram(db, args.area_boundaries)
+
+  output = io.open(args.output_path, 'w', encoding='utf-8') if args.output_path is not None else sys.stdout
+  try:
+    count = 0
+    for result in results:
+      output.write(serialization.dumps(result) + '\n')
+      count += 1
+  finally:
+    if output is not sys.stdout:
+      output.close()
+  print("Found %d results" % (count,), file=sys.stderr)
+
+if __name__ == '__main__':
+  main()
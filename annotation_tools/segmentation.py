@@ -0,0 +1,612 @@
+"""
+Vectorized COCO segmentation utilities: RLE encoding and decoding, polygon rasterization, mask
+areas, mask bboxes and mask IoU, without a C extension.
+
+A segmentation is either a list of polygons ([[x1, y1, x2, y2, ...], ...] in pixels) or a run
+length encoded mask (RLE): {"size" : [height, width], "counts" : [int, ...] or str}. The runs
+alternate between background and foreground pixels (starting with background) in column major
+order, and the string form of `counts` is the compressed encoding used by the COCO API.
+
+Masks are processed in batches: the foreground runs of every mask of a batch are held in flat
+arrays, and areas, bboxes and intersections are computed from the runs with a few array
+operations, so the full masks are never materialized. Polygons are rasterized column by column
+straight to runs. A pixel is inside a polygon if its center is (even-odd rule), so the areas can
+differ from the COCO API's rasterization by a fraction of the polygon's perimeter.
+
+Recompute the areas of the annotations that are already in the database:
+$ python -m annotation_tools.segmentation
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import math
+
+import numpy as np
+from pymongo import UpdateOne
+
+from annotation_tools.array_utils import concat_ranges
+from annotation_tools.connection import get_db
+from annotation_tools.stream_utils import iter_batches, ProgressReporter
+
+DEFAULT_BATCH_SIZE = 1000
+
+# The compressed counts use 5 bits per character, 6 with the continuation bit. The deltas of
+# int64 counts need at most 13 characters.
+_MAX_CHARS_PER_COUNT = 13
+
+def _segment_cumsum(values, segment_starts):
+  """ Cumulative sums of `values` that restart at each True of `segment_starts`.
+  """
+  if len(values) == 0:
+    return values
+  totals = np.cumsum(values)
+  # The total before the start of each value's segment.
+  start_idxs = np.flatnonzero(segment_starts)
+  before = totals[start_idxs] - values[start_idxs]
+  segment_ids = np.cumsum(segment_starts) - 1
+  return totals - before[segment_ids]
+
+################## Compressed Counts ##################
+
+def decode_counts_strings(strings):
+  """ Decode a batch of compressed RLE count strings.
+  Args:
+    strings: A list of compressed count strings (or utf-8 bytes).
+  Returns:
+    (counts, offsets): The concatenated counts (int64) and the offsets of each string's counts.
+  """
+  strings = [s.encode('ascii') if not isinstance(s, bytes) else s for s in strings]
+  byte_offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+  np.cumsum([len(s) for s in strings], out=byte_offsets[1:])
+  chars = np.frombuffer(b''.join(strings), dtype=np.uint8).astype(np.int64) - 48
+
+  # A count ends at the first character without the continuation bit.
+  ends = (chars & 0x20) == 0
+  end_idxs = np.flatnonzero(ends)
+  start_idxs = np.concatenate([[0], end_idxs + 1])[:-1].astype(np.int64)
+  count_lengths = end_idxs - start_idxs + 1
+  shifts = 5 * (np.arange(len(chars), dtype=np.int64) - np.repeat(start_idxs, count_lengths))
+  deltas = np.add.reduceat((chars & 0x1f) << shifts, start_idxs) if len(chars) > 0 else np.zeros(0, dtype=np.int64)
+  # The last character of a negative delta has its sign bit set.
+  negative = (chars[end_idxs] & 0x10) != 0
+  deltas[negative] -= np.left_shift(1, 5 * count_lengths[negative])
+
+  ends_before = np.concatenate([[0], np.cumsum(ends)]).astype(np.int64)
+  offsets = ends_before[byte_offsets]
+
+  # counts[m] = delta[m] + counts[m - 2] for m > 2, i.e. the background and the foreground runs are
+  # each a cumulative sum, starting at the third and the second count.
+  m = np.arange(len(deltas), dtype=np.int64) - np.repeat(offsets[:-1], np.diff(offsets))
+  counts = np.empty_like(deltas)
+  for parity, first in ((0, 2), (1, 1)):
+    idxs = np.flatnonzero((m % 2 == parity) & (m >= first))
+    counts[idxs] = _segment_cumsum(deltas[idxs], m[idxs] == first)
+  counts[m == 0] = deltas[m == 0]
+  return counts, offsets
+
+def encode_counts_strings(counts, offsets):
+  """ Compress a batch of RLE counts, the inverse of `decode_counts_strings`.
+  Args:
+    counts: The concatenated counts.
+    offsets: The offsets of each mask's counts.
+  Returns:
+    A list of compressed count strings.
+  """
+  counts = np.asarray(counts, dtype=np.int64)
+  offsets = np.asarray(offsets, dtype=np.int64)
+  m = np.arange(len(counts), dtype=np.int64) - np.repeat(offsets[:-1], np.diff(offsets))
+  deltas = counts.copy()
+  idxs = np.flatnonzero(m > 2)
+  deltas[idxs] -= counts[idxs - 2]
+
+  # Emit 5 bits per character, for all of the counts at once.
+  chars = np.zeros((len(deltas), _MAX_CHARS_PER_COUNT), dtype=np.uint8)
+  num_chars = np.zeros(len(deltas), dtype=np.int64)
+  active = np.ones(len(deltas), dtype=bool)
+  x = deltas
+  for k in range(_MAX_CHARS_PER_COUNT):
+    c = x & 0x1f
+    x = x >> 5
+    more = np.where((c & 0x10) != 0, x != -1, x != 0)
+    chars[:, k] = np.where(more, c | 0x20, c) + 48
+    num_chars += active
+    active &= more
+    if not active.any():
+      break
+
+  data = chars[np.arange(chars.shape[1]) < num_chars[:, None]].tobytes().decode('ascii')
+  char_offsets = np.concatenate([[0], np.cumsum(num_chars)]).astype(np.int64)[offsets]
+  return [data[start:end] for start, end in zip(char_offsets[:-1].tolist(), char_offsets[1:].tolist())]
+
+def decode_counts(string):
+  """ Decode one compressed RLE count string to a list of counts.
+  """
+  counts, _ = decode_counts_strings([string])
+  return counts.tolist()
+
+def encode_counts(counts):
+  """ Compress one list of RLE counts.
+  """
+  return encode_counts_strings(counts, [0, len(counts)])[0]
+
+#################################################
+
+################## Mask Batches ##################
+
+def is_rle(segmentation):
+  return isinstance(segmentation, dict)
+
+class MaskBatch(object):
+  """ The foreground runs of a batch of masks.
+
+  Run `i` of the batch covers the column major pixel indices [starts[i], ends[i]) of its mask, the
+  runs of mask `j` are runs[offsets[j]:offsets[j + 1]], sorted and disjoint.
+  """
+
+  def __init__(self, heights, widths, starts, ends, offsets):
+    self.heights = np.asarray(heights, dtype=np.int64)
+    self.widths = np.asarray(widths, dtype=np.int64)
+    self.starts = np.asarray(starts, dtype=np.int64)
+    self.ends = np.asarray(ends, dtype=np.int64)
+    self.offsets = np.asarray(offsets, dtype=np.int64)
+
+  def __len__(self):
+    return len(self.heights)
+
+  @classmethod
+  def from_counts(cls, heights, widths, counts, offsets):
+    """ Build a batch from concatenated (uncompressed) RLE counts.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    m = np.arange(len(counts), dtype=np.int64) - np.repeat(offsets[:-1], np.diff(offsets))
+    # The pixel index at the end of each count, within its mask.
+    positions = _segment_cumsum(counts, m == 0)
+    foreground = np.flatnonzero((m % 2 == 1) & (counts > 0))
+    ends = positions[foreground]
+    starts = ends - counts[foreground]
+    run_offsets = np.searchsorted(foreground, offsets)
+    return cls(heights, widths, starts, ends, run_offsets)
+
+  def counts(self):
+    """ Returns:
+      (counts, offsets): The concatenated RLE counts of the masks and the offsets of each mask's counts.
+    """
+    num_runs = np.diff(self.offsets)
+    mask_idxs = np.repeat(np.arange(len(self), dtype=np.int64), num_runs)
+    first = np.zeros(len(self.starts), dtype=bool)
+    first[self.offsets[:-1][num_runs > 0]] = True
+    previous_ends = np.concatenate([[0], self.ends[:-1]]).astype(np.int64)
+    previous_ends[first] = 0
+
+    last_ends = np.zeros(len(self), dtype=np.int64)
+    last_ends[num_runs > 0] = self.ends[self.offsets[1:][num_runs > 0] - 1]
+    trailing = self.heights * self.widths - last_ends
+
+    # Each run adds (background count, foreground count), and masks that don't end with a foreground
+    # pixel end with a background count.
+    num_counts = 2 * num_runs + (trailing > 0)
+    count_offsets = np.zeros(len(self) + 1, dtype=np.int64)
+    np.cumsum(num_counts, out=count_offsets[1:])
+    counts = np.empty(count_offsets[-1], dtype=np.int64)
+    run_positions = count_offsets[:-1][mask_idxs] + 2 * (np.arange(len(self.starts), dtype=np.int64) - self.offsets[:-1][mask_idxs])
+    counts[run_positions] = self.starts - previous_ends
+    counts[run_positions + 1] = self.ends - self.starts
+    counts[count_offsets[1:][trailing > 0] - 1] = trailing[trailing > 0]
+    return counts, count_offsets
+
+  def to_rles(self):
+    """ Returns:
+      The masks as RLE dicts with compressed counts.
+    """
+    counts, offsets = self.counts()
+    strings = encode_counts_strings(counts, offsets)
+    return [{'size' : [h, w], 'counts' : s} for h, w, s in zip(self.heights.tolist(), self.widths.tolist(), strings)]
+
+  def area(self):
+    """ Returns:
+      The number of foreground pixels of each mask (int64).
+    """
+    lengths = self.ends - self.starts
+    totals = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    return totals[self.offsets[1:]] - totals[self.offsets[:-1]]
+
+  def bbox(self):
+    """ Returns:
+      The [x, y, width, height] bbox (in pixels) of each mask, as a float64 array of shape (N, 4).
+      Empty masks have an all zero bbox.
+    """
+    bboxes = np.zeros((len(self), 4), dtype=np.float64)
+    nonempty = np.flatnonzero(np.diff(self.offsets) > 0)
+    if len(nonempty) == 0:
+      return bboxes
+
+    heights = np.repeat(self.heights, np.diff(self.offsets))
+    last = self.ends - 1
+    x1 = self.starts // heights
+    x2 = last // heights
+    # A run that wraps around to the next column covers every row.
+    wraps = x1 < x2
+    y1 = np.where(wraps, 0, self.starts % heights)
+    y2 = np.where(wraps, heights - 1, last % heights)
+
+    run_offsets = self.offsets[:-1][nonempty]
+    min_x = np.minimum.reduceat(x1, run_offsets)
+    max_x = np.maximum.reduceat(x2, run_offsets)
+    min_y = np.minimum.reduceat(y1, run_offsets)
+    max_y = np.maximum.reduceat(y2, run_offsets)
+    bboxes[nonempty] = np.stack([min_x, min_y, max_x - min_x + 1, max_y - min_y + 1], axis=1)
+    return bboxes
+
+  def _covered(self, mask_idx, positions):
+    """ The number of foreground pixels of mask `mask_idx` before each of `positions`.
+    """
+    start, end = self.offsets[mask_idx], self.offsets[mask_idx + 1]
+    starts = self.starts[start:end]
+    lengths = self.ends[start:end] - starts
+    if len(starts) == 0:
+      return np.zeros(len(positions), dtype=np.int64)
+    before = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    run_idxs = np.searchsorted(starts, positions, side='right') - 1
+    clipped = np.maximum(run_idxs, 0)
+    partial = np.clip(positions - starts[clipped], 0, lengths[clipped])
+    return np.where(run_idxs >= 0, before[clipped] + partial, 0)
+
+  def iou(self, other, iscrowd=None):
+    """ The intersection over union of each mask of this batch with each mask of `other`.
+    Args:
+      other: A MaskBatch with masks of the same sizes.
+      iscrowd: Optional flags for the masks of `other`. As in the COCO API, the union with a crowd
+        mask is the area of the mask of this batch.
+    Returns:
+      A float64 array of shape (len(self), len(other)).
+    """
+    ious = np.zeros((len(self), len(other)), dtype=np.float64)
+    if len(self) == 0 or len(other) == 0:
+      return ious
+
+    areas = self.area()
+    other_areas = other.area()
+    other_num_runs = np.diff(other.offsets)
+    nonempty = np.flatnonzero(other_num_runs > 0)
+    run_offsets = other.offsets[:-1][nonempty]
+    crowd = np.zeros(len(other), dtype=bool) if iscrowd is None else np.asarray(iscrowd, dtype=bool)
+    for i in range(len(self)):
+      same_size = (other.heights == self.heights[i]) & (other.widths == self.widths[i])
+      intersection = np.zeros(len(other), dtype=np.int64)
+      if len(nonempty) > 0:
+        # The foreground of mask i within each run of the other masks.
+        overlap = self._covered(i, other.ends) - self._covered(i, other.starts)
+        intersection[nonempty] = np.add.reduceat(overlap, run_offsets)
+      intersection[~same_size] = 0
+      union = np.where(crowd, areas[i], areas[i] + other_areas - intersection)
+      ious[i] = np.where(union > 0, intersection / np.maximum(union, 1), 0)
+    return ious
+
+def _polygon_size(polygons):
+  """ The (height, width) that covers the polygons, for when the image size is unknown.
+  """
+  xs = [x for polygon in polygons for x in polygon[0::2]]
+  ys = [y for polygon in polygons for y in polygon[1::2]]
+  if len(xs) == 0:
+    return 0, 0
+  return max(int(math.ceil(max(ys))), 0), max(int(math.ceil(max(xs))), 0)
+
+def _rasterize_polygons(polygon_lists, heights, widths):
+  """ Rasterize a batch of masks, each the union of a list of polygons, straight to runs.
+
+  Each polygon edge crosses the vertical lines through the centers of the columns it spans. In each
+  column, the pixels between consecutive pairs of crossings are inside the polygon, which gives
+  one run per pair.
+  """
+  heights = np.asarray(heights, dtype=np.int64)
+  widths = np.asarray(widths, dtype=np.int64)
+  polygons = [np.asarray(polygon, dtype=np.float64) for polygon_list in polygon_lists for polygon in polygon_list]
+  polygon_masks = np.repeat(np.arange(len(polygon_lists), dtype=np.int64), [len(p) for p in polygon_lists])
+  polygons_and_masks = [(p, mask_idx) for p, mask_idx in zip(polygons, polygon_masks.tolist()) if len(p) >= 6]
+  if len(polygons_and_masks) == 0:
+    return MaskBatch(heights, widths, [], [], np.zeros(len(polygon_lists) + 1, dtype=np.int64))
+
+  num_vertices = np.array([len(p) // 2 for p, _ in polygons_and_masks], dtype=np.int64)
+  points = np.concatenate([p[:2 * (len(p) // 2)] for p, _ in polygons_and_masks]).reshape(-1, 2)
+  edge_polygons = np.repeat(np.arange(len(num_vertices), dtype=np.int64), num_vertices)
+  vertex_offsets = np.concatenate([[0], np.cumsum(num_vertices)]).astype(np.int64)
+  # Each vertex is joined to the next, and the last one to the first.
+  next_idxs = np.arange(1, len(points) + 1, dtype=np.int64)
+  next_idxs[vertex_offsets[1:] - 1] = vertex_offsets[:-1]
+  x0, y0 = points[:, 0], points[:, 1]
+  x1, y1 = points[next_idxs, 0], points[next_idxs, 1]
+
+  # The columns whose centers are in [min(x0, x1), max(x0, x1)).
+  first_cols = np.ceil(np.minimum(x0, x1) - 0.5).astype(np.int64)
+  num_cols = np.maximum(np.ceil(np.maximum(x0, x1) - 0.5).astype(np.int64) - first_cols, 0)
+  edge_idxs = np.repeat(np.arange(len(x0), dtype=np.int64), num_cols)
+  cols = concat_ranges(first_cols, num_cols)
+  slopes = (y1 - y0)[edge_idxs] / (x1 - x0)[edge_idxs]
+  ys = y0[edge_idxs] + (cols + 0.5 - x0[edge_idxs]) * slopes
+
+  crossing_polygons = edge_polygons[edge_idxs]
+  crossing_masks = np.array([mask_idx for _, mask_idx in polygons_and_masks], dtype=np.int64)[crossing_polygons]
+  # Every column of a closed polygon is crossed an even number of times, so dropping whole columns
+  # keeps the crossings paired.
+  keep = (cols >= 0) & (cols < widths[crossing_masks])
+  cols, ys, crossing_polygons, crossing_masks = cols[keep], ys[keep], crossing_polygons[keep], crossing_masks[keep]
+  order = np.lexsort((ys, cols, crossing_polygons))
+  cols, ys, crossing_masks = cols[order], ys[order], crossing_masks[order]
+  cols, crossing_masks = cols[0::2], crossing_masks[0::2]
+  mask_heights = heights[crossing_masks]
+  # The rows whose centers are in [y_in, y_out).
+  row_starts = np.clip(np.ceil(ys[0::2] - 0.5), 0, mask_heights).astype(np.int64)
+  row_ends = np.clip(np.ceil(ys[1::2] - 0.5), 0, mask_heights).astype(np.int64)
+  nonempty = row_ends > row_starts
+
+  # Merge the runs of the polygons of each mask. The masks are laid out one after the other with a
+  # gap, so that runs of different masks never touch.
+  mask_bases = np.zeros(len(polygon_lists) + 1, dtype=np.int64)
+  np.cumsum(heights * widths + 1, out=mask_bases[1:])
+  run_masks = crossing_masks[nonempty]
+  run_bases = mask_bases[run_masks]
+  starts = run_bases + cols[nonempty] * mask_heights[nonempty] + row_starts[nonempty]
+  ends = run_bases + cols[nonempty] * mask_heights[nonempty] + row_ends[nonempty]
+  order = np.argsort(starts, kind='stable')
+  starts, ends, run_masks = starts[order], ends[order], run_masks[order]
+  if len(starts) > 0:
+    max_ends = np.maximum.accumulate(ends)
+    new_runs = np.concatenate([[True], starts[1:] > max_ends[:-1]])
+    run_idxs = np.flatnonzero(new_runs)
+    ends = np.maximum.reduceat(ends, run_idxs)
+    starts = starts[run_idxs]
+    run_masks = run_masks[run_idxs]
+  offsets = np.searchsorted(run_masks, np.arange(len(polygon_lists) + 1, dtype=np.int64))
+  return MaskBatch(heights, widths, starts - mask_bases[run_masks], ends - mask_bases[run_masks], offsets)
+
+def mask_batch(segmentations, sizes=None):
+  """ Convert a batch of segmentations to a MaskBatch.
+  Args:
+    segmentations: A list of segmentations, lists of polygons or RLE dicts (compressed or not).
+    sizes: The (height, width) of the image of each segmentation, used to rasterize the polygons.
+      RLEs have their own size. If a size is None then the polygons are rasterized on a canvas
+      that covers them.
+  Returns:
+    A MaskBatch, with the masks in the order of `segmentations`.
+  """
+  if sizes is None:
+    sizes = [None] * len(segmentations)
+  heights = np.zeros(len(segmentations), dtype=np.int64)
+  widths = np.zeros(len(segmentations), dtype=np.int64)
+
+  string_idxs, strings = [], []
+  list_idxs, lists = [], []
+  polygon_idxs, polygon_lists = [], []
+  for i, (segmentation, size) in enumerate(zip(segmentations, sizes)):
+    if is_rle(segmentation):
+      heights[i], widths[i] = segmentation['size']
+      if isinstance(segmentation['counts'], list):
+        list_idxs.append(i)
+        lists.append(segmentation['counts'])
+      else:
+        string_idxs.append(i)
+        strings.append(segmentation['counts'])
+    else:
+      if size is None:
+        size = _polygon_size(segmentation)
+      heights[i], widths[i] = size
+      polygon_idxs.append(i)
+      polygon_lists.append(segmentation)
+
+  # Build a batch for each kind of segmentation and interleave them back in order.
+  parts = []
+  if len(strings) > 0:
+    counts, offsets = decode_counts_strings(strings)
+    parts.append((string_idxs, MaskBatch.from_counts(heights[string_idxs], widths[string_idxs], counts, offsets)))
+  if len(lists) > 0:
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(counts) for counts in lists], out=offsets[1:])
+    counts = np.fromiter((c for counts in lists for c in counts), dtype=np.int64, count=offsets[-1])
+    parts.append((list_idxs, MaskBatch.from_counts(heights[list_idxs], widths[list_idxs], counts, offsets)))
+  if len(polygon_lists) > 0:
+    parts.append((polygon_idxs, _rasterize_polygons(polygon_lists, heights[polygon_idxs], widths[polygon_idxs])))
+  if len(parts) == 1 and len(parts[0][0]) == len(segmentations):
+    return parts[0][1]
+
+  num_runs = np.zeros(len(segmentations), dtype=np.int64)
+  for idxs, batch in parts:
+    num_runs[idxs] = np.diff(batch.offsets)
+  offsets = np.zeros(len(segmentations) + 1, dtype=np.int64)
+  np.cumsum(num_runs, out=offsets[1:])
+  starts = np.zeros(offsets[-1], dtype=np.int64)
+  ends = np.zeros(offsets[-1], dtype=np.int64)
+  for idxs, batch in parts:
+    positions = concat_ranges(offsets[:-1][idxs], num_runs[idxs])
+    starts[positions] = batch.starts
+    ends[positions] = batch.ends
+  return MaskBatch(heights, widths, starts, ends, offsets)
+
+def encode(mask):
+  """ Run length encode a binary mask of shape (height, width).
+  Returns:
+    An RLE dict with compressed counts.
+  """
+  mask = np.asarray(mask)
+  h, w = mask.shape
+  pixels = np.concatenate([[0], mask.ravel(order='F') != 0, [0]]).astype(np.int8)
+  changes = np.flatnonzero(np.diff(pixels))
+  batch = MaskBatch([h], [w], changes[0::2], changes[1::2], [0, len(changes) // 2])
+  return batch.to_rles()[0]
+
+def decode(rle):
+  """ Decode an RLE dict to a uint8 mask of shape (height, width).
+  """
+  batch = mask_batch([rle])
+  h, w = int(batch.heights[0]), int(batch.widths[0])
+  pixels = np.zeros(h * w, dtype=np.uint8)
+  pixels[concat_ranges(batch.starts, batch.ends - batch.starts)] = 1
+  return pixels.reshape((w, h)).T
+
+def polygons_to_rle(polygons, height, width):
+  """ Rasterize a list of polygons to an RLE dict with compressed counts.
+  """
+  return _rasterize_polygons([polygons], [height], [width]).to_rles()[0]
+
+def area(segmentations, sizes=None):
+  """ The area (in pixels) of each of a batch of segmentations, see `mask_batch`.
+  """
+  return mask_batch(segmentations, sizes).area()
+
+def bbox(segmentations, sizes=None):
+  """ The [x, y, width, height] bbox (in pixels) of each of a batch of segmentations, see `mask_batch`.
+  """
+  return mask_batch(segmentations, sizes).bbox()
+
+def iou(segmentations1, segmentations2, iscrowd=None, sizes1=None, sizes2=None):
+  """ The mask intersection over union of each pair of segmentations, see `MaskBatch.iou`.
+  """
+  return mask_batch(segmentations1, sizes1).iou(mask_batch(segmentations2, sizes2), iscrowd)
+
+#################################################
+
+################## Annotations ##################
+
+def normalize_segmentation(segmentation):
+  """ Put a segmentation in canonical form: polygons are a list of lists of floats, and RLEs have an
+  integer size and compressed counts. Returns None for an empty segmentation.
+  """
+  if segmentation is None:
+    return None
+  if is_rle(segmentation):
+    counts = segmentation['counts']
+    if isinstance(counts, bytes):
+      counts = counts.decode('ascii')
+    elif isinstance(counts, list):
+      counts = encode_counts(counts)
+    return {'size' : [int(segmentation['size'][0]), int(segmentation['size'][1])], 'counts' : counts}
+  if len(segmentation) == 0:
+    return None
+  # A single polygon
+  if not isinstance(segmentation[0], (list, tuple)):
+    segmentation = [segmentation]
+  return [[float(v) for v in polygon] for polygon in segmentation if len(polygon) > 0]
+
+def prepare_annotations(annotations, image_id_to_w_h=None, normalized=False, overwrite=False):
+  """ Normalize the segmentations of a batch of annotations in place, fill in missing bboxes from
+  the segmentations and compute the areas.
+
+  The area of an annotation with a segmentation is the area of its mask, otherwise it is the area
+  of its bbox. Areas are in pixels. Empty segmentations are left as they are.
+  Args:
+    annotations: A list of annotation dicts.
+    image_id_to_w_h: A dict mapping image ids to (width, height) tuples. Needed to compute the areas of
+      normalized bboxes, and to clip polygons to their images.
+    normalized: Are the bboxes of the annotations normalized?
+    overwrite: Recompute the areas that are already set.
+  Returns:
+    The annotations.
+  Raises:
+    ValueError: If a normalized bbox is needed for an annotation whose image size is unknown.
+  """
+  if image_id_to_w_h is None:
+    image_id_to_w_h = {}
+
+  mask_annos = []
+  mask_anno_ids = set()
+  for anno in annotations:
+    if 'segmentation' not in anno:
+      continue
+    segmentation = normalize_segmentation(anno['segmentation'])
+    if segmentation is None:
+      continue
+    anno['segmentation'] = segmentation
+    mask_anno_ids.add(id(anno))
+    if overwrite or 'area' not in anno or 'bbox' not in anno:
+      mask_annos.append(anno)
+
+  if len(mask_annos) > 0:
+    sizes = []
+    for anno in mask_annos:
+      w_h = image_id_to_w_h.get(anno.get('image_id'))
+      sizes.append((int(w_h[1]), int(w_h[0])) if w_h is not None else None)
+    batch = mask_batch([anno['segmentation'] for anno in mask_annos], sizes)
+    areas = batch.area().tolist()
+    bboxes = batch.bbox() if any('bbox' not in anno for anno in mask_annos) else None
+    for i, anno in enumerate(mask_annos):
+      if overwrite or 'area' not in anno:
+        anno['area'] = float(areas[i])
+      if 'bbox' not in anno:
+        x, y, bw, bh = bboxes[i].tolist()
+        if normalized:
+          w_h = image_id_to_w_h.get(anno.get('image_id'))
+          if w_h is None:
+            raise ValueError("Annotation %s has no bbox, and the size of its image is unknown." % (anno.get('id'),))
+          w, h = w_h
+          x, y, bw, bh = x / w, y / h, bw / w, bh / h
+        anno['bbox'] = [x, y, bw, bh]
+
+  for anno in annotations:
+    if id(anno) in mask_anno_ids or 'bbox' not in anno or not (overwrite or 'area' not in anno):
+      continue
+    bw, bh = anno['bbox'][2:4]
+    if normalized:
+      w_h = image_id_to_w_h.get(anno.get('image_id'))
+      if w_h is None:
+        continue
+      bw, bh = bw * w_h[0], bh * w_h[1]
+    anno['area'] = float(bw * bh)
+
+  return annotations
+
+def update_areas(db, normalized=True, batch_size=DEFAULT_BATCH_SIZE):
+  """ Recompute the areas of the annotations in the database.
+  Args:
+    db: A mongodb database handle.
+    normalized: Are the bboxes in the database normalized?
+    batch_size: The number of annotations to update at a time.
+  Returns:
+    The number of annotations whose area changed.
+  """
+  image_id_to_w_h = {image['id'] : (float(image['width']), float(image['height']))
+                     for image in db.image.find(projection={'_id' : False, 'id' : True, 'width' : True, 'height' : True})}
+
+  num_updated = 0
+  progress = ProgressReporter('annotations')
+  cursor = db.annotation.find(projection={'image_id' : True, 'bbox' : True, 'segmentation' : True, 'area' : True},
+                              batch_size=batch_size)
+  for annotations in iter_batches(cursor, batch_size):
+    previous_areas = [anno.get('area') for anno in annotations]
+    prepare_annotations(annotations, image_id_to_w_h, normalized=normalized, overwrite=True)
+    operations = [UpdateOne({'_id' : anno['_id']}, {'$set' : {'area' : anno['area']}})
+                  for anno, previous_area in zip(annotations, previous_areas)
+                  if 'area' in anno and anno['area'] != previous_area]
+    if len(operations) > 0:
+      db.annotation.bulk_write(operations, ordered=False)
+    num_updated += len(operations)
+    progress.update(len(annotations))
+  progress.report(final=True)
+  return num_updated
+
+#################################################
+
+def parse_args():
+
+  parser = argparse.ArgumentParser(description='Recompute the areas of the annotations from their segmentations and bboxes.')
+
+  parser.add_argument('--denormalized', dest='denormalized',
+                        help='The bboxes in the database are in pixels rather than normalized.',
+                        required=False, action='store_true', default=False)
+
+  parser.add_argument('--batch_size', dest='batch_size',
+                        help='The number of annotations to update at a time.',
+                        required=False, type=int, default=DEFAULT_BATCH_SIZE)
+
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+  db = get_db()
+  num_updated = update_areas(db, normalized=not args.denormalized, batch_size=args.batch_size)
+  print("Updated the area of %d annotations" % (num_updated,))
+
+if __name__ == '__main__':
+  main()
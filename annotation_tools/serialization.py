@@ -0,0 +1,151 @@
+"""
+Encode Mongo documents to json, and decode request bodies back to Mongo documents, in one pass.
+
+BSON types use MongoDB's extended json (the format of `bson.json_util`), e.g. an ObjectId is
+encoded as {"$oid" : "..."} and decoded back to an ObjectId. Unlike `json_util.dumps`, which
+copies the whole document into json compatible types before encoding it, the encoder only
+visits the values that json can't represent.
+
+Documents are encoded and decoded with orjson when it is installed, otherwise with the standard
+library's json module:
+$ pip install orjson
+
+Both give the same results: NaN and infinity are encoded as null, int, float, bool and None keys
+are encoded as strings, ints wider than 64 bits are encoded and decoded exactly, and NaN and
+Infinity in the decoded json are read as floats.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import math
+
+from bson import json_util
+from bson.objectid import ObjectId
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+def _default(obj):
+  """ Encode a value that json can't represent.
+  """
+  if isinstance(obj, ObjectId):
+    return {'$oid' : str(obj)}
+  return json_util.default(obj)
+
+def _object_hook(dct):
+  """ Decode an extended json object (e.g. {"$oid" : "..."}) to its BSON type.
+  """
+  for key in dct:
+    if key[:1] == '$':
+      return json_util.object_hook(dct)
+  return dct
+
+def _finite(obj):
+  """ Copy `obj`, replacing NaN and infinite floats with None.
+  """
+  if isinstance(obj, float):
+    return obj if math.isfinite(obj) else None
+  if isinstance(obj, dict):
+    return {key : _finite(value) for key, value in obj.items()}
+  if isinstance(obj, (list, tuple)):
+    return [_finite(value) for value in obj]
+  return obj
+
+_encoder = json.JSONEncoder(default=_default, separators=(',', ':'), ensure_ascii=False, allow_nan=False)
+
+def _json_dumps(obj):
+  """ Encode `obj` as a json string with the json module.
+  """
+  try:
+    return _encoder.encode(obj)
+  except ValueError:
+    # NaN and infinity aren't json. orjson writes them as null, so do the same.
+    return _encoder.encode(_finite(obj))
+
+def _json_loads(data):
+  """ Decode json with the json module, converting extended json objects to BSON types.
+  """
+  if isinstance(data, bytes):
+    data = data.decode('utf-8')
+  return json.loads(data, object_hook=_object_hook)
+
+class _InexactFloat(Exception):
+  """ Raised by `_convert` for a float that orjson may have decoded from an int.
+  """
+
+# orjson decodes ints that don't fit in 64 bits to floats. Floats this large may have been such ints.
+_INT64_LIMIT = float(2**63)
+
+def _convert(value):
+  """ Convert the extended json objects in a dict or list decoded by orjson to BSON types, in place,
+  as the `object_hook` of `_json_loads` does: inner objects are converted first. Raises
+  _InexactFloat if `value` holds a float that may have been decoded from an int wider than 64 bits.
+  """
+  # orjson only returns dicts, lists, strs, ints, floats, bools and None, so their exact types are checked.
+  if type(value) is dict:
+    for key, item in value.items():
+      item_type = type(item)
+      if item_type is float:
+        if not -_INT64_LIMIT <= item < _INT64_LIMIT:
+          raise _InexactFloat()
+      elif item_type is dict or item_type is list:
+        value[key] = _convert(item)
+    for key in value:
+      if key[:1] == '$':
+        return json_util.object_hook(value)
+  else:
+    for i, item in enumerate(value):
+      item_type = type(item)
+      if item_type is float:
+        if not -_INT64_LIMIT <= item < _INT64_LIMIT:
+          raise _InexactFloat()
+      elif item_type is dict or item_type is list:
+        value[i] = _convert(item)
+  return value
+
+if orjson is not None:
+
+  def dumpb(obj):
+    """ Encode `obj` as utf-8 json bytes.
+    """
+    try:
+      # Datetimes go through `_default`, so that they are encoded as extended json too.
+      return orjson.dumps(obj, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    except orjson.JSONEncodeError:
+      # orjson only takes str keys and 64 bit ints. The json module also encodes int, float, bool
+      # and None keys and wider ints, or raises the same TypeError for values neither can encode.
+      return _json_dumps(obj).encode('utf-8')
+
+  def dumps(obj):
+    """ Encode `obj` as a json string.
+    """
+    return dumpb(obj).decode('utf-8')
+
+  def loads(data):
+    """ Decode json (a string or utf-8 bytes), converting extended json objects to BSON types.
+    """
+    # orjson rejects NaN and Infinity, and decodes ints wider than 64 bits to floats. Those bodies go
+    # through the json module, so that they decode as they do without orjson.
+    try:
+      # Wrapped in a list, so that a top level value is checked too.
+      return _convert([orjson.loads(data)])[0]
+    except (orjson.JSONDecodeError, _InexactFloat):
+      pass
+    return _json_loads(data)
+
+else:
+
+  def dumpb(obj):
+    """ Encode `obj` as utf-8 json bytes.
+    """
+    return _json_dumps(obj).encode('utf-8')
+
+  dumps = _json_dumps
+  loads = _json_loads
@@ -0,0 +1,69 @@
+"""
+Serve the web app with gunicorn, a pre-forking server with a pool of worker processes.
+
+Each worker creates its own MongoClient after it is forked, connects it and loads the caches
+before it accepts requests, and writes its queued task results and closes its connections when
+it exits. On SIGTERM the workers stop accepting connections and get `SERVER_GRACEFUL_TIMEOUT`
+seconds to finish the requests in flight.
+
+gunicorn is an optional dependency:
+$ pip install gunicorn
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+
+from annotation_tools.annotation_tools import get_config, shut_down, warm_up
+
+logger = logging.getLogger(__name__)
+
+def _post_worker_init(worker):
+  try:
+    warm_up()
+  except Exception:
+    # The worker can still serve requests, it will connect when the database is reachable.
+    logger.exception("Failed to warm up worker %d", worker.pid)
+
+def _worker_exit(server, worker):
+  shut_down()
+
+def run_production_server(app, host, port, workers=None, threads=None, worker_class=None):
+  """ Serve `app` with gunicorn. This blocks until the server is stopped.
+  Args:
+    app: The Flask app.
+    host: The interface to bind to.
+    port: The port to bind to.
+    workers: The number of worker processes. Defaults to SERVER_WORKERS.
+    threads: The number of request threads per worker. Defaults to SERVER_THREADS.
+    worker_class: The gunicorn worker class, e.g. `gthread` or `gevent`. Defaults to SERVER_WORKER_CLASS.
+  """
+  try:
+    from gunicorn.app.base import BaseApplication
+  except ImportError:
+    raise ImportError("The production server requires gunicorn: pip install gunicorn")
+
+  options = {
+    'bind' : '%s:%d' % (host, port),
+    'workers' : workers if workers is not None else get_config('SERVER_WORKERS'),
+    'threads' : threads if threads is not None else get_config('SERVER_THREADS'),
+    'worker_class' : worker_class if worker_class is not None else get_config('SERVER_WORKER_CLASS'),
+    'timeout' : get_config('SERVER_TIMEOUT'),
+    'graceful_timeout' : get_config('SERVER_GRACEFUL_TIMEOUT'),
+    'keepalive' : get_config('SERVER_KEEPALIVE'),
+    'post_worker_init' : _post_worker_init,
+    'worker_exit' : _worker_exit
+  }
+
+  class _Application(BaseApplication):
+
+    def load_config(self):
+      for key, value in options.items():
+        self.cfg.set(key, value)
+
+    def load(self):
+      return app
+
+  _Application().run()
@@ -0,0 +1,191 @@
+"""
+Utilities for reading and writing large json files incrementally.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import time
+
+from annotation_tools import serialization
+
+DEFAULT_READ_SIZE = 1 << 20 # 1MB
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+class _Reader(object):
+  """ A buffered view over a file object that the parser can advance through.
+  """
+
+  def __init__(self, fileobj, read_size=DEFAULT_READ_SIZE):
+    self.fileobj = fileobj
+    self.read_size = read_size
+    self.buf = ''
+    self.pos = 0
+    self.eof = False
+
+  def fill(self):
+    """ Read more data into the buffer, dropping everything before `pos`.
+    Returns False if the end of the file has been reached.
+    """
+    if self.eof:
+      return False
+    data = self.fileobj.read(self.read_size)
+    if isinstance(data, bytes):
+      data = data.decode('utf-8')
+    if not data:
+      self.eof = True
+      return False
+    self.buf = self.buf[self.pos:] + data
+    self.pos = 0
+    return True
+
+  def peek(self):
+    """ Skip whitespace and return the next character (or None at the end of the file).
+    """
+    while True:
+      while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+        self.pos += 1
+      if self.pos < len(self.buf):
+        return self.buf[self.pos]
+      if not self.fill():
+        return None
+
+  def expect(self, chars):
+    c = self.peek()
+    if c is None or c not in chars:
+      raise ValueError("Expected one of %r at offset %d, found %r" % (chars, self.pos, c))
+    self.pos += 1
+    return c
+
+  def decode(self):
+    """ Decode the next json value, reading more data until the value is complete.
+    """
+    self.peek()
+    while True:
+      try:
+        value, end = _decoder.raw_decode(self.buf, self.pos)
+      except ValueError:
+        if not self.fill():
+          raise
+        continue
+      # A number at the end of the buffer may have been cut in half.
+      if end == len(self.buf) and not self.eof and self.fill():
+        continue
+      self.pos = end
+      return value
+
+def iter_json_arrays(fileobj, keys=None, read_size=DEFAULT_READ_SIZE):
+  """ Iterate over the elements of the top level arrays of a json object without loading the whole file.
+  Args:
+    fileobj: A file object opened for reading.
+    keys: Only yield the elements of these top level keys. Other values are parsed and discarded.
+    read_size: The number of characters to read from the file at a time.
+  Returns:
+    A generator of (key, element) tuples, in file order.
+  """
+  reader = _Reader(fileobj, read_size)
+  reader.expect('{')
+  if reader.peek() == '}':
+    return
+  while True:
+    key = reader.decode()
+    reader.expect(':')
+
+    if reader.peek() == '[':
+      # Walk the array one element at a time, even when it is being skipped, so
+      # that large arrays never have to be held in memory.
+      selected = keys is None or key in keys
+      reader.expect('[')
+      if reader.peek() == ']':
+        reader.pos += 1
+      else:
+        while True:
+          element = reader.decode()
+          if selected:
+            yield key, element
+          if reader.expect(',]') == ']':
+            break
+    else:
+      reader.decode()
+
+    if reader.expect(',}') == '}':
+      return
+
+def write_json_array(fileobj, elements):
+  """ Write an iterable as a json array, one element at a time.
+  Returns:
+    The number of elements written.
+  """
+  count = 0
+  fileobj.write('[')
+  for element in elements:
+    if count > 0:
+      fileobj.write(',')
+    fileobj.write(serialization.dumps(element))
+    count += 1
+  fileobj.write(']')
+  return count
+
+def write_json_arrays(fileobj, arrays):
+  """ Write a json object whose values are arrays, one element at a time.
+  Args:
+    fileobj: A file object opened for writing.
+    arrays: A list of (key, iterable) tuples. An iterable can also be a function returning an iterable,
+      in which case it is called when the writer reaches its key.
+  Returns:
+    A dict mapping each key to the number of elements written.
+  """
+  counts = {}
+  fileobj.write('{')
+  for i, (key, elements) in enumerate(arrays):
+    if i > 0:
+      fileobj.write(',')
+    fileobj.write(serialization.dumps(key) + ':')
+    if callable(elements):
+      elements = elements()
+    counts[key] = write_json_array(fileobj, elements)
+  fileobj.write('}')
+  return counts
+
+def iter_batches(iterable, batch_size):
+  """ Group an iterable into lists of at most `batch_size` items.
+  """
+  batch = []
+  for item in iterable:
+    batch.append(item)
+    if len(batch) >= batch_size:
+      yield batch
+      batch = []
+  if len(batch) > 0:
+    yield batch
+
+class ProgressReporter(object):
+  """ Print the number of records processed and the processing rate.
+  """
+
+  def __init__(self, name, every=100000):
+    self.name = name
+    self.every = every
+    self.count = 0
+    self.start_time = time.time()
+    self.last_time = self.start_time
+    self._next_report = every
+
+  def update(self, n):
+    self.count += n
+    self.last_time = time.time()
+    if self.count >= self._next_report:
+      self.report()
+      while self._next_report <= self.count:
+        self._next_report += self.every
+
+  def rate(self):
+    elapsed = self.last_time - self.start_time
+    return self.count / elapsed if elapsed > 0 else 0.
+
+  def report(self, final=False):
+    print("%s %d %s (%.1f records/sec)" % ("Finished" if final else "\tProcessed", self.count, self.name, self.rate()))
@@ -0,0 +1,291 @@
+"""
+Lease bbox tasks to workers, so that concurrent workers never do the same task at the same time and
+each task is done by exactly `redundancy` different workers.
+
+Dispatch state is kept on the bbox task documents:
+{
+  redundancy : int              # The number of workers that should complete the task.
+  open_slots : int              # redundancy - (completions + active leases), 0 when the task is taken.
+  num_completed : int
+  completed_by : [str]          # The ids of the workers that completed the task.
+  leases : [{
+    lease_id : str
+    worker_id : str
+    expires : float             # Unix time.
+  }]
+}
+
+A lease is taken atomically with `find_one_and_update` on the `open_slots` index, and given back
+when it expires without a result (see `reclaim_expired_leases`, which the lease requests run at most
+every `DEFAULT_RECLAIM_INTERVAL` seconds). A worker that asks for a task while it holds an unexpired
+lease gets that lease back. A saved task result completes the lease named by its `lease_id`.
+
+Enable dispatching for the tasks that are already in the database (or change their redundancy):
+$ python -m annotation_tools.task_dispatch enable --redundancy 3
+
+Show the progress of the tasks:
+$ python -m annotation_tools.task_dispatch status
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+import uuid
+
+from pymongo import UpdateOne
+
+from annotation_tools.connection import get_db
+from annotation_tools.stream_utils import iter_batches
+
+DEFAULT_REDUNDANCY = 1
+DEFAULT_LEASE_DURATION = 60 * 60
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_RECLAIM_INTERVAL = 60
+
+# When this process should next reclaim the expired leases.
+_next_reclaim = 0
+
+def ensure_dispatch_indices(db):
+  # Leases are taken from the tasks with the fewest open slots first, so that started tasks are finished first.
+  db.bbox_task.create_index([("open_slots", 1), ("id", 1)])
+  db.bbox_task.create_index("leases.expires")
+  db.bbox_task.create_index("leases.worker_id")
+
+def dispatch_fields(redundancy=DEFAULT_REDUNDANCY):
+  """ The dispatch state of a new task.
+  """
+  return {
+    'redundancy' : redundancy,
+    'open_slots' : redundancy,
+    'num_completed' : 0,
+    'completed_by' : [],
+    'leases' : []
+  }
+
+def enable_dispatch(db, redundancy=DEFAULT_REDUNDANCY, query=None, batch_size=DEFAULT_BATCH_SIZE):
+  """ Set the redundancy of the tasks matching `query` (all tasks by default). Tasks that were not
+  dispatched yet get a fresh dispatch state, the open slots of the others are adjusted.
+  Returns:
+    The number of updated tasks.
+  """
+  query = dict(query or {})
+  num_updated = 0
+
+  new_query = dict(query, redundancy={'$exists' : False})
+  num_updated += db.bbox_task.update_many(new_query, {'$set' : dispatch_fields(redundancy)}).modified_count
+
+  changed_query = dict(query, redundancy={'$exists' : True, '$ne' : redundancy})
+  tasks = db.bbox_task.find(changed_query, projection={'redundancy' : True},
+                            batch_size=batch_size)
+  for batch in iter_batches(tasks, batch_size):
+    operations = []
+    for task in batch:
+      # Only the open slots change, the leases that are out stay valid. Lowering the redundancy below the
+      # number of workers that have the task leaves the open slots negative until their leases end.
+      change = redundancy - task['redundancy']
+      operations.append(UpdateOne({'_id' : task['_id'], 'redundancy' : task['redundancy']},
+                                  {'$set' : {'redundancy' : redundancy}, '$inc' : {'open_slots' : change}}))
+    db.bbox_task.bulk_write(operations, ordered=False)
+    num_updated += len(operations)
+
+  return num_updated
+
+def active_lease(db, worker_id, query=None, now=None):
+  """ Return the unexpired lease of `worker_id` on a task matching `query`, or None.
+  """
+  if now is None:
+    now = time.time()
+  lease_match = {'worker_id' : worker_id, 'expires' : {'$gt' : now}}
+  task = db.bbox_task.find_one(dict(query or {}, leases={'$elemMatch' : lease_match}),
+                               projection={'_id' : False, 'id' : True, 'leases' : {'$elemMatch' : lease_match}})
+  if task is None or len(task.get('leases', [])) == 0:
+    return None
+  lease = dict(task['leases'][0])
+  lease['task_id'] = task['id']
+  return lease
+
+def lease_task(db, worker_id, lease_duration=DEFAULT_LEASE_DURATION, query=None,
+               reclaim_interval=DEFAULT_RECLAIM_INTERVAL):
+  """ Lease an open task to `worker_id`. A worker that already holds an unexpired lease (e.g. it
+  reloaded the task page) gets that lease back, and a worker never gets a task that it completed.
+  Args:
+    db: A mongodb database handle.
+    worker_id: The id of the worker.
+    lease_duration: The number of seconds the worker has to complete the task.
+    query: Restrict the leased tasks, e.g. {'category_id' : ...}.
+    reclaim_interval: Reclaim the expired leases first if this process hasn't done it for this
+      many seconds, so that abandoned tasks are finished before the open tasks run out.
+  Returns:
+    {'task_id' : str, 'lease_id' : str, 'worker_id' : str, 'expires' : float}, or None if there are
+    no open tasks.
+  """
+  global _next_reclaim
+  now = time.time()
+  lease = active_lease(db, worker_id, query, now)
+  if lease is not None:
+    return lease
+
+  if now >= _next_reclaim:
+    _next_reclaim = now + reclaim_interval
+    reclaim_expired_leases(db, now)
+
+  lease = {
+    'lease_id' : uuid.uuid4().hex,
+    'worker_id' : worker_id,
+    'expires' : now + lease_duration
+  }
+  task_query = dict(query or {})
+  task_query.update({
+    'open_slots' : {'$gt' : 0},
+    'leases.worker_id' : {'$ne' : worker_id},
+    'completed_by' : {'$ne' : worker_id}
+  })
+
+  task = None
+  for attempt in range(2):
+    task = db.bbox_task.find_one_and_update(task_query,
+                                            {'$inc' : {'open_slots' : -1}, '$push' : {'leases' : lease}},
+                                            projection={'_id' : False, 'id' : True},
+                                            sort=[('open_slots', 1), ('id', 1)])
+    # Give the slots of expired leases back and try again.
+    if task is not None or attempt > 0 or reclaim_expired_leases(db) == 0:
+      break
+  if task is None:
+    return None
+
+  lease['task_id'] = task['id']
+  return lease
+
+def reclaim_expired_leases(db, now=None):
+  """ Reopen the slots of the leases that expired without a result.
+  Returns:
+    The number of reclaimed leases.
+  """
+  if now is None:
+    now = time.time()
+  num_reclaimed = 0
+  tasks = db.bbox_task.find({'leases.expires' : {'$lt' : now}}, projection={'id' : True, 'leases' : True})
+  for task in tasks:
+    for lease in task['leases']:
+      if lease['expires'] >= now:
+        continue
+      # Matching the lease id makes this safe to run concurrently, only one process gives the slot back.
+      result = db.bbox_task.update_one({'_id' : task['_id'], 'leases.lease_id' : lease['lease_id']},
+                                       {'$pull' : {'leases' : {'lease_id' : lease['lease_id']}},
+                                        '$inc' : {'open_slots' : 1}})
+      num_reclaimed += result.modified_count
+  return num_reclaimed
+
+def complete_task(db, task_id, worker_id=None, lease_id=None):
+  """ Record that a worker completed a task.
+
+  The worker's lease is closed. A result that arrives after its lease was reclaimed still counts,
+  and takes an open slot if there is one.
+  Returns:
+    True if the completion was recorded, False if the task isn't dispatched, the lease is unknown
+    and there is no worker id, or the worker already completed the task.
+  """
+  if lease_id is not None:
+    lease_query = {'id' : task_id, 'leases.lease_id' : lease_id}
+    if worker_id is None:
+      task = db.bbox_task.find_one(lease_query, projection={'leases' : {'$elemMatch' : {'lease_id' : lease_id}}})
+      if task is not None and len(task.get('leases', [])) > 0:
+        worker_id = task['leases'][0]['worker_id']
+    update = {'$pull' : {'leases' : {'lease_id' : lease_id}}, '$inc' : {'num_completed' : 1}}
+    if worker_id is not None:
+      update['$addToSet'] = {'completed_by' : worker_id}
+    if db.bbox_task.update_one(lease_query, update).modified_count > 0:
+      return True
+
+  if worker_id is None:
+    return False
+  task_query = {'id' : task_id, 'redundancy' : {'$exists' : True}, 'completed_by' : {'$ne' : worker_id}}
+  update = {'$addToSet' : {'completed_by' : worker_id}, '$inc' : {'num_completed' : 1, 'open_slots' : -1}}
+  if db.bbox_task.update_one(dict(task_query, open_slots={'$gt' : 0}), update).modified_count > 0:
+    return True
+  del update['$inc']['open_slots']
+  return db.bbox_task.update_one(task_query, update).modified_count > 0
+
+def complete_tasks(db, task_results):
+  """ Record the completions of a batch of task results (see `complete_task`).
+  Returns:
+    The number of recorded completions.
+  """
+  num_completed = 0
+  for task_result in task_results:
+    if complete_task(db, task_result['task_id'], task_result.get('worker_id'), task_result.get('lease_id')):
+      num_completed += 1
+  return num_completed
+
+def dispatch_status(db, query=None):
+  """ Summarize the dispatch state of the tasks matching `query`.
+  Returns:
+    A dict with the number of tasks, open slots, active and expired leases, completions and completed tasks.
+  """
+  now = time.time()
+  match = dict(query or {}, redundancy={'$exists' : True})
+  status = {'num_tasks' : 0, 'open_slots' : 0, 'active_leases' : 0, 'expired_leases' : 0, 'num_completed' : 0,
+            'completed_tasks' : 0}
+  for doc in db.bbox_task.aggregate([
+      {'$match' : match},
+      {'$project' : {
+        'open_slots' : {'$max' : [0, '$open_slots']},
+        'num_completed' : True,
+        'complete' : {'$cond' : [{'$gte' : ['$num_completed', '$redundancy']}, 1, 0]},
+        'active_leases' : {'$size' : {'$filter' : {'input' : '$leases', 'as' : 'lease', 'cond' : {'$gte' : ['$$lease.expires', now]}}}},
+        'num_leases' : {'$size' : '$leases'}
+      }},
+      {'$group' : {
+        '_id' : None,
+        'num_tasks' : {'$sum' : 1},
+        'open_slots' : {'$sum' : '$open_slots'},
+        'active_leases' : {'$sum' : '$active_leases'},
+        'num_leases' : {'$sum' : '$num_leases'},
+        'num_completed' : {'$sum' : '$num_completed'},
+        'completed_tasks' : {'$sum' : '$complete'}
+      }}]):
+    status.update({key : doc[key] for key in status if key in doc})
+    status['expired_leases'] = doc['num_leases'] - doc['active_leases']
+  return status
+
+def parse_args():
+
+  parser = argparse.ArgumentParser(description='Lease bbox tasks to workers.')
+  subparsers = parser.add_subparsers(dest='action')
+  subparsers.required = True
+
+  enable = subparsers.add_parser('enable', help='Dispatch the tasks in the database, or change their redundancy.')
+  enable.add_argument('-r', '--redundancy', dest='redundancy', type=int, default=DEFAULT_REDUNDANCY,
+                      help='The number of different workers that should complete each task.')
+
+  subparsers.add_parser('reclaim', help='Reopen the slots of the expired leases.')
+  subparsers.add_parser('status', help='Print the number of open slots, leases and completions.')
+
+  for subparser in subparsers.choices.values():
+    subparser.add_argument('-c', '--category_id', dest='category_id', type=str, default=None,
+                           help='Only the tasks of this category.')
+
+  return parser.parse_args()
+
+def main():
+
+  args = parse_args()
+  db = get_db()
+  query = {'category_id' : args.category_id} if args.category_id is not None else None
+
+  if args.action == 'enable':
+    ensure_dispatch_indices(db)
+    num_updated = enable_dispatch(db, args.redundancy, query)
+    print("Set the redundancy of %d tasks to %d." % (num_updated, args.redundancy))
+  elif args.action == 'reclaim':
+    print("Reclaimed %d expired leases." % (reclaim_expired_leases(db),))
+  else:
+    status = dispatch_status(db, query)
+    print("%d tasks, %d completed (%d completions)" % (status['num_tasks'], status['completed_tasks'], status['num_completed']))
+    print("%d open slots, %d active leases, %d expired leases" % (status['open_slots'], status['active_leases'], status['expired_leases']))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,273 @@
+"""
+Precompute image pyramids (tiles) and thumbnails so that the editors only download the parts of a
+large image that are on screen.
+
+Each image gets a directory in the cache, named after a hash of its id:
+<cache_dir>/<2 hex digits>/<sha1 of the image id>/
+  info.json         # {width, height, tile_size, max_level, levels : [[width, height]], format}
+  thumbnail.jpg     # At most `thumbnail_size` pixels on each side.
+  <level>/<x>_<y>.jpg
+
+Level `max_level` is the full resolution image and each lower level halves the resolution, down to
+level 0 which fits in a single tile. `info.json` is written last, so an image with an `info.json`
+has all of its tiles.
+
+The image files are read from `image_dir`, using the image's `file_name` or, if it doesn't have one,
+the last component of its `url`:
+$ python -m annotation_tools.tiles \
+--image_dir ~/images \
+--cache_dir ~/image_tiles \
+--num_processes 8
+
+Serve the tiles from the web server by setting IMAGE_TILE_DIR to the cache directory.
+
+Pillow is an optional dependency:
+$ pip install Pillow
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import time
+
+try:
+  from urllib.parse import urlparse
+except ImportError:
+  from urlparse import urlparse
+
+from annotation_tools.connection import get_db
+
+DEFAULT_TILE_SIZE = 256
+DEFAULT_THUMBNAIL_SIZE = 256
+DEFAULT_QUALITY = 90
+DEFAULT_BATCH_SIZE = 1000
+
+INFO_FILE = 'info.json'
+THUMBNAIL_FILE = 'thumbnail.jpg'
+TILE_EXTENSION = '.jpg'
+
+def _import_pil():
+  try:
+    from PIL import Image
+  except ImportError:
+    raise ImportError("Generating tiles requires Pillow: pip install Pillow")
+  return Image
+
+def image_tile_dir(cache_dir, image_id):
+  """ The directory that holds the tiles of an image.
+  """
+  digest = hashlib.sha1(str(image_id).encode('utf-8')).hexdigest()
+  return os.path.join(cache_dir, digest[:2], digest)
+
+def read_tile_info(cache_dir, image_id):
+  """ Return the info of an image's tiles, or None if the image has no (complete) tiles.
+  """
+  try:
+    with open(os.path.join(image_tile_dir(cache_dir, image_id), INFO_FILE)) as f:
+      return json.load(f)
+  except (IOError, OSError, ValueError):
+    return None
+
+def tile_path(level, x, y):
+  """ The path of a tile, relative to the image's tile directory.
+  """
+  return os.path.join(str(level), '%d_%d%s' % (x, y, TILE_EXTENSION))
+
+def num_levels(width, height, tile_size=DEFAULT_TILE_SIZE):
+  """ The number of levels needed for the lowest level to fit in a single tile.
+  """
+  return int(math.ceil(math.log(max(width, height, tile_size) / tile_size, 2))) + 1
+
+def level_sizes(width, height, tile_size=DEFAULT_TILE_SIZE):
+  """ The [width, height] of each level, from the lowest resolution to the full resolution.
+  """
+  max_level = num_levels(width, height, tile_size) - 1
+  return [[int(math.ceil(width / 2 ** (max_level - level))), int(math.ceil(height / 2 ** (max_level - level)))]
+          for level in range(max_level + 1)]
+
+def generate_image_tiles(image_path, output_dir, tile_size=DEFAULT_TILE_SIZE,
+                         thumbnail_size=DEFAULT_THUMBNAIL_SIZE, quality=DEFAULT_QUALITY):
+  """ Write the tiles, thumbnail and info file of an image to `output_dir`.
+  The tiles are written to a temporary directory that is renamed when it is complete.
+  Returns:
+    The info dict.
+  """
+  Image = _import_pil()
+  # Gigapixel images are expected here.
+  Image.MAX_IMAGE_PIXELS = None
+
+  image = Image.open(image_path)
+  if image.mode not in ('RGB', 'L'):
+    image = image.convert('RGB')
+  width, height = image.size
+  sizes = level_sizes(width, height, tile_size)
+  max_level = len(sizes) - 1
+  resample = getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS
+
+  temp_dir = '%s.tmp-%d' % (output_dir, os.getpid())
+  if os.path.exists(temp_dir):
+    shutil.rmtree(temp_dir)
+  os.makedirs(temp_dir)
+
+  thumbnail = None
+  level_image = image
+  for level in range(max_level, -1, -1):
+    level_width, level_height = sizes[level]
+    if level_image.size != (level_width, level_height):
+      # Halving the previous level is much faster than resizing the full image.
+      level_image = level_image.resize((level_width, level_height), resample)
+
+    os.makedirs(os.path.join(temp_dir, str(level)))
+    for y in range(0, int(math.ceil(level_height / tile_size))):
+      for x in range(0, int(math.ceil(level_width / tile_size))):
+        box = (x * tile_size, y * tile_size, min((x + 1) * tile_size, level_width), min((y + 1) * tile_size, level_height))
+        level_image.crop(box).save(os.path.join(temp_dir, tile_path(level, x, y)), 'JPEG', quality=quality)
+
+    if thumbnail is None and (max(level_width, level_height) <= 2 * thumbnail_size or level == 0):
+      thumbnail = level_image.copy()
+      thumbnail.thumbnail((thumbnail_size, thumbnail_size), resample)
+      thumbnail.save(os.path.join(temp_dir, THUMBNAIL_FILE), 'JPEG', quality=quality)
+
+  info = {
+    'width' : width,
+    'height' : height,
+    'tile_size' : tile_size,
+    'max_level' : max_level,
+    'levels' : sizes,
+    'format' : 'jpeg'
+  }
+  with open(os.path.join(temp_dir, INFO_FILE), 'w') as f:
+    json.dump(info, f)
+
+  if os.path.exists(output_dir):
+    shutil.rmtree(output_dir)
+  parent_dir = os.path.dirname(output_dir)
+  if not os.path.exists(parent_dir):
+    try:
+      os.makedirs(parent_dir)
+    except OSError:
+      pass # Another process created it.
+  os.rename(temp_dir, output_dir)
+  return info
+
+def _generate_image_tiles(job):
+  """ Process pool entry point. Returns (image id, status) where status is `generated`, `skipped`,
+  `missing` or `failed`.
+  """
+  image_id, image_path, output_dir, tile_size, thumbnail_size, quality, overwrite = job
+  if not overwrite and os.path.exists(os.path.join(output_dir, INFO_FILE)):
+    return image_id, 'skipped'
+  if not os.path.exists(image_path):
+    return image_id, 'missing'
+  try:
+    generate_image_tiles(image_path, output_dir, tile_size, thumbnail_size, quality)
+  except Exception as e:
+    print("Failed to generate the tiles of image %s (%s): %s" % (image_id, image_path, e))
+    return image_id, 'failed'
+  return image_id, 'generated'
+
+def image_file_name(image):
+  """ The file name of an image: its `file_name`, or the last component of its `url`.
+  """
+  if image.get('file_name'):
+    return image['file_name']
+  return os.path.basename(urlparse(image.get('url', '')).path)
+
+def generate_tiles(db, image_dir, cache_dir, tile_size=DEFAULT_TILE_SIZE, thumbnail_size=DEFAULT_THUMBNAIL_SIZE,
+                   quality=DEFAULT_QUALITY, min_size=0, overwrite=False, num_processes=None,
+                   batch_size=DEFAULT_BATCH_SIZE):
+  """ Generate the tiles of the images in the database, in a pool of processes.
+  Args:
+    db: A mongodb database handle.
+    image_dir: The directory that holds the image files.
+    cache_dir: The tile cache directory.
+    tile_size: The width and height of a tile.
+    thumbnail_size: The maximum width and height of a thumbnail.
+    quality: The jpeg quality of the tiles and thumbnails.
+    min_size: Skip the images whose width and height are both smaller than this.
+    overwrite: Regenerate the tiles of images that already have them.
+    num_processes: The number of processes. Defaults to the number of CPUs.
+    batch_size: The number of images fetched from the database per round trip.
+  Returns:
+    A dict with the number of images of each status.
+  """
+  _import_pil()
+
+  # The workers only write files, they don't use the database connection (which `main` has already opened).
+  pool = multiprocessing.Pool(num_processes)
+  try:
+    query = {}
+    if min_size > 0:
+      query = {'$or' : [{'width' : {'$gte' : min_size}}, {'height' : {'$gte' : min_size}}]}
+    images = db.image.find(query, projection={'_id' : False, 'id' : True, 'file_name' : True, 'url' : True},
+                           batch_size=batch_size)
+    jobs = ((image['id'], os.path.join(image_dir, image_file_name(image)), image_tile_dir(cache_dir, image['id']),
+             tile_size, thumbnail_size, quality, overwrite)
+            for image in images)
+
+    counts = {'generated' : 0, 'skipped' : 0, 'missing' : 0, 'failed' : 0}
+    start_time = time.time()
+    for i, (image_id, status) in enumerate(pool.imap_unordered(_generate_image_tiles, jobs, chunksize=4)):
+      counts[status] += 1
+      if (i + 1) % 1000 == 0:
+        print("Processed %d images (%.1f images/sec)" % (i + 1, (i + 1) / (time.time() - start_time)))
+    pool.close()
+  except BaseException:
+    # Stop the workers that are still generating tiles.
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  return counts
+
+def parse_args():
+
+  parser = argparse.ArgumentParser(description='Precompute image tiles and thumbnails.')
+
+  parser.add_argument('--image_dir', dest='image_dir', type=str, required=True,
+                      help='The directory that holds the image files.')
+
+  parser.add_argument('--cache_dir', dest='cache_dir', type=str, required=True,
+                      help='The directory to write the tiles to. Point IMAGE_TILE_DIR at it to serve them.')
+
+  parser.add_argument('--tile_size', dest='tile_size', type=int, default=DEFAULT_TILE_SIZE,
+                      help='The width and height of a tile.')
+
+  parser.add_argument('--thumbnail_size', dest='thumbnail_size', type=int, default=DEFAULT_THUMBNAIL_SIZE,
+                      help='The maximum width and height of a thumbnail.')
+
+  parser.add_argument('--quality', dest='quality', type=int, default=DEFAULT_QUALITY,
+                      help='The jpeg quality of the tiles and thumbnails.')
+
+  parser.add_argument('--min_size', dest='min_size', type=int, default=0,
+                      help='Skip the images whose width and height are both smaller than this (they are loaded directly).')
+
+  parser.add_argument('--overwrite', dest='overwrite', action='store_true', default=False,
+                      help='Regenerate the tiles of images that already have them.')
+
+  parser.add_argument('--num_processes', dest='num_processes', type=int, default=None,
+                      help='The number of processes. Defaults to the number of CPUs.')
+
+  return parser.parse_args()
+
+def main():
+
+  args = parse_args()
+  db = get_db()
+
+  counts = generate_tiles(db, args.image_dir, args.cache_dir, tile_size=args.tile_size,
+                          thumbnail_size=args.thumbnail_size, quality=args.quality, min_size=args.min_size,
+                          overwrite=args.overwrite, num_processes=args.num_processes)
+  print("Generated the tiles of %d images (%d skipped, %d missing, %d failed)." % (
+    counts['generated'], counts['skipped'], counts['missing'], counts['failed']))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,102 @@
+"""
+Compare the batched coordinate conversion in `annotation_tools.coord_utils` with the
+per coordinate python loops it replaced.
+
+$ python -m benchmarks.coords \
+--num_images 10000 \
+--annotations_per_image 10 \
+--num_keypoints 17
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import copy
+import gc
+import time
+
+from annotation_tools.coord_utils import normalize_annotations, denormalize_annotations
+
+from benchmarks import synthetic
+
+def loop_normalize(annotations, image_id_to_w_h):
+  for anno in annotations:
+    image_width, image_height = image_id_to_w_h[anno['image_id']]
+    x, y, w, h = anno['bbox']
+    anno['bbox'] = [x / image_width, y / image_height, w / image_width, h / image_height]
+    if 'keypoints' in anno:
+      for pidx in range(0, len(anno['keypoints']), 3):
+        x, y = anno['keypoints'][pidx:pidx+2]
+        anno['keypoints'][pidx:pidx+2] = [x / image_width, y / image_height]
+  return annotations
+
+def loop_denormalize(annotations, image_id_to_w_h):
+  for anno in annotations:
+    image_width, image_height = image_id_to_w_h[anno['image_id']]
+    x, y, w, h = anno['bbox']
+    anno['bbox'] = [x * image_width, y * image_height, w * image_width, h * image_height]
+    if 'keypoints' in anno:
+      for pidx in range(0, len(anno['keypoints']), 3):
+        x, y = anno['keypoints'][pidx:pidx+2]
+        anno['keypoints'][pidx:pidx+2] = [x * image_width, y * image_height]
+  return annotations
+
+def make_annotations(num_images, annotations_per_image, num_keypoints, seed=0):
+  """ Return the annotations of a synthetic dataset (see `benchmarks.synthetic`) and its image dimensions.
+  """
+  dataset = synthetic.make_dataset(num_images, annotations_per_image, num_keypoints, seed=seed)
+  image_id_to_w_h = {image['id'] : (float(image['width']), float(image['height'])) for image in dataset['images']}
+  return dataset['annotations'], image_id_to_w_h
+
+def time_function(fn, annotations, image_id_to_w_h, repeats):
+  best = None
+  result = None
+  for _ in range(repeats):
+    data = copy.deepcopy(annotations)
+    # Like timeit, keep garbage collections of the copied data out of the measurements.
+    gc.collect()
+    gc.disable()
+    try:
+      start = time.time()
+      result = fn(data, image_id_to_w_h)
+      elapsed = time.time() - start
+    finally:
+      gc.enable()
+    best = elapsed if best is None else min(best, elapsed)
+  return best, result
+
+def parse_args():
+
+  parser = argparse.ArgumentParser(description='Benchmark the coordinate conversion kernels.')
+
+  parser.add_argument('--num_images', dest='num_images', type=int, default=10000,
+                      help='Number of synthetic images.')
+
+  parser.add_argument('--annotations_per_image', dest='annotations_per_image', type=int, default=10,
+                      help='Number of annotations per image.')
+
+  parser.add_argument('--num_keypoints', dest='num_keypoints', type=int, default=17,
+                      help='Number of keypoints per annotation, 0 for bboxes only.')
+
+  parser.add_argument('--repeats', dest='repeats', type=int, default=3,
+                      help='Report the best of this many runs.')
+
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+
+  annotations, image_id_to_w_h = make_annotations(args.num_images, args.annotations_per_image, args.num_keypoints)
+  print("%d annotations, %d keypoints each" % (len(annotations), args.num_keypoints))
+
+  for name, loop_fn, batched_fn in [('normalize', loop_normalize, normalize_annotations),
+                                       ('denormalize', loop_denormalize, denormalize_annotations)]:
+    loop_time, expected = time_function(loop_fn, annotations, image_id_to_w_h, args.repeats)
+    batched_time, actual = time_function(batched_fn, annotations, image_id_to_w_h, args.repeats)
+    assert actual == expected, "The batched %s produced different coordinates." % (name,)
+    print("%s: loop %.3fs, batched %.3fs, speedup %.1fx" % (name, loop_time, batched_time, loop_time / batched_time))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,194 @@
+"""
+Timing, memory and reporting utilities for the benchmarks.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import datetime
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+import pymongo
+
+# The CPU time of this process (python 2 only has `time.clock`).
+_cpu_time = getattr(time, 'process_time', None) or time.clock
+
+def peak_rss_mb():
+  """ The peak resident set size of this process so far, in MB (None if it can't be measured).
+  """
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, macOS reports bytes.
+  if sys.platform == 'darwin':
+    return peak / (1024. * 1024.)
+  return peak / 1024.
+
+def percentile(values, q):
+  """ The `q`th percentile (0 - 100) of `values`, interpolating between the closest ranks.
+  """
+  if len(values) == 0:
+    return None
+  values = sorted(values)
+  rank = (len(values) - 1) * q / 100.
+  lower = int(rank)
+  upper = min(lower + 1, len(values) - 1)
+  return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+@contextlib.contextmanager
+def quiet():
+  """ Silence the progress output of the functions being measured.
+  """
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    yield
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+
+def connect(mongo_uri=None, db_name='vat_benchmark', use_mongomock=False):
+  """ Return (client, db) for a local mongod, or for an in-memory mongomock database.
+  """
+  if use_mongomock:
+    try:
+      import mongomock
+    except ImportError:
+      raise ImportError("The in-memory backend requires mongomock: pip install mongomock")
+    _add_find_one_or_404(mongomock.collection.Collection)
+    client = mongomock.MongoClient()
+  else:
+    client = pymongo.MongoClient(mongo_uri)
+  return client, client[db_name]
+
+def _add_find_one_or_404(collection_class):
+  """ The web app uses Flask-PyMongo's `find_one_or_404`, which mongomock collections don't have.
+  """
+  if hasattr(collection_class, 'find_one_or_404'):
+    return
+  from flask import abort
+  def find_one_or_404(self, *args, **kwargs):
+    document = self.find_one(*args, **kwargs)
+    if document is None:
+      abort(404)
+    return document
+  collection_class.find_one_or_404 = find_one_or_404
+
+def _git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).decode('utf-8').strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+class Report(object):
+  """ Collect the measurements of a benchmark run and write them as json.
+  """
+
+  def __init__(self, config):
+    self.config = config
+    self.results = []
+    self.environment = {
+      'date' : datetime.datetime.now().isoformat(),
+      'python' : platform.python_version(),
+      'platform' : platform.platform(),
+      'pymongo' : pymongo.version,
+      'git_commit' : _git_commit()
+    }
+
+  def measure(self, name, fn, repeats=1, num_records=1, setup=None):
+    """ Run `fn` `repeats` times and record its latency distribution.
+    Args:
+      name: The name of the benchmark.
+      fn: The function to time.
+      repeats: The number of timed calls.
+      num_records: The number of records (documents, requests, ...) processed by each call, for the throughput.
+      setup: An optional function called before each call, outside of the timing.
+    """
+    latencies = []
+    for _ in range(repeats):
+      if setup is not None:
+        setup()
+      gc.collect()
+      start = time.time()
+      fn()
+      latencies.append(time.time() - start)
+    return self.add(name, latencies, num_records)
+
+  def measure_cpu(self, name, fn, repeats=100, num_records=1):
+    """ Run `fn` `repeats` times and record its CPU time per call, and the peak memory that a call
+    allocates (None if it can't be measured).
+    """
+    cpu_times = []
+    for _ in range(repeats):
+      start = _cpu_time()
+      fn()
+      cpu_times.append(_cpu_time() - start)
+
+    # Tracing slows the calls down, so the allocations are measured separately.
+    peak_allocated_kb = None
+    if tracemalloc is not None:
+      peaks = []
+      tracemalloc.start()
+      try:
+        for _ in range(min(repeats, 10)):
+          # Clearing the traces also resets the peak.
+          tracemalloc.clear_traces()
+          fn()
+          peaks.append(tracemalloc.get_traced_memory()[1])
+      finally:
+        tracemalloc.stop()
+      peak_allocated_kb = percentile(peaks, 50) / 1024.
+    return self.add(name, cpu_times, num_records, extra={'peak_allocated_kb' : peak_allocated_kb})
+
+  def add(self, name, latencies, num_records=1, extra=None):
+    """ Record the latencies (in seconds) of calls that each processed `num_records` records.
+    `extra` holds additional fields for the result.
+    """
+    total = sum(latencies)
+    result = {
+      'name' : name,
+      'calls' : len(latencies),
+      'records_per_call' : num_records,
+      'total_seconds' : total,
+      'throughput' : len(latencies) * num_records / total if total > 0 else None,
+      'p50_ms' : percentile(latencies, 50) * 1000.,
+      'p99_ms' : percentile(latencies, 99) * 1000.,
+      'max_ms' : max(latencies) * 1000.,
+      'peak_rss_mb' : peak_rss_mb()
+    }
+    if extra is not None:
+      result.update(extra)
+    self.results.append(result)
+    print("%-28s %6d calls  %12.1f records/sec  p50 %9.2fms  p99 %9.2fms  peak rss %s MB" % (
+      name, result['calls'], result['throughput'] or 0, result['p50_ms'], result['p99_ms'],
+      '%.1f' % result['peak_rss_mb'] if result['peak_rss_mb'] is not None else '?'))
+    return result
+
+  def to_dict(self):
+    return {
+      'config' : self.config,
+      'environment' : self.environment,
+      'results' : self.results
+    }
+
+  def write(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.to_dict(), f, indent=2, sort_keys=True)
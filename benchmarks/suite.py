@@ -0,0 +1,341 @@
+"""
+Benchmark the dataset loading and exporting paths and the web server's hot routes on a synthetic
+dataset, and write the results (throughput, p50 / p99 latency, peak RSS) to a json file.
+
+Against a local mongod (the benchmark database is dropped first):
+$ python -m benchmarks.suite \
+--mongo_uri mongodb://localhost:27017 \
+--num_images 10000 \
+--annotations_per_image 10 \
+--num_keypoints 17 \
+--output benchmark_results.json
+
+Against an in-memory mongomock database (requires `pip install mongomock`):
+$ python -m benchmarks.suite --mongomock --num_images 1000
+
+Compare two runs by diffing the `results` of their json files.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import copy
+import datetime
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from bson import json_util
+from bson.objectid import ObjectId
+from flask import jsonify
+
+from annotation_tools import annotation_tools as web
+from annotation_tools import connection
+from annotation_tools import db_bbox_utils
+from annotation_tools import db_dataset_utils
+from annotation_tools import serialization
+from annotation_tools import task_dispatch
+
+from benchmarks import synthetic
+from benchmarks.harness import Report, connect, quiet
+
+INSTRUCTIONS_ID = 'benchmark'
+
+def _reset(db):
+  db.client.drop_database(db.name)
+  web.category_cache.invalidate()
+  web.bbox_task_instructions_cache.invalidate()
+
+def benchmark_load(report, db, dataset, dataset_path, args):
+  num_records = sum(len(dataset[key]) for key in ['categories', 'images', 'annotations', 'licenses'])
+
+  def load():
+    with quiet():
+      db_dataset_utils.load_dataset(db, copy.deepcopy(dataset), normalize=True,
+                                    batch_size=args.batch_size, num_workers=args.num_workers)
+
+  def load_stream():
+    with quiet():
+      db_dataset_utils.load_dataset_stream(db, dataset_path, normalize=True,
+                                           batch_size=args.batch_size, num_workers=args.num_workers)
+
+  def setup():
+    _reset(db)
+    db_dataset_utils.ensure_dataset_indices(db)
+
+  report.measure('load_dataset', load, repeats=args.repeats, num_records=num_records, setup=setup)
+  report.measure('load_dataset_stream', load_stream, repeats=args.repeats, num_records=num_records, setup=setup)
+
+def benchmark_export(report, db, dataset, args):
+  num_records = sum(len(dataset[key]) for key in ['categories', 'images', 'annotations', 'licenses'])
+
+  def export():
+    with quiet():
+      db_dataset_utils.export_dataset(db, denormalize=True)
+
+  def export_stream():
+    with quiet(), open(os.devnull, 'w') as f:
+      db_dataset_utils.export_dataset_stream(db, f, denormalize=True, batch_size=args.batch_size)
+
+  report.measure('export_dataset', export, repeats=args.repeats, num_records=num_records)
+  report.measure('export_dataset_stream', export_stream, repeats=args.repeats, num_records=num_records)
+
+def load_bbox_tasks(db, dataset, args):
+  tasks = synthetic.make_bbox_tasks(dataset, INSTRUCTIONS_ID, args.images_per_task)
+  with quiet():
+    db_bbox_utils.ensure_bbox_indices(db)
+    db_bbox_utils.insert_bbox_task_instructions(db, [synthetic.make_bbox_task_instructions(INSTRUCTIONS_ID)])
+    db_bbox_utils.insert_bbox_tasks(db, tasks, batch_size=args.batch_size, num_workers=args.num_workers)
+  task_results = synthetic.make_bbox_task_results(dataset, tasks)
+  db.bbox_task_result.insert_many(task_results)
+  return tasks, task_results
+
+def benchmark_export_task_results(report, db, task_results, args):
+
+  def export():
+    with quiet():
+      db_bbox_utils.export_task_results(db, denormalize=True)
+
+  def export_stream():
+    with quiet(), open(os.devnull, 'w') as f:
+      db_bbox_utils.export_task_results_stream(db, f, denormalize=True, batch_size=args.batch_size)
+
+  report.measure('export_task_results', export, repeats=args.repeats, num_records=len(task_results))
+  report.measure('export_task_results_stream', export_stream, repeats=args.repeats, num_records=len(task_results))
+
+def check_serialization_parity():
+  """ Check that `serialization` encodes and decodes the values where orjson and the json module
+  differ the same way with either backend.
+  """
+  docs = [
+    {1 : 'int', 2.5 : 'float', True : 'bool', None : 'none'},
+    {'nan' : float('nan'), 'infinity' : [float('inf'), float('-inf')], 'id' : ObjectId()},
+    {'u64' : 2**64 - 1, 'wide' : 2**64, 'negative' : -2**63 - 1, 'date' : datetime.datetime(2020, 1, 1)},
+  ]
+  for doc in docs:
+    assert serialization.dumps(doc) == serialization._json_dumps(doc), doc
+  bodies = [serialization.dumps(doc) for doc in docs] + [
+    '{"nan":NaN,"infinity":[Infinity,-Infinity,1e400]}',
+    '{"wide":18446744073709551616,"negative":-9223372036854775809,"float":0.0000000000000000000001}',
+    '{"id":"1234567890123456789","oid":{"$oid":"%s"}}' % (ObjectId(),),
+    '18446744073709551616', 'NaN', '"text"',
+  ]
+  for body in bodies:
+    expected = repr(serialization._json_loads(body))
+    assert repr(serialization.loads(body)) == expected, body
+    assert repr(serialization.loads(body.encode('utf-8'))) == expected, body
+
+def benchmark_serialization(report, db, dataset, args):
+  """ Compare the CPU time and allocations of encoding a window of `/edit_images/` data, and of
+  decoding an `/annotations/save` body, with `json_util` round trips and with `serialization`.
+  """
+  image_ids = [image['id'] for image in dataset['images'][:6]]
+  images = list(db.image.find({'id' : {'$in' : image_ids}}))
+  image_data = [{'image' : image, 'annotations' : list(db.annotation.find({'image_id' : image['id']}))}
+                for image in images]
+  num_annotations = sum(len(data['annotations']) for data in image_data)
+  body = json_util.dumps({'annotations' : [anno for data in image_data for anno in data['annotations']]})
+
+  def encode_json_util():
+    with web.app.app_context():
+      jsonify({'image_data' : json.loads(json_util.dumps(image_data))}).get_data()
+
+  def encode_serialization():
+    serialization.dumpb({'image_data' : image_data})
+
+  check_serialization_parity()
+  repeats = args.num_requests
+  report.measure_cpu('encode json_util', encode_json_util, repeats=repeats, num_records=num_annotations)
+  report.measure_cpu('encode %s' % (serialization.BACKEND,), encode_serialization, repeats=repeats, num_records=num_annotations)
+  report.measure_cpu('decode json_util', lambda: json_util.loads(body), repeats=repeats, num_records=num_annotations)
+  report.measure_cpu('decode serialization', lambda: serialization.loads(body), repeats=repeats, num_records=num_annotations)
+
+def _time_requests(report, name, client, make_request, num_requests):
+  """ Time `num_requests` requests, one at a time. `make_request` sends a request with the test client.
+  """
+  latencies = []
+  for i in range(num_requests):
+    start = time.time()
+    response = make_request(client, i)
+    latencies.append(time.time() - start)
+    if response.status_code >= 400:
+      raise ValueError("%s returned %d" % (name, response.status_code))
+  report.add(name, latencies)
+
+def benchmark_http(report, client, db, dataset, tasks, args):
+  rng = random.Random(0)
+  image_ids = [image['id'] for image in dataset['images']]
+  category_ids = [category['id'] for category in dataset['categories']]
+  xhr = {'X-Requested-With' : 'XMLHttpRequest'}
+
+  _time_requests(report, 'GET /edit_image/ (html)', client,
+    lambda c, i: c.get('/edit_image/%s' % (rng.choice(image_ids),)), args.num_requests)
+
+  _time_requests(report, 'GET /edit_image/ (xhr)', client,
+    lambda c, i: c.get('/edit_image/%s' % (rng.choice(image_ids),), headers=xhr), args.num_requests)
+
+  _time_requests(report, 'GET /edit_images/', client,
+    lambda c, i: c.get('/edit_images/', query_string={'image_ids' : ','.join(rng.sample(image_ids, min(6, len(image_ids))))}),
+    args.num_requests)
+
+  _time_requests(report, 'GET /edit_task/', client,
+    lambda c, i: c.get('/edit_task/', query_string={'category_id' : rng.choice(category_ids)}), args.num_requests)
+
+  _time_requests(report, 'GET /bbox_task/', client,
+    lambda c, i: c.get('/bbox_task/%s' % (rng.choice(tasks)['id'],)), args.num_requests)
+
+  def save(c, i):
+    image_id = rng.choice(image_ids)
+    annotations = json.loads(serialization.dumps(list(db.annotation.find({'image_id' : image_id}))))
+    for anno in annotations:
+      anno['bbox'] = [min(1., v * rng.uniform(0.95, 1.05)) for v in anno['bbox']]
+    return c.post('/annotations/save', data=json.dumps({'annotations' : annotations}), content_type='application/json')
+
+  _time_requests(report, 'POST /annotations/save', client, save, args.num_requests)
+
+def parse_args():
+
+  parser = argparse.ArgumentParser(description='Benchmark loading, exporting and the web server on a synthetic dataset.')
+
+  parser.add_argument('--mongo_uri', dest='mongo_uri', type=str, default=None,
+                      help='URI of the mongod to benchmark against. Defaults to MONGO_HOST and MONGO_PORT.')
+
+  parser.add_argument('--mongomock', dest='mongomock', action='store_true', default=False,
+                      help='Benchmark against an in-memory mongomock database instead of a mongod.')
+
+  parser.add_argument('--db_name', dest='db_name', type=str, default='vat_benchmark',
+                      help='Name of the benchmark database. It is dropped before and after the run.')
+
+  parser.add_argument('--num_images', dest='num_images', type=int, default=1000,
+                      help='Number of synthetic images.')
+
+  parser.add_argument('--annotations_per_image', dest='annotations_per_image', type=int, default=10,
+                      help='Number of annotations per image.')
+
+  parser.add_argument('--num_keypoints', dest='num_keypoints', type=int, default=17,
+                      help='Number of keypoints per annotation, 0 for bboxes only.')
+
+  parser.add_argument('--num_categories', dest='num_categories', type=int, default=10,
+                      help='Number of categories.')
+
+  parser.add_argument('--images_per_task', dest='images_per_task', type=int, default=20,
+                      help='Number of images per bbox task.')
+
+  parser.add_argument('--repeats', dest='repeats', type=int, default=3,
+                      help='Number of times to run each load and export benchmark.')
+
+  parser.add_argument('--num_requests', dest='num_requests', type=int, default=200,
+                      help='Number of requests to send to each route.')
+
+  parser.add_argument('--batch_size', dest='batch_size', type=int, default=db_dataset_utils.DEFAULT_BATCH_SIZE,
+                      help='Batch size for loading and exporting.')
+
+  parser.add_argument('--num_workers', dest='num_workers', type=int, default=db_dataset_utils.DEFAULT_NUM_WORKERS,
+                      help='Number of concurrent inserts when loading.')
+
+  parser.add_argument('--skip', dest='skip', nargs='*', default=[], choices=['load', 'export', 'tasks', 'serialize', 'http', 'dispatch'],
+                      help='Benchmark groups to skip.')
+
+  parser.add_argument('--output', dest='output_path', type=str, default='benchmark_results.json',
+                      help='Path to write the json results to.')
+
+  return parser.parse_args()
+
+def benchmark_dispatch(report, db, tasks, args, redundancy=2, num_workers=8):
+  """ Lease and complete every task `redundancy` times with a pool of simulated workers, and check the
+  dispatch rules along the way: a worker that asks again gets its unexpired lease back, an abandoned
+  lease goes to another worker, and each task is completed by `redundancy` different workers.
+  """
+  worker_ids = ['worker%d' % i for i in range(max(num_workers, redundancy + 1))]
+
+  def setup():
+    db.bbox_task.update_many({}, {'$set' : task_dispatch.dispatch_fields(redundancy)})
+
+  def lease_and_complete():
+    # The first lease is abandoned: it expires at once, and the task's slot is reclaimed by the next lease.
+    abandoned = task_dispatch.lease_task(db, worker_ids[0], lease_duration=-1, reclaim_interval=0)
+    assert abandoned is not None
+    workers = list(worker_ids)
+    while len(workers) > 0:
+      for worker_id in list(workers):
+        lease = task_dispatch.lease_task(db, worker_id, reclaim_interval=0)
+        if lease is None:
+          workers.remove(worker_id)
+          continue
+        # Reloading the task page doesn't take a second task.
+        assert task_dispatch.lease_task(db, worker_id, reclaim_interval=0)['lease_id'] == lease['lease_id']
+        assert task_dispatch.complete_task(db, lease['task_id'], worker_id, lease['lease_id'])
+
+    status = task_dispatch.dispatch_status(db)
+    assert status['completed_tasks'] == len(tasks), status
+    assert status['active_leases'] == 0 and status['expired_leases'] == 0, status
+    for task in db.bbox_task.find(projection={'completed_by' : True}):
+      assert len(set(task['completed_by'])) == len(task['completed_by']) == redundancy, task
+
+  report.measure('dispatch lease_task + complete_task', lease_and_complete, repeats=args.repeats,
+                 num_records=redundancy * len(tasks), setup=setup)
+
+def main():
+  args = parse_args()
+
+  mongo_uri = args.mongo_uri
+  if mongo_uri is None and not args.mongomock:
+    # The benchmark database is `--db_name`, whatever database the configured uri names.
+    mongo_uri = connection.mongo_uri()
+  client, db = connect(mongo_uri, args.db_name, use_mongomock=args.mongomock)
+
+  config = dict(vars(args))
+  config['backend'] = 'mongomock' if args.mongomock else 'mongod'
+  report = Report(config)
+
+  print("Generating %d images with %d annotations each" % (args.num_images, args.annotations_per_image))
+  dataset = synthetic.make_dataset(args.num_images, args.annotations_per_image, args.num_keypoints, args.num_categories)
+  temp_dir = tempfile.mkdtemp()
+  dataset_path = os.path.join(temp_dir, 'dataset.json')
+  synthetic.write_dataset(dataset, dataset_path)
+
+  # Point the web app at the benchmark database.
+  web.mongo.cx = client
+  web.mongo.db = db
+
+  try:
+    if 'load' not in args.skip:
+      benchmark_load(report, db, dataset, dataset_path, args)
+
+    # The remaining benchmarks read from a freshly loaded dataset.
+    _reset(db)
+    with quiet():
+      db_dataset_utils.ensure_dataset_indices(db)
+      db_dataset_utils.load_dataset_stream(db, dataset_path, normalize=True,
+                                           batch_size=args.batch_size, num_workers=args.num_workers)
+
+    if 'export' not in args.skip:
+      benchmark_export(report, db, dataset, args)
+
+    tasks, task_results = load_bbox_tasks(db, dataset, args)
+    if 'tasks' not in args.skip:
+      benchmark_export_task_results(report, db, task_results, args)
+
+    if 'serialize' not in args.skip:
+      benchmark_serialization(report, db, dataset, args)
+
+    if 'http' not in args.skip:
+      benchmark_http(report, web.app.test_client(), db, dataset, tasks, args)
+
+    if 'dispatch' not in args.skip:
+      benchmark_dispatch(report, db, tasks, args)
+
+  finally:
+    _reset(db)
+    shutil.rmtree(temp_dir)
+
+  report.write(args.output_path)
+  print("Wrote the results to %s" % (args.output_path,))
+
+if __name__ == '__main__':
+  main()
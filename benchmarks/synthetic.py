@@ -0,0 +1,133 @@
+"""
+Generate synthetic datasets in the COCO format (see the README), at any scale, along with bbox
+tasks and task results for them. The output is deterministic for a given seed.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import random
+
+def make_dataset(num_images, annotations_per_image, num_keypoints=0, num_categories=10, seed=0):
+  """ Return a dataset dict with `num_images` images and `annotations_per_image` annotations per image.
+  Coordinates are in image space, i.e. the dataset should be loaded with `normalize=True`.
+  """
+  rng = random.Random(seed)
+
+  categories = []
+  for i in range(num_categories):
+    category = {
+      'id' : str(i),
+      'name' : 'category %d' % (i,),
+      'supercategory' : 'supercategory %d' % (i % 3,)
+    }
+    if num_keypoints > 0:
+      category['keypoints'] = ['part %d' % (k,) for k in range(num_keypoints)]
+      category['keypoints_style'] = ['#%06x' % (rng.randint(0, 0xffffff),) for _ in range(num_keypoints)]
+    categories.append(category)
+
+  licenses = [{'id' : '0', 'name' : 'license 0', 'url' : 'http://example.com/license'}]
+
+  images = []
+  annotations = []
+  for i in range(num_images):
+    image_id = '%09d' % (i,)
+    width = rng.randint(200, 1024)
+    height = rng.randint(200, 1024)
+    images.append({
+      'id' : image_id,
+      'width' : width,
+      'height' : height,
+      'file_name' : '%s.jpg' % (image_id,),
+      'license' : '0',
+      'url' : 'http://localhost:8007/%s.jpg' % (image_id,)
+    })
+    for _ in range(annotations_per_image):
+      w = rng.uniform(1, width / 2.)
+      h = rng.uniform(1, height / 2.)
+      x = rng.uniform(0, width - w)
+      y = rng.uniform(0, height - h)
+      anno = {
+        'id' : str(len(annotations)),
+        'image_id' : image_id,
+        'category_id' : str(rng.randrange(num_categories)),
+        'bbox' : [x, y, w, h],
+        'area' : w * h,
+        'iscrowd' : 0
+      }
+      if num_keypoints > 0:
+        keypoints = []
+        for _ in range(num_keypoints):
+          keypoints.extend([rng.uniform(x, x + w), rng.uniform(y, y + h), rng.randint(0, 2)])
+        anno['keypoints'] = keypoints
+        anno['num_keypoints'] = sum(1 for v in keypoints[2::3] if v > 0)
+      annotations.append(anno)
+
+  return {
+    'categories' : categories,
+    'images' : images,
+    'annotations' : annotations,
+    'licenses' : licenses
+  }
+
+def write_dataset(dataset, path):
+  with open(path, 'w') as f:
+    json.dump(dataset, f)
+
+def make_bbox_tasks(dataset, instructions_id, num_images_per_task=20):
+  """ Return bbox tasks covering all of the images of `dataset`, one category per task.
+  """
+  image_ids = [image['id'] for image in dataset['images']]
+  category_ids = [category['id'] for category in dataset['categories']]
+  tasks = []
+  for idx in range(0, len(image_ids), num_images_per_task):
+    tasks.append({
+      'id' : str(len(tasks)),
+      'image_ids' : image_ids[idx:idx + num_images_per_task],
+      'instructions_id' : instructions_id,
+      'category_id' : category_ids[len(tasks) % len(category_ids)]
+    })
+  return tasks
+
+def make_bbox_task_instructions(instructions_id):
+  return {
+    'id' : instructions_id,
+    'title' : 'Box the objects',
+    'description' : 'Draw a box around each object.',
+    'instructions' : 'http://example.com/instructions',
+    'examples' : []
+  }
+
+def make_bbox_task_results(dataset, tasks, boxes_per_image=2, seed=0):
+  """ Return a task result for each task, in normalized coordinates (as saved by the bbox task).
+  """
+  rng = random.Random(seed)
+  image_id_to_image = {image['id'] : image for image in dataset['images']}
+  task_results = []
+  for task in tasks:
+    results = []
+    for image_id in task['image_ids']:
+      annotations = []
+      for _ in range(boxes_per_image):
+        w = rng.uniform(0.01, 0.5)
+        h = rng.uniform(0.01, 0.5)
+        annotations.append({
+          'image_id' : image_id,
+          'category_id' : task['category_id'],
+          'bbox' : [rng.uniform(0, 1 - w), rng.uniform(0, 1 - h), w, h]
+        })
+      results.append({
+        'time' : rng.uniform(1, 20),
+        'annotations' : annotations,
+        'image' : image_id_to_image[image_id]
+      })
+    task_results.append({
+      'time' : rng.uniform(20, 200),
+      'task_id' : task['id'],
+      'date' : '2017-01-01 00:00:00',
+      'worker_id' : 'worker %d' % (rng.randrange(100),),
+      'results' : results
+    })
+  return task_results
@@ -0,0 +1,22 @@
+import $ from 'jquery';
+
+/**
+ * Fetch the categories from the server. The server responds with an ETag, so the browser
+ * only downloads the categories again when they have changed.
+ */
+export let loadCategories = function(onSuccess, onFail){
+
+  $.ajax({
+    url : "/categories",
+    method : 'GET',
+    dataType : 'json'
+  }).done(function(categories){
+    onSuccess(categories);
+  }).fail(function(jqXHR, textStatus, errorThrown){
+    console.log(textStatus);
+    if(onFail){
+      onFail();
+    }
+  });
+
+}
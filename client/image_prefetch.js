@@ -0,0 +1,138 @@
+/*
+ * Download and decode upcoming images in the background, so that moving to the next image of a
+ * task doesn't wait on the network.
+ *
+ * Images with precomputed tiles (see annotation_tools/tiles.py) are warmed by loading their
+ * thumbnail and the tiles that are shown before the annotator zooms in. Other images are loaded
+ * from their url. The prefetched images are held in a least recently used cache of `maxImages`
+ * images, older images are released so that the browser can reclaim their memory.
+ */
+
+// The size (in pixels) of the image editor, used to pick the tiles that are shown at first.
+const DEFAULT_VIEW_SIZE = 600;
+
+function tileUrl(imageId){
+  return '/tiles/' + encodeURIComponent(imageId);
+}
+
+/*
+ * The urls of the thumbnail and of the tiles that cover the image when it is fit to a
+ * `viewSize` x `viewSize` view (see ImageTileLayer).
+ */
+export function initialTileUrls(imageId, info, viewSize){
+  let ratio = Math.min(viewSize / info.width, viewSize / info.height);
+  let level = info.max_level + Math.ceil(Math.log(ratio) / Math.LN2 - 1e-6);
+  level = Math.max(0, Math.min(info.max_level, level));
+
+  let baseUrl = tileUrl(imageId);
+  let urls = [baseUrl + '/thumbnail.jpg'];
+  let numTilesX = Math.ceil(info.levels[level][0] / info.tile_size);
+  let numTilesY = Math.ceil(info.levels[level][1] / info.tile_size);
+  for (var y = 0; y < numTilesY; y++){
+    for (var x = 0; x < numTilesX; x++){
+      urls.push(baseUrl + '/' + level + '/' + x + '_' + y + '.jpg');
+    }
+  }
+  return urls;
+}
+
+export class ImagePrefetcher {
+
+  constructor(maxImages, viewSize){
+    this.maxImages = maxImages;
+    this.viewSize = viewSize != null ? viewSize : DEFAULT_VIEW_SIZE;
+    // Image id -> {elements : [Image], request : jqXHR}, in least recently used order.
+    this.cache = new Map();
+  }
+
+  /*
+   * Prefetch `images` (image dicts with an `id` and `url`), in order of priority. Images that are
+   * already cached are marked as recently used.
+   */
+  prefetch(images){
+    if (images == null){
+      return;
+    }
+    images.forEach((image) => {
+      if (image == null){
+        return;
+      }
+      let entry = this.cache.get(image.id);
+      if (entry != null){
+        this.cache.delete(image.id);
+        this.cache.set(image.id, entry);
+        return;
+      }
+      entry = {elements : [], request : null};
+      this.cache.set(image.id, entry);
+      this._load(image, entry);
+    });
+
+    while (this.cache.size > this.maxImages){
+      let oldestId = this.cache.keys().next().value;
+      this._release(this.cache.get(oldestId));
+      this.cache.delete(oldestId);
+    }
+  }
+
+  clear(){
+    this.cache.forEach((entry) => {
+      this._release(entry);
+    });
+    this.cache.clear();
+  }
+
+  _load(image, entry){
+    if (window.VAT_IMAGE_TILES !== true){
+      this._loadUrls([image.url], entry);
+      return;
+    }
+    // The server includes the tile info in the image data (null for an image without tiles).
+    if (image.tiles !== undefined){
+      this._loadUrls(image.tiles != null ? initialTileUrls(image.id, image.tiles, this.viewSize) : [image.url], entry);
+      return;
+    }
+    // The info request is cached by the browser, so ImageLoader gets it for free later on.
+    entry.request = $.ajax({
+      url : tileUrl(image.id) + '/info.json',
+      method : 'GET',
+      dataType : 'json'
+    }).done((info) => {
+      entry.request = null;
+      this._loadUrls(initialTileUrls(image.id, info, this.viewSize), entry);
+    }).fail((jqXHR, textStatus) => {
+      entry.request = null;
+      if (textStatus != 'abort'){
+        this._loadUrls([image.url], entry);
+      }
+    });
+  }
+
+  _loadUrls(urls, entry){
+    if (entry.released){
+      return;
+    }
+    urls.forEach((url) => {
+      let element = new Image();
+      element.src = url;
+      // Decode off of the main thread, where supported, so the first paint doesn't have to.
+      if (element.decode != null){
+        element.decode().catch(() => {});
+      }
+      entry.elements.push(element);
+    });
+  }
+
+  _release(entry){
+    entry.released = true;
+    if (entry.request != null){
+      entry.request.abort();
+    }
+    entry.elements.forEach((element) => {
+      // Cancel the download if it is still in flight.
+      element.src = '';
+    });
+    entry.elements = [];
+  }
+
+}
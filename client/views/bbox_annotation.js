@@ -7,6 +7,7 @@ import '../leaflet.draw/leaflet.draw-src.js';
 
 import {COLORS,KEYS} from '../utils.js';
 import {Annotation} from './annotation.js';
+import {addImageLayer} from './image_tiles.js';
 import {BBoxInstructions} from './instructions.js';
 
 
@@ -179,7 +180,7 @@ export class BBoxAnnotation extends React.Component {
       leafletMap.setMaxBounds(bounds);
 
       // Render the image on the map
-      let image = L.imageOverlay(this.props.imageElement.src, bounds).addTo(leafletMap);
+      let image = addImageLayer(leafletMap, this.props.imageElement, bounds, width, height);
 
       // Add the feature group that will hold the annotations
       // All layers added to this feature group will be editable
@@ -7,6 +7,7 @@ import {BBoxAnnotation} from './bbox_annotation.js';
 import {TaskInstructions} from './task_instructions.js';
 
 import {MTurkFinishWrapper} from '../mturk.js';
+import {ImagePrefetcher} from '../image_prefetch.js';
 
 class BBoxTask extends React.Component {
 
@@ -84,6 +85,8 @@ class BBoxTask extends React.Component {
     if (this.state.imageElement == null){
       return (
           <ImageLoader url={this.props.image.url}
+              imageId={this.props.image.id}
+              tileInfo={this.props.image.tiles}
               onImageLoadSuccess={this.handleImageLoaded}
               onImageLoadError={this.handleImageFailed} />
       )
@@ -122,10 +125,21 @@ class BBoxTask extends React.Component {
 
 // Main driver. Handles showing the instructions, and then kicking off the task sequence,
 // and then sending the results back to the server.
-export let bboxTask = function(taskId, taskData, categories, mturk, taskInstructions){
+export let bboxTask = function(taskId, taskData, categories, mturk, taskInstructions, prefetchCount, lease){
+
+  // Start downloading the first images while the worker reads the instructions.
+  let imagePrefetcher = new ImagePrefetcher(2 * prefetchCount + 1);
+  imagePrefetcher.prefetch(taskData.slice(0, 1 + prefetchCount).map((data) => data.image));
 
   var onFinish;
   function submit(taskResults, onSuccess, onFailure){
+    // Tasks from /bbox_task/next are leased, the server closes the lease when it gets the results.
+    if (lease != null){
+      taskResults['lease_id'] = lease.lease_id;
+      if (taskResults['worker_id'] == null){
+        taskResults['worker_id'] = lease.worker_id;
+      }
+    }
     $.ajax({
       url : "/bbox_task/save",
       method : 'POST',
@@ -173,7 +187,7 @@ export let bboxTask = function(taskId, taskData, categories, mturk, taskInstruct
   // Function to start the TaskSequence
   function onStart(){
     ReactDOM.render(
-      <TaskSequence taskId={taskId} taskData={taskData} taskView={BBoxTask} categories={categories} onFinish={onFinish} taskInstructionModalId="bboxTaskHelpModal" taskHotKeysModalId="bboxTaskHotKeysModal" visualize={false}/>,
+      <TaskSequence taskId={taskId} taskData={taskData} taskView={BBoxTask} categories={categories} onFinish={onFinish} taskInstructionModalId="bboxTaskHelpModal" taskHotKeysModalId="bboxTaskHotKeysModal" visualize={false} prefetchCount={prefetchCount} imagePrefetcher={imagePrefetcher}/>,
       document.getElementById('app')
     );
   }
@@ -2,16 +2,21 @@ import React from 'react';
 import ReactDOM from 'react-dom';
 
 import {FullEditView} from './full_edit.js'
+import {loadCategories} from '../categories.js';
 
 /**
  * Edit a single Image
  */
 export let editImage = function(editData){
 
-    ReactDOM.render(
-        <FullEditView image={editData.image}
-                      annotations={editData.annotations}
-                      categories={editData.categories}/>,
-        document.getElementById('app')
-    );
-}
\ No newline at end of file
+    loadCategories(function(categories){
+        ReactDOM.render(
+            <FullEditView image={editData.image}
+                          annotations={editData.annotations}
+                          categories={categories}/>,
+            document.getElementById('app')
+        );
+    }, function(){
+        alert("Failed to load the categories");
+    });
+}
@@ -4,6 +4,7 @@ import ReactDOM from 'react-dom';
 import 'bootstrap';
 
 import {KEYS} from '../utils.js';
+import {ImagePrefetcher} from '../image_prefetch.js';
 
 
 /**
@@ -17,7 +18,10 @@ export class EditSequence extends React.Component {
 
         this.state = {
             imageIndex : -1,
-            fetchingData : true
+            fetchingData : true,
+            // The image ids are sent by the server a page at a time.
+            imageIds : props.imageIds,
+            nextCursor : props.nextCursor
         };
 
         this.prevImage = this.prevImage.bind(this);
@@ -25,14 +29,32 @@ export class EditSequence extends React.Component {
         this.finish = this.finish.bind(this);
         this.handleKeyDown = this.handleKeyDown.bind(this);
 
+        // Image data that has been fetched from the server, keyed by image id.
+        this.imageDataCache = {};
+        // Image ids that are currently being fetched, mapped to the callbacks waiting on them.
+        this.pendingRequests = {};
+        // Are we waiting on the next page of image ids?
+        this.fetchingImageIds = false;
+        // The callbacks waiting on the next page of image ids.
+        this.imageIdsCallbacks = [];
+        // Keeps the pixels of the upcoming images (and the recently visited ones) downloaded and decoded.
+        this.imagePrefetcher = props.imagePrefetcher;
+        if(this.imagePrefetcher == null){
+          this.imagePrefetcher = new ImagePrefetcher(2 * props.prefetchCount + 1);
+          this.imagePrefetcher.prefetch(props.images);
+        }
+
     }
 
     componentDidMount(){
       document.addEventListener("keydown", this.handleKeyDown);
 
-      if(this.props.imageIds.length > 0){
+      if(this.state.imageIds.length > 0){
+
+        let nextImageId = this.state.imageIds[0];
 
-        let nextImageId = this.props.imageIds[0];
+        // Get the data for the first few images with one request.
+        this.fetchImageData(this.state.imageIds.slice(0, 1 + this.props.prefetchCount));
 
         // Get the data for the next image.
         this.getImageData(nextImageId, (imageData)=>{
@@ -57,6 +79,7 @@ export class EditSequence extends React.Component {
 
     componentWillUnmount(){
       document.removeEventListener("keydown", this.handleKeyDown);
+      this.imagePrefetcher.clear();
     }
 
     handleKeyDown(e){
@@ -75,22 +98,150 @@ export class EditSequence extends React.Component {
 
     }
 
-    getImageData(imageId, onSuccess, onFail){
+    fetchImageData(imageIds){
+      /* Fetch the data for a window of images with a single request and store it in the cache.
+      */
+
+      imageIds = imageIds.filter((imageId) => {
+        return !(imageId in this.imageDataCache) && !(imageId in this.pendingRequests);
+      });
+      if(imageIds.length == 0){
+        return;
+      }
 
-      let endpoint = "/edit_image/" + imageId;
+      imageIds.forEach((imageId) => {
+        this.pendingRequests[imageId] = [];
+      });
 
       $.ajax({
-        url : endpoint,
-        method : 'GET'
-      }).done(function(data){
-        onSuccess(data);
-      }).fail(function(jqXHR, textStatus, errorThrown ){
+        url : "/edit_images/",
+        method : 'GET',
+        data : {'image_ids' : imageIds.join(',')}
+      }).done((data) => {
+        data.image_data.forEach((imageData) => {
+          this.imageDataCache[imageData.image.id] = imageData;
+        });
+        // Start downloading the pixels as soon as we know the urls.
+        this.imagePrefetcher.prefetch(data.image_data.map((imageData) => imageData.image));
+        imageIds.forEach((imageId) => {
+          let callbacks = this.pendingRequests[imageId];
+          delete this.pendingRequests[imageId];
+          callbacks.forEach((callback) => {
+            if(imageId in this.imageDataCache){
+              callback.onSuccess(this.imageDataCache[imageId]);
+            }
+            else{
+              callback.onFail();
+            }
+          });
+        });
+      }).fail((jqXHR, textStatus, errorThrown) => {
         console.log(textStatus);
-        onFail();
+        imageIds.forEach((imageId) => {
+          let callbacks = this.pendingRequests[imageId];
+          delete this.pendingRequests[imageId];
+          callbacks.forEach((callback) => {
+            callback.onFail();
+          });
+        });
       });
 
     }
 
+    fetchImageIds(onSuccess){
+      /* Fetch the next page of image ids and append it to the sequence. If the page is
+       * already being fetched, `onSuccess` is called once it arrives.
+      */
+
+      if(this.state.nextCursor == null){
+        return;
+      }
+      if(onSuccess != null && this.imageIdsCallbacks.indexOf(onSuccess) < 0){
+        this.imageIdsCallbacks.push(onSuccess);
+      }
+      if(this.fetchingImageIds){
+        return;
+      }
+      this.fetchingImageIds = true;
+
+      let data = Object.assign({}, this.props.pageArgs, {'after' : this.state.nextCursor});
+
+      $.ajax({
+        url : "/edit_task/image_ids",
+        method : 'GET',
+        data : data
+      }).done((data) => {
+        this.fetchingImageIds = false;
+        let callbacks = this.imageIdsCallbacks;
+        this.imageIdsCallbacks = [];
+        this.imagePrefetcher.prefetch(data.images);
+        this.setState(function(prevState, props){
+          return {
+            imageIds : prevState.imageIds.concat(data.image_ids),
+            nextCursor : data.next_cursor
+          }
+        }, () => {
+          callbacks.forEach((callback) => {
+            callback();
+          });
+        });
+      }).fail((jqXHR, textStatus, errorThrown) => {
+        this.fetchingImageIds = false;
+        this.imageIdsCallbacks = [];
+        console.log(textStatus);
+      });
+
+    }
+
+    prefetch(imageIndex){
+      /* Fetch the data for the images following `imageIndex` in the background, and drop
+       * the cached data for images that are far behind. The next page of image ids is
+       * fetched once the prefetch window reaches the end of the current page.
+      */
+
+      let imageIds = this.state.imageIds;
+      let prefetchCount = this.props.prefetchCount;
+
+      let keep = new Set(imageIds.slice(Math.max(0, imageIndex - prefetchCount), imageIndex + 1 + prefetchCount));
+      for(let imageId in this.imageDataCache){
+        if(!keep.has(imageId)){
+          delete this.imageDataCache[imageId];
+        }
+      }
+
+      // Mark the current and upcoming images that we already have as recently used.
+      let upcomingIds = imageIds.slice(imageIndex, imageIndex + 1 + prefetchCount).filter((imageId) => {
+        return imageId in this.imageDataCache;
+      });
+      this.imagePrefetcher.prefetch(upcomingIds.map((imageId) => this.imageDataCache[imageId].image));
+
+      this.fetchImageData(imageIds.slice(imageIndex + 1, imageIndex + 1 + prefetchCount));
+
+      if(imageIndex + 1 + prefetchCount >= imageIds.length){
+        this.fetchImageIds();
+      }
+    }
+
+    getImageData(imageId, onSuccess, onFail){
+
+      if(imageId in this.imageDataCache){
+        onSuccess(this.imageDataCache[imageId]);
+        return;
+      }
+
+      if(!(imageId in this.pendingRequests)){
+        this.fetchImageData([imageId]);
+      }
+      this.pendingRequests[imageId].push({onSuccess : onSuccess, onFail : onFail});
+
+    }
+
+    invalidateImageData(imageId){
+      /* The annotations for this image have been saved, so the cached copy is stale.
+      */
+      delete this.imageDataCache[imageId];
+    }
+
 
     prevImage(){
 
@@ -103,11 +254,15 @@ export class EditSequence extends React.Component {
       }
       else{
         // Get the next image id
-        let nextImageId = this.props.imageIds[this.state.imageIndex - 1];
+        let nextImageId = this.state.imageIds[this.state.imageIndex - 1];
+
+        let currentImageId = this.state.imageIds[this.state.imageIndex];
 
         // Save the annotations from the current image
         this.taskViewRef.performSave(()=>{
 
+          this.invalidateImageData(currentImageId);
+
           // Get the data for the next image.
           this.getImageData(nextImageId, (imageData)=>{
 
@@ -140,17 +295,23 @@ export class EditSequence extends React.Component {
         return;
       }
 
-      if(this.state.imageIndex == this.props.imageIds.length - 1){
+      if(this.state.imageIndex == this.state.imageIds.length - 1){
+        // Wait for the next page of image ids, if there is one.
+        this.fetchImageIds(this.nextImage);
         return;
       }
       else{
 
         // Get the next image id
-        let nextImageId = this.props.imageIds[this.state.imageIndex + 1];
+        let nextImageId = this.state.imageIds[this.state.imageIndex + 1];
+
+        let currentImageId = this.state.imageIds[this.state.imageIndex];
 
         // Save the annotations from the current image
         this.taskViewRef.performSave(()=>{
 
+          this.invalidateImageData(currentImageId);
+
           // Get the data for the next image.
           this.getImageData(nextImageId, (imageData)=>{
 
@@ -183,6 +344,12 @@ export class EditSequence extends React.Component {
 
     }
 
+    componentDidUpdate(prevProps, prevState){
+      if(this.state.imageIndex != prevState.imageIndex){
+        this.prefetch(this.state.imageIndex);
+      }
+    }
+
     render() {
 
       if(this.state.fetchingData){
@@ -193,7 +360,8 @@ export class EditSequence extends React.Component {
 
       // feedback for the user
       let current_image = this.state.imageIndex + 1;
-      let num_images = this.props.imageIds.length;
+      let num_images = this.state.imageIds.length;
+      let more_images = this.state.nextCursor != null;
 
       // Determine which buttons we should render
       var buttons = []
@@ -202,12 +370,12 @@ export class EditSequence extends React.Component {
           (<button key="prevButton" type="button" className="btn btn-outline-secondary" onClick={this.prevImage}>Prev</button>)
         );
       }
-      if(this.state.imageIndex < num_images - 1){
+      if(this.state.imageIndex < num_images - 1 || more_images){
         buttons.push(
           (<button key="nextButton" type="button" className="btn btn-outline-secondary" onClick={this.nextImage}>Next</button>)
         );
       }
-      if(this.state.imageIndex == num_images - 1){
+      if(this.state.imageIndex == num_images - 1 && !more_images){
         buttons.push(
           (<button key="finishButton" type="button" className="btn btn-outline-success" onClick={this.finish}>Finish</button>)
         );
@@ -231,7 +399,7 @@ export class EditSequence extends React.Component {
                 <div className="btn-group" role="group">
                   {buttons}
                 </div>
-                  <span> Image {current_image} / {num_images} </span>
+                  <span> Image {current_image} / {num_images}{more_images ? '+' : ''} </span>
             </div>
             <div className="ml-auto">
 
@@ -245,6 +413,11 @@ export class EditSequence extends React.Component {
 
 EditSequence.defaultProps = {
   imageIds : [], // Array of image ids
+  nextCursor : null, // Cursor for the next page of image ids, or null if there are no more pages
+  pageArgs : null, // Query arguments for fetching the next page of image ids
+  images : [], // The first image dicts of the sequence, so that their pixels can be prefetched right away
+  prefetchCount : 5, // Number of upcoming images to fetch in the background
+  imagePrefetcher : null, // An ImagePrefetcher that may already be warming the first images
   onFinish : null, // a function to call when the image sequence is finished.
   categories : null // Categories array,
 };
\ No newline at end of file
@@ -4,24 +4,39 @@ import ReactDOM from 'react-dom';
 import {ImageLoader} from './image_loader.js';
 import {EditSequence} from './edit_seq.js';
 import {FullEditView} from './full_edit.js';
+import {loadCategories} from '../categories.js';
+import {ImagePrefetcher} from '../image_prefetch.js';
 
 
 // Main driver. Handles showing the instructions, and then kicking off the task sequence,
 // and then sending the results back to the server.
-export let editTask = function(taskId, imageIds, categories){
+export let editTask = function(taskId, imageIds, nextCursor, pageArgs, images, prefetchCount){
 
   let onFinish = function(){};
 
-  // Start the TaskSequence
-  ReactDOM.render(
-    <EditSequence taskId={taskId}
-                  imageIds={imageIds}
-                  taskView={FullEditView}
-                  categories={categories}
-                  onFinish={onFinish}/>,
-    document.getElementById('app')
-  );
-
-
+  // Start downloading the first images while the categories load.
+  let imagePrefetcher = new ImagePrefetcher(2 * prefetchCount + 1);
+  imagePrefetcher.prefetch(images);
+
+  loadCategories(function(categories){
+
+    // Start the TaskSequence
+    ReactDOM.render(
+      <EditSequence taskId={taskId}
+                    imageIds={imageIds}
+                    nextCursor={nextCursor}
+                    pageArgs={pageArgs}
+                    images={images}
+                    prefetchCount={prefetchCount}
+                    imagePrefetcher={imagePrefetcher}
+                    taskView={FullEditView}
+                    categories={categories}
+                    onFinish={onFinish}/>,
+      document.getElementById('app')
+    );
+
+  }, function(){
+    alert("Failed to load the categories");
+  });
 
 }
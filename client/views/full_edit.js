@@ -19,6 +19,18 @@ export class FullEditView extends React.Component {
         this.handleImageFailed = this.handleImageFailed.bind(this);
         this.performSave = this.performSave.bind(this);
         //this.saveAnnotations = this.saveAnnotations.bind(this);
+
+        // The last saved version of each annotation (as a json string), keyed by annotation id.
+        // Used to send only the annotations that changed.
+        this.savedAnnotations = {};
+        // The database `_id` of each annotation, keyed by annotation id.
+        this.annotationObjectIds = {};
+        this.props.annotations.forEach((annotation) => {
+          this.savedAnnotations[annotation.id] = JSON.stringify(annotation);
+          if(annotation._id != undefined){
+            this.annotationObjectIds[annotation.id] = annotation._id;
+          }
+        });
     }
 
   handleImageLoaded(imageElement) {
@@ -31,26 +43,86 @@ export class FullEditView extends React.Component {
     console.log('Image failed to load');
   }
 
+  getChangedAnnotations(annotations){
+    /* Return the annotations that differ from their last saved version, with their `_id` attached.
+    */
+    var changed = [];
+    annotations.forEach((annotation) => {
+
+      if(annotation._id == undefined && annotation.id in this.annotationObjectIds){
+        annotation._id = this.annotationObjectIds[annotation.id];
+      }
+
+      if(annotation.deleted){
+        // Nothing to do if this annotation never made it to the server, or was already deleted.
+        if(annotation._id == undefined || this.savedAnnotations[annotation.id] == null){
+          return;
+        }
+      }
+      else if(this.savedAnnotations[annotation.id] == JSON.stringify(annotation)){
+        return;
+      }
+
+      changed.push(annotation);
+    });
+    return changed;
+  }
+
   performSave(onSuccess, onFail){
     if(this.leafletImage != 'undefined' && this.leafletImage != null){
       let imageData = this.leafletImage.getState();
+      let annotations = this.getChangedAnnotations(imageData.annotations);
 
-      console.log("saving annotations");
+      if(annotations.length == 0){
+        onSuccess();
+        return;
+      }
+
+      console.log("saving " + annotations.length + " annotations");
       $.ajax({
         url : "/annotations/save",
         method : 'POST',
-        data : JSON.stringify({'annotations' : imageData.annotations}),
+        data : JSON.stringify({'annotations' : annotations}),
         contentType: 'application/json'
-      }).done(function(){
+      }).done((data) => {
         console.log("saved annotations");
+        this.handleSaveResults(annotations, data.results);
         onSuccess();
-      }).fail(function(){
+      }).fail((jqXHR) => {
+        if(jqXHR.responseJSON != undefined){
+          // Some of the annotations may have been saved.
+          this.handleSaveResults(annotations, jqXHR.responseJSON.results);
+        }
         onFail();
       });
 
     }
   }
 
+  handleSaveResults(annotations, results){
+    /* Remember what was saved, and the `_id` of new annotations so that they are not upserted again.
+    */
+    for(var i = 0; i < results.length; i++){
+      let annotation = annotations[i];
+      let result = results[i];
+      if(result._id != undefined){
+        annotation._id = result._id;
+        this.annotationObjectIds[annotation.id] = result._id;
+      }
+      if(result.status == 'deleted'){
+        this.savedAnnotations[annotation.id] = null;
+      }
+      else if(result.status == 'not_found'){
+        // Someone else deleted this annotation, it is created again (by its `id`) the next time it is saved.
+        delete annotation._id;
+        delete this.annotationObjectIds[annotation.id];
+      }
+      else if(result.status == 'replaced' || result.status == 'upserted'){
+        this.savedAnnotations[annotation.id] = JSON.stringify(annotation);
+      }
+    }
+  }
+
     // saveAnnotations(annotations){
     //   console.log("saving annotations");
     //   $.ajax({
@@ -70,6 +142,8 @@ export class FullEditView extends React.Component {
     if (this.state.imageElement == null){
         return (
             <ImageLoader url={this.props.image.url}
+                imageId={this.props.image.id}
+                tileInfo={this.props.image.tiles}
                 onImageLoadSuccess={this.handleImageLoaded}
                 onImageLoadError={this.handleImageFailed} />
         )
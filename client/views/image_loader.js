@@ -1,32 +1,129 @@
 import React from 'react';
+import $ from 'jquery';
 
 /*
  * Load an image, perhaps with a spinner, etc.
+ *
+ * When the server has tiles for the image (see annotation_tools/tiles.py), only the thumbnail is
+ * loaded here. The image element passed to `onImageLoadSuccess` then has the full resolution
+ * `width` and `height`, and a `tiles` object with the tile url and info.
+ *
+ * Pass the `tiles` of the image data as `tileInfo` (null for an image without tiles) to skip the
+ * `info.json` request. If it is undefined, the info is requested from the server.
  */
 export class ImageLoader extends React.Component {
 
     constructor(props) {
         super(props);
 
+        this.state = this.initialTileState(props);
+
         this.onImageLoaded = this.onImageLoaded.bind(this);
         this.onImageErrored = this.onImageErrored.bind(this);
     }
 
+    initialTileState(props) {
+        if (props.imageId == null || window.VAT_IMAGE_TILES !== true){
+            return {checkingTiles : false, tiles : null};
+        }
+        if (props.tileInfo !== undefined){
+            let tiles = null;
+            if (props.tileInfo != null){
+                tiles = {url : '/tiles/' + encodeURIComponent(props.imageId), info : props.tileInfo};
+            }
+            return {checkingTiles : false, tiles : tiles};
+        }
+        // Is the tile info request in flight?
+        return {checkingTiles : true, tiles : null};
+    }
+
+    componentDidMount() {
+        if (this.state.checkingTiles){
+            this.checkTiles();
+        }
+    }
+
+    componentDidUpdate(prevProps) {
+        if (prevProps.imageId != this.props.imageId){
+            let state = this.initialTileState(this.props);
+            this.setState(state);
+            if (state.checkingTiles){
+                this.checkTiles();
+            }
+        }
+    }
+
+    checkTiles() {
+        if (this.tileRequest != null){
+            this.tileRequest.abort();
+        }
+        let imageId = this.props.imageId;
+        let tileUrl = '/tiles/' + encodeURIComponent(imageId);
+        this.tileRequest = $.ajax({
+            url : tileUrl + '/info.json',
+            method : 'GET',
+            dataType : 'json'
+        }).done((info) => {
+            if (imageId == this.props.imageId){
+                this.setState({checkingTiles : false, tiles : {url : tileUrl, info : info}});
+            }
+        }).fail(() => {
+            // No tiles, load the full image.
+            if (imageId == this.props.imageId){
+                this.setState({checkingTiles : false});
+            }
+        });
+    }
+
+    componentWillUnmount() {
+        if (this.tileRequest != null){
+            this.tileRequest.abort();
+        }
+    }
+
     onImageLoaded() {
-        this.props.onImageLoadSuccess(this.image);
+        if (this.state.tiles != null){
+            this.props.onImageLoadSuccess({
+                src : this.image.src,
+                width : this.state.tiles.info.width,
+                height : this.state.tiles.info.height,
+                tiles : this.state.tiles
+            });
+        }
+        else{
+            this.props.onImageLoadSuccess(this.image);
+        }
     }
 
     onImageErrored() {
+        if (this.state.tiles != null){
+            // Fall back to the full image.
+            this.setState({tiles : null});
+            return;
+        }
         this.props.onImageLoadError();
     }
 
     render() {
 
+        if (this.state.checkingTiles){
+            return (
+                <div style={{display : 'none'}}>
+                    Loading Image
+                </div>
+            )
+        }
+
+        let url = this.props.url;
+        if (this.state.tiles != null){
+            url = this.state.tiles.url + '/thumbnail.jpg';
+        }
+
         return(
             <div style={{display : 'none'}}>
                 <img
                     ref={i => { this.image = i; }}
-                    src={this.props.url}
+                    src={url}
                     onLoad={this.onImageLoaded}
                     onError={this.onImageErrored}
                 />
@@ -35,4 +132,4 @@ export class ImageLoader extends React.Component {
         )
 
     }
-}
\ No newline at end of file
+}
@@ -0,0 +1,115 @@
+import L from 'leaflet';
+
+/*
+ * Render a tiled image (see annotation_tools/tiles.py) on a L.CRS.Simple map, loading only
+ * the tiles of the visible part of the image at the current zoom level.
+ *
+ * The image is drawn at `width` x `height` map pixels at zoom 0. The tiles of the lowest pyramid
+ * level whose resolution is at least the on-screen resolution are shown.
+ */
+export let ImageTileLayer = L.LayerGroup.extend({
+
+  // `tileUrl` is the url of the image's tiles (e.g. /tiles/<image id>), `info` is its info.json.
+  initialize: function(tileUrl, info, width, height){
+    L.LayerGroup.prototype.initialize.call(this);
+    this._tileUrl = tileUrl;
+    this._info = info;
+    this._width = width;
+    this._height = height;
+    this._tiles = {};
+  },
+
+  onAdd: function(map){
+    L.LayerGroup.prototype.onAdd.call(this, map);
+    map.on('moveend zoomend', this._update, this);
+    this._update();
+  },
+
+  onRemove: function(map){
+    map.off('moveend zoomend', this._update, this);
+    L.LayerGroup.prototype.onRemove.call(this, map);
+    this._tiles = {};
+  },
+
+  // The pyramid level to show at the current zoom.
+  _currentLevel: function(){
+    let info = this._info;
+    // Screen pixels per full resolution pixel.
+    let scale = Math.pow(2, this._map.getZoom()) * this._width / info.width;
+    let level = info.max_level + Math.ceil(Math.log(scale) / Math.LN2 - 1e-6);
+    return Math.max(0, Math.min(info.max_level, level));
+  },
+
+  // Convert full resolution image coordinates to a map location.
+  _unproject: function(x, y){
+    return this._map.unproject([x * this._width / this._info.width, y * this._height / this._info.height], 0);
+  },
+
+  _update: function(){
+    if (this._map == null){
+      return;
+    }
+    let info = this._info;
+    let tileSize = info.tile_size;
+    let level = this._currentLevel();
+    let levelWidth = info.levels[level][0];
+    let levelHeight = info.levels[level][1];
+    // Level pixels per full resolution pixel.
+    let levelScale = levelWidth / info.width;
+
+    // The visible part of the image, in level pixels.
+    let bounds = this._map.getBounds();
+    let northWest = this._map.project(bounds.getNorthWest(), 0);
+    let southEast = this._map.project(bounds.getSouthEast(), 0);
+    let x1 = northWest.x * info.width / this._width * levelScale;
+    let y1 = northWest.y * info.height / this._height * levelScale;
+    let x2 = southEast.x * info.width / this._width * levelScale;
+    let y2 = southEast.y * info.height / this._height * levelScale;
+
+    let minTileX = Math.max(0, Math.floor(x1 / tileSize));
+    let minTileY = Math.max(0, Math.floor(y1 / tileSize));
+    let maxTileX = Math.min(Math.ceil(levelWidth / tileSize) - 1, Math.floor(x2 / tileSize));
+    let maxTileY = Math.min(Math.ceil(levelHeight / tileSize) - 1, Math.floor(y2 / tileSize));
+
+    let visible = {};
+    for (var tileY = minTileY; tileY <= maxTileY; tileY++){
+      for (var tileX = minTileX; tileX <= maxTileX; tileX++){
+        let key = level + '/' + tileX + '_' + tileY;
+        visible[key] = true;
+        if (this._tiles[key] != null){
+          continue;
+        }
+        let tileBounds = L.latLngBounds(
+          this._unproject(tileX * tileSize / levelScale, Math.min((tileY + 1) * tileSize, levelHeight) / levelScale),
+          this._unproject(Math.min((tileX + 1) * tileSize, levelWidth) / levelScale, tileY * tileSize / levelScale)
+        );
+        // The tile pane is below the overlay pane that holds the annotations.
+        let tile = L.imageOverlay(this._tileUrl + '/' + key + '.jpg', tileBounds, {pane : 'tilePane'});
+        this._tiles[key] = tile;
+        this.addLayer(tile);
+      }
+    }
+
+    // Drop the tiles that are off screen or from another level.
+    for (var key in this._tiles){
+      if (visible[key] == null){
+        this.removeLayer(this._tiles[key]);
+        delete this._tiles[key];
+      }
+    }
+  }
+
+});
+
+/*
+ * Render the image loaded by ImageLoader on the map. A tiled image is drawn as its thumbnail
+ * (shown immediately, while the tiles load) under the visible tiles.
+ */
+export function addImageLayer(leafletMap, imageElement, bounds, width, height){
+  if (imageElement.tiles == null){
+    return L.imageOverlay(imageElement.src, bounds).addTo(leafletMap);
+  }
+  let image = L.imageOverlay(imageElement.src, bounds, {pane : 'tilePane'}).addTo(leafletMap);
+  new ImageTileLayer(imageElement.tiles.url, imageElement.tiles.info, width, height).addTo(leafletMap);
+  return image;
+}
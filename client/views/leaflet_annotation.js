@@ -8,6 +8,7 @@ import '../leaflet.draw/leaflet.draw.js';
 
 import {COLORS} from '../utils.js';
 import {Annotation} from './annotation.js';
+import {addImageLayer} from './image_tiles.js';
 import {DefaultEditInstructions, KeypointInstructions, BBoxInstructions} from './instructions.js';
 import {CategorySelectionModal} from './category_selection_modal.js';
 
@@ -155,7 +156,7 @@ export class LeafletAnnotation extends React.Component {
       leafletMap.setMaxBounds(bounds);
 
       // Render the image on the map
-      let image = L.imageOverlay(this.props.imageElement.src, bounds).addTo(leafletMap);
+      let image = addImageLayer(leafletMap, this.props.imageElement, bounds, width, height);
 
       // Add the feature group that will hold the annotations
       // All layers added to this feature group will be editable
@@ -4,6 +4,7 @@ import ReactDOM from 'react-dom';
 import 'bootstrap';
 
 import {KEYS} from '../utils.js';
+import {ImagePrefetcher} from '../image_prefetch.js';
 
 
 /**
@@ -30,14 +31,42 @@ export class TaskSequence extends React.Component {
         }
 
         this.overallStartTime = new Date().getTime() / 1000;
+
+        // Keeps the upcoming images (and the recently visited ones) downloaded and decoded.
+        this.imagePrefetcher = this.props.imagePrefetcher;
+        if (this.imagePrefetcher == null){
+          this.imagePrefetcher = new ImagePrefetcher(2 * this.props.prefetchCount + 1);
+        }
     }
 
     componentDidMount(){
       document.addEventListener("keydown", this.handleKeyDown);
+      this.prefetch(this.state.imageIndex);
     }
 
     componentWillUnmount(){
       document.removeEventListener("keydown", this.handleKeyDown);
+      this.imagePrefetcher.clear();
+    }
+
+    componentDidUpdate(prevProps, prevState){
+      if(this.state.imageIndex != prevState.imageIndex){
+        this.prefetch(this.state.imageIndex);
+      }
+    }
+
+    prefetch(imageIndex){
+      /* Warm the images following `imageIndex`, and the previous image in case the user goes back.
+      */
+      let taskData = this.props.taskData;
+      let indices = [];
+      for(var i = imageIndex; i < Math.min(taskData.length, imageIndex + 1 + this.props.prefetchCount); i++){
+        indices.push(i);
+      }
+      if(imageIndex > 0){
+        indices.push(imageIndex - 1);
+      }
+      this.imagePrefetcher.prefetch(indices.map((i) => taskData[i].image));
     }
 
     handleKeyDown(e){
@@ -210,6 +239,8 @@ export class TaskSequence extends React.Component {
 
 TaskSequence.defaultProps = {
   taskData : [], // Array of image dicts
+  prefetchCount : 5, // Number of upcoming images to download in the background
+  imagePrefetcher : null, // An ImagePrefetcher that may already be warming the first images
   onFinish : null, // a function to call when the image sequence is finished.
   categories : null, // Categories array,
   taskInstructionModalId : null,
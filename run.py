@@ -4,6 +4,15 @@ Start the web server.
 $ python run.py \
 --debug \
 --port 8008
+
+Start the production server (requires gunicorn):
+
+$ python run.py \
+--production \
+--host 0.0.0.0 \
+--port 8008 \
+--workers 4 \
+--threads 16
 """
 
 import argparse
@@ -30,6 +39,22 @@ def parse_args():
                         help='Host to run on, set to 0.0.0.0 for remote access', type=str,
                         required=False, default=DEFAULT_HOST)
 
+  parser.add_argument('--production', dest='production',
+                        help='Run with a multi-process production server (gunicorn) instead of the development server.',
+                        required=False, action='store_true', default=False)
+
+  parser.add_argument('--workers', dest='workers',
+                        help='Number of worker processes for the production server. Defaults to SERVER_WORKERS.', type=int,
+                        required=False, default=None)
+
+  parser.add_argument('--threads', dest='threads',
+                        help='Number of request threads per worker for the production server. Defaults to SERVER_THREADS.', type=int,
+                        required=False, default=None)
+
+  parser.add_argument('--worker_class', dest='worker_class',
+                        help='gunicorn worker class for the production server, e.g. gthread or gevent. Defaults to SERVER_WORKER_CLASS.', type=str,
+                        required=False, default=None)
+
   args = parser.parse_args()
   return args
 
@@ -37,7 +62,12 @@ def parse_args():
 def main():
   args = parse_args()
 
-  app.run(host=args.host, port=args.port, debug=args.debug)
+  if args.production:
+    from annotation_tools.server import run_production_server
+    run_production_server(app, host=args.host, port=args.port,
+                          workers=args.workers, threads=args.threads, worker_class=args.worker_class)
+  else:
+    app.run(host=args.host, port=args.port, debug=args.debug, threaded=True)
 
 
 if __name__ == "__main__":